@@ -163,6 +163,12 @@ STATICFILES_FINDERS = [
 MEDIA_ROOT = str(APPS_DIR('media'))
 # https://docs.djangoproject.com/en/dev/ref/settings/#media-url
 MEDIA_URL = '/media/'
+# https://docs.djangoproject.com/en/dev/ref/settings/#file-upload-handlers
+# Same as the defaults, but uploads are also hashed as they are received (see `gwas.uploads`)
+FILE_UPLOAD_HANDLERS = [
+    'locuszoom_plotting_service.gwas.uploads.HashingMemoryFileUploadHandler',
+    'locuszoom_plotting_service.gwas.uploads.HashingTemporaryFileUploadHandler',
+]
 
 # TEMPLATES
 # ------------------------------------------------------------------------------
@@ -321,6 +327,35 @@ REST_FRAMEWORK = {
 #   for JS in LocalZoom, separately.
 LZ_MAX_REGION_SIZE = 2_000_000
 
+# Manhattan plots with large -log10(p) values fold the y-axis at this value. Manhattan plot data is binned at a
+#   resolution that suits the folded axis; the value is set for JS separately (see `pheweb_plots.js`).
+LZ_MANHATTAN_FOLD_THRESHOLD = 20
+
+# Number of processes used to summarize each study (one chromosome at a time), per Celery queue, eg "celery=4,big=32".
+#   Queues that are not listed summarize the whole file in a single read, in the worker process.
+LZ_SUMMARY_WORKERS = env.dict('LZ_SUMMARY_WORKERS', cast={'value': int}, default={})
+
+# Uploads whose rows are not sorted by chromosome and position are rejected, unless sorting is enabled. Sorting uses at
+#   most this much memory (per task) and temporary disk space (in the study folder), in bytes.
+LZ_SORT_UNSORTED_UPLOADS = env.bool('LZ_SORT_UNSORTED_UPLOADS', default=False)
+LZ_SORT_MEMORY_BYTES = env.int('LZ_SORT_MEMORY_BYTES', default=512 * 2 ** 20)
+LZ_SORT_DISK_BYTES = env.int('LZ_SORT_DISK_BYTES', default=20 * 2 ** 30)
+
+# Identical uploads wait while one of them writes the shared data (see `gwas.models.SharedArtifacts`). If that upload
+#   has not finished after this many seconds (eg because its worker was killed), the next identical upload redoes it.
+LZ_SHARED_DATA_CLAIM_TIMEOUT = env.int('LZ_SHARED_DATA_CLAIM_TIMEOUT', default=24 * 60 * 60)
+
+# Rendered region API responses are cached in each web process (up to this many bytes), and in the shared cache (for
+#   this many seconds). See `api.caching`.
+LZ_REGION_CACHE_BYTES = env.int('LZ_REGION_CACHE_BYTES', default=64 * 2 ** 20)
+LZ_REGION_CACHE_TIMEOUT = env.int('LZ_REGION_CACHE_TIMEOUT', default=7 * 24 * 60 * 60)
+# Region API responses for regions at least this large (bp) are sent as they are read, rather than all at once
+LZ_REGION_STREAM_MIN_SIZE = env.int('LZ_REGION_STREAM_MIN_SIZE', default=500_000)
+# Each web process keeps up to this many tabix files open between region queries
+LZ_TABIX_MAX_OPEN = env.int('LZ_TABIX_MAX_OPEN', default=256)
+# ... and up to this many columnar stores (each maps the files of the chromosomes that have been queried)
+LZ_COLUMNAR_MAX_OPEN = env.int('LZ_COLUMNAR_MAX_OPEN', default=256)
+
 # The "official" domain name. This is set in a .env file, and it must exactly match the base url registered as part of
 #   your OAuth provider configuration (eg callback urls). It should be a domain, not an IP.
 LZ_OFFICIAL_DOMAIN = env('LZ_OFFICIAL_DOMAIN', default='my.locuszoom.org')
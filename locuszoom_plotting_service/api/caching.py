@@ -0,0 +1,129 @@
+"""
+Caches used by the region API
+
+The data for an ingested fileset never changes, and many users tend to view the same (popular) regions. Rendered
+    responses are kept in a small in-process LRU cache, in front of the cache shared by all web workers
+    (`CACHES['default']`). Each key includes the fileset (and when it was ingested), so a study that points at new data
+    never sees the old responses.
+
+Each process also keeps recently used tabix files and columnar stores open (`tabix_pool`, `columnar_stores`), for
+    queries that are not in the cache.
+"""
+import collections
+import threading
+import typing as ty
+
+from django.conf import settings
+from django.core.cache import caches
+
+from locuszoom_plotting_service.gwas import models as lz_models
+from util.ingest import handles
+
+
+# Increment when a change alters the rendered responses (eg new fields), so that old entries are ignored
+VERSION = 1
+
+
+class LRUByteCache:
+    """A least-recently-used cache of byte strings, which holds at most `max_bytes` in total (thread safe)"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()  # type: ty.OrderedDict[str, bytes]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> ty.Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            # Would evict everything else, and still not fit
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class RegionCache:
+    """
+    Two tiers of cache for rendered region responses: local to this process (fast, small), then shared (by all
+        workers). Entries found in the shared cache are copied to the local one.
+
+    Hits and misses are counted per process (see `stats`), to help choose the size of each tier.
+    """
+    def __init__(self, *, max_bytes: int, timeout: int, alias: str = 'default'):
+        self.local = LRUByteCache(max_bytes)
+        self.timeout = timeout
+        self._alias = alias
+        self._counts = collections.Counter()  # type: ty.Counter[str]
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self._alias]
+
+    @staticmethod
+    def make_key(fileset: lz_models.AnalysisFileset, chrom: str, start: int, end: int, *, layout: str) -> str:
+        """The key for one region of a fileset, in one response format (`layout`)"""
+        ingested = int(fileset.ingest_complete.timestamp()) if fileset.ingest_complete else 0
+        return f'lz-region:{VERSION}:{layout}:{fileset.pk}:{ingested}:{chrom}:{start}:{end}'
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    def get(self, key: str) -> ty.Optional[bytes]:
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+
+        value = self.shared.get(key)
+        if value is not None:
+            self._count('shared_hits')
+            self.local.set(key, value)
+            return value
+
+        self._count('misses')
+        return None
+
+    def set(self, key: str, value: bytes):
+        self.local.set(key, value)
+        self.shared.set(key, value, timeout=self.timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        return {
+            'local_hits': counts.get('local_hits', 0),
+            'shared_hits': counts.get('shared_hits', 0),
+            'misses': counts.get('misses', 0),
+            'local_entries': len(self.local),
+            'local_bytes': self.local.size,
+            'local_max_bytes': self.local.max_bytes,
+        }
+
+
+region_cache = RegionCache(max_bytes=settings.LZ_REGION_CACHE_BYTES, timeout=settings.LZ_REGION_CACHE_TIMEOUT)
+
+tabix_pool = handles.TabixPool(max_open=settings.LZ_TABIX_MAX_OPEN)
+
+columnar_stores = handles.ColumnarStorePool(max_open=settings.LZ_COLUMNAR_MAX_OPEN)
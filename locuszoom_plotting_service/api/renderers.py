@@ -1,3 +1,4 @@
+from rest_framework import renderers as drf_renderers
 from rest_framework_json_api.renderers import JSONRenderer
 
 
@@ -20,3 +21,12 @@ class HackJSONAPIRenderer(JSONRenderer):
 
         base['id'] = resource_instance.slug
         return base
+
+
+class GwasColumnsRenderer(drf_renderers.JSONRenderer):
+    """
+    Region data as one list per field (`{"position": [...], "log_pvalue": [...], ...}`), rather than one object per
+        row. Requested with `?format=columns`, or by this media type in the Accept header.
+    """
+    media_type = 'application/vnd.locuszoom.columns+json'
+    format = 'columns'
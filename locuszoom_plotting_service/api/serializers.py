@@ -2,10 +2,14 @@
 Serialize data representing GWAS studies
 """
 import math
+import typing as ty
 
+import numpy as np
 from rest_framework import serializers as drf_serializers
+from zorp.parsers import BasicVariant
 
 from locuszoom_plotting_service.gwas import models as lz_models
+from util.ingest import columnar
 
 
 class GwasSerializer(drf_serializers.ModelSerializer):
@@ -48,14 +52,67 @@ class GwasFileSerializer(drf_serializers.Serializer):
     alt_allele_freq = drf_serializers.FloatField(read_only=True)
 
     def get_neg_log_pvalue(self, row):
-        """
-        Many GWAS programs suffer from underflow and may represent small p=0/-logp=inf
-
-        The JSON standard can't handle "Infinity", but the string 'Infinity' can be type-coerced by JS, eg +value
-        Therefore we serialize this as a special case so it can be used in the frontend
-        """
-        value = row.neg_log_pvalue
-        if value is not None and math.isinf(value):
-            return 'Infinity'
-        else:
-            return value
+        return _neg_log_pvalue(row.neg_log_pvalue)
+
+
+def _neg_log_pvalue(value: ty.Optional[float]) -> ty.Union[float, str, None]:
+    """
+    Many GWAS programs suffer from underflow and may represent small p=0/-logp=inf
+
+    The JSON standard can't handle "Infinity", but the string 'Infinity' can be type-coerced by JS, eg +value
+    Therefore we serialize this as a special case so it can be used in the frontend
+    """
+    if value is not None and math.isinf(value):
+        return 'Infinity'
+    else:
+        return value
+
+
+def _missing_as_none(values: np.ndarray) -> list:
+    # Missing values in the columnar store are NaN
+    if not np.isnan(values).any():
+        return values.tolist()
+    return [None if math.isnan(value) else value for value in values.tolist()]
+
+
+def gwas_columns_from_variants(variants: ty.Sequence[BasicVariant]) -> dict:
+    """
+    The same fields as `GwasFileSerializer`, as one list per field ("struct of arrays"), without the cost of a
+        serializer for each row
+    """
+    return {
+        'chromosome': [row.chrom for row in variants],
+        'position': [row.pos for row in variants],
+        'ref_allele': [row.ref for row in variants],
+        'alt_allele': [row.alt for row in variants],
+        'rsid': [row.rsid for row in variants],
+        'log_pvalue': [_neg_log_pvalue(row.neg_log_pvalue) for row in variants],
+        'variant': [row.marker for row in variants],
+        'beta': [row.beta for row in variants],
+        'se': [row.stderr_beta for row in variants],
+        'alt_allele_freq': [row.alt_allele_freq for row in variants],
+    }
+
+
+def gwas_columns_from_region(region: columnar.Region) -> dict:
+    """Same as `gwas_columns_from_variants`, built directly from the arrays of the columnar store"""
+    positions = region.pos.tolist()
+    refs = region.ref
+    alts = region.alt
+    neg_log_pvalues = region.neg_log_pvalue.tolist()
+    if np.isinf(region.neg_log_pvalue).any():
+        neg_log_pvalues = [_neg_log_pvalue(value) for value in neg_log_pvalues]
+    chrom = region.chrom
+    return {
+        'chromosome': [chrom] * len(positions),
+        'position': positions,
+        'ref_allele': refs,
+        'alt_allele': alts,
+        'rsid': region.rsid,
+        'log_pvalue': neg_log_pvalues,
+        'variant': [f'{chrom}:{pos}_{ref}/{alt}' if (ref and alt) else f'{chrom}:{pos}'
+                    for pos, ref, alt in zip(positions, refs, alts)],
+        'beta': _missing_as_none(region.beta),
+        'se': _missing_as_none(region.stderr_beta),
+        'alt_allele_freq': _missing_as_none(region.alt_allele_freq),
+    }
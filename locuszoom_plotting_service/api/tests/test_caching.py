@@ -0,0 +1,53 @@
+from django.core.cache import caches
+from django.test import SimpleTestCase
+
+from .. import caching
+
+
+class TestLRUByteCache(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        cache = caching.LRUByteCache(max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        self.assertEqual(cache.get('a'), b'1234')  # Now the most recently used
+        cache.set('c', b'1234')
+
+        self.assertIsNone(cache.get('b'), 'Oldest entry was evicted')
+        self.assertEqual(cache.get('a'), b'1234')
+        self.assertEqual(cache.get('c'), b'1234')
+        self.assertEqual(cache.size, 8)
+
+    def test_replaces_entry(self):
+        cache = caching.LRUByteCache(max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('a', b'12')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 2)
+
+    def test_ignores_values_larger_than_budget(self):
+        cache = caching.LRUByteCache(max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('b', b'12345678901')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1234', 'Other entries were kept')
+
+
+class TestRegionCache(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.cache = caching.RegionCache(max_bytes=100, timeout=60)
+
+    def test_counts_hits_in_each_tier(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.set('key', b'[]')
+        self.assertEqual(self.cache.get('key'), b'[]')
+
+        self.cache.local.clear()  # As seen by another web worker
+        self.assertEqual(self.cache.get('key'), b'[]')
+        self.assertEqual(self.cache.local.get('key'), b'[]', 'Entry copied from the shared cache')
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['shared_hits'], 1)
+        self.assertEqual(stats['local_bytes'], 2)
@@ -1,8 +1,18 @@
+import math
+import os
+import tempfile
 import unittest
 
 from zorp.parsers import BasicVariant
 
 from locuszoom_plotting_service.api import serializers
+from util.ingest import columnar
+
+VARIANTS = [
+    BasicVariant('1', 2, 'rs2', 'A', 'G', 1.5, 0.1, 0.01, 0.25),
+    BasicVariant('1', 3, None, None, None, math.inf, None, None, None),
+    BasicVariant('1', 4, 'rs4', 'C', 'T', 2.5, -0.2, 0.02, None),
+]
 
 
 class TestGwasFileSerializer(unittest.TestCase):
@@ -13,3 +23,24 @@ class TestGwasFileSerializer(unittest.TestCase):
         self.assertIsNone(ser['beta'], 'Handles missing beta')
         self.assertIsNone(ser['se'], 'Handles missing sebeta')
         self.assertIsNone(ser['alt_allele_freq'], 'Handles missing alt allele freq')
+
+
+class TestGwasColumns(unittest.TestCase):
+    def test_same_values_as_serializer(self):
+        rows = serializers.GwasFileSerializer(instance=VARIANTS, many=True).data
+        columns = serializers.gwas_columns_from_variants(VARIANTS)
+        self.assertEqual(set(columns), set(rows[0]))
+        for name, values in columns.items():
+            self.assertEqual(values, [row[name] for row in rows], f'Same values for {name}')
+        self.assertEqual(columns['log_pvalue'][1], 'Infinity', 'Handles pvalue underflow')
+
+    def test_same_values_from_columnar_store(self):
+        with tempfile.TemporaryDirectory() as folder:
+            writer = columnar.ColumnarWriter(os.path.join(folder, 'columns'))
+            for variant in VARIANTS:
+                writer(variant)
+            writer.finish()
+            writer.close()
+            region = columnar.ColumnarStore(os.path.join(folder, 'columns')).fetch('1', 0, 100)
+            self.assertEqual(serializers.gwas_columns_from_region(region),
+                             serializers.gwas_columns_from_variants(VARIANTS))
@@ -1,12 +1,26 @@
+import datetime
+import json
+import os
+import random
+import shutil
+import tempfile
+
+from django.core.cache import caches
+from django.test import override_settings
 from django.urls import reverse
 from rest_framework.test import APITestCase
+from zorp import parsers, sniffers
 
+from locuszoom_plotting_service.gwas import models as lz_models
 from locuszoom_plotting_service.gwas.tests.factories import (
     AnalysisFilesetFactory,
     AnalysisInfoFactory,
     UserFactory,
     ViewLinkFactory,
 )
+from util.ingest import processors
+
+from .. import caching
 
 
 class TestListview(APITestCase):
@@ -111,3 +125,180 @@ class TestDetailView(APITestCase):
                                    {'token': self.study_private_viewlink.code})
         print(response.content)
         self.assertEqual(response.status_code, 200)
+
+
+class TestIngestMetrics(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_admin = UserFactory(is_staff=True)
+        cls.user_other = UserFactory()
+
+        fileset = AnalysisFilesetFactory(has_completed=True)
+        for wall_time, rows in [(1.0, 1000), (3.0, 1000)]:
+            lz_models.IngestStageMetrics.objects.create(fileset=fileset, stage='normalize_gwas', succeeded=True,
+                                                        wall_time=wall_time, cpu_time=wall_time, rows=rows)
+        lz_models.IngestStageMetrics.objects.create(fileset=fileset, stage='normalize_gwas', succeeded=False,
+                                                    wall_time=100.0, cpu_time=100.0)
+
+    def test_requires_admin(self):
+        self.client.force_login(self.user_other)
+        response = self.client.get(reverse('apiv1:ingest-metrics'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_summarizes_each_stage(self):
+        self.client.force_login(self.user_admin)
+        response = self.client.get(reverse('apiv1:ingest-metrics'))
+        self.assertEqual(response.status_code, 200)
+        stage, = response.json()['data']
+        self.assertEqual(stage['runs'], 3)
+        self.assertEqual(stage['failed'], 1)
+        self.assertEqual(stage['mean_wall_time'], 2.0, 'Failed runs are not included in timings')
+        self.assertEqual(stage['rows_per_second'], 500.0)
+
+
+def _make_rows(num_rows: int, seed: int) -> list:
+    rand = random.Random(seed)
+    lines = ['#chrom\tpos\tref\talt\tpvalue\n']
+    for pos in range(1_000, 1_000 + 100 * num_rows, 100):
+        lines.append(f'1\t{pos}\tA\tG\t{rand.random():.6g}\n')
+    return lines
+
+
+class TestRegionView(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        caching.region_cache.local.clear()
+        caches['default'].clear()
+        caching.columnar_stores.clear()
+
+        self.study = AnalysisInfoFactory(is_public=True, build='GRCh37',
+                                         files=AnalysisFilesetFactory(has_completed=True))
+        self._ingest(_make_rows(5_000, seed=1))
+        self.url = reverse('apiv1:gwas-region', args=[self.study.slug])
+        self.region = {'chrom': '1', 'start': 1_000, 'end': 400_000}
+
+    def _ingest(self, lines: list, *, columnar: bool = True):
+        """Write the normalized file (and optionally the columnar store), as the ingest pipeline would"""
+        files = self.study.files
+        os.makedirs(os.path.dirname(files.normalized_gwas_path), exist_ok=True)
+        parser = parsers.GenericGwasLineParser(chrom_col=1, pos_col=2, ref_col=3, alt_col=4, pvalue_col=5)
+        reader = sniffers.guess_gwas_generic(lines, parser=parser, skip_errors=True)
+        processors.validate_and_normalize(reader, files.normalized_gwas_path, 'GRCh37', debug_mode=True,
+                                          columnar_path=files.columnar_path if columnar else None)
+        if not columnar:
+            shutil.rmtree(files.columnar_path, ignore_errors=True)
+
+    def _get(self, **params) -> list:
+        response = self.client.get(self.url, {**self.region, **params})
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            return json.loads(b''.join(response.streaming_content))
+        return response.json()
+
+    def _count_change(self, before: dict) -> dict:
+        after = caching.region_cache.stats()
+        return {name: after[name] - before[name] for name in ('local_hits', 'shared_hits', 'misses')}
+
+    def test_repeated_request_served_from_memory(self):
+        before = caching.region_cache.stats()
+        expected = self._get()
+        self.assertEqual(len(expected), 3_990)
+        self.assertEqual(self._get(), expected)
+        self.assertEqual(self._count_change(before), {'local_hits': 1, 'shared_hits': 0, 'misses': 1})
+
+    def test_other_worker_served_from_shared_cache(self):
+        expected = self._get()
+        caching.region_cache.local.clear()  # As seen by another web worker
+
+        before = caching.region_cache.stats()
+        self.assertEqual(self._get(), expected)
+        self.assertEqual(self._count_change(before), {'local_hits': 0, 'shared_hits': 1, 'misses': 0})
+        self.assertEqual(self._get(), expected, 'Copied to the local cache')
+        self.assertEqual(self._count_change(before), {'local_hits': 1, 'shared_hits': 1, 'misses': 0})
+
+    def test_columnar_store_stays_open(self):
+        self._get()
+        store = caching.columnar_stores.get(self.study.files.columnar_path)
+        self.assertIsNotNone(store)
+
+        self.region = {'chrom': '1', 'start': 2_000, 'end': 300_000}  # Not in the cache
+        self._get()
+        self.assertIs(caching.columnar_stores.get(self.study.files.columnar_path), store,
+                      'Same store used for the next query')
+
+    def test_reingested_study_is_not_stale(self):
+        old = self._get()
+
+        # A new upload of the study replaces the data, and records when it finished
+        self._ingest(_make_rows(5_000, seed=2))
+        files = self.study.files
+        files.ingest_complete = files.ingest_complete + datetime.timedelta(minutes=1)
+        files.save()
+
+        new = self._get()
+        self.assertEqual(len(new), len(old))
+        self.assertNotEqual(new, old, 'New data is returned, not the cached response')
+        reader = sniffers.guess_gwas_standard(files.normalized_gwas_path)
+        self.assertEqual([row['log_pvalue'] for row in new],
+                         [row.neg_log_pvalue for row in reader.fetch('1', self.region['start'], self.region['end'])])
+
+    def test_columns_have_same_values_as_rows(self):
+        for columnar in (True, False):
+            with self.subTest(columnar=columnar):
+                self._ingest(_make_rows(500, seed=3), columnar=columnar)
+                caching.region_cache.local.clear()
+                caches['default'].clear()
+
+                rows = self._get()
+                response = self.client.get(self.url, {**self.region, 'format': 'columns'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], 'application/vnd.locuszoom.columns+json')
+                columns = response.json()
+
+                self.assertEqual(set(columns), set(rows[0]), 'One list per field')
+                self.assertEqual(len(rows), 499, 'Region starts after the first row')
+                for field, values in columns.items():
+                    self.assertEqual(values, [row[field] for row in rows], f'Same values for {field}')
+
+    def test_streamed_response_matches_single_response(self):
+        for columnar in (True, False):
+            with self.subTest(columnar=columnar):
+                self._ingest(_make_rows(5_000, seed=4), columnar=columnar)
+                caching.region_cache.local.clear()
+                caches['default'].clear()
+
+                expected = self.client.get(self.url, self.region)
+                self.assertFalse(expected.streaming, 'Region is smaller than the default threshold')
+
+                caching.region_cache.local.clear()
+                caches['default'].clear()
+                with override_settings(LZ_REGION_STREAM_MIN_SIZE=1):
+                    response = self.client.get(self.url, self.region)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.streaming)
+                body = b''.join(response.streaming_content)
+                self.assertEqual(json.loads(body), expected.json())
+                self.assertEqual(body, expected.content, 'Same bytes as rendering the whole list at once')
+
+                key = caching.region_cache.make_key(self.study.files, '1', self.region['start'],
+                                                    self.region['end'], layout='json')
+                self.assertEqual(caching.region_cache.get(key), body, 'Complete response was cached')
+
+    def test_streamed_response_larger_than_cache_is_not_cached(self):
+        expected = self.client.get(self.url, self.region).content
+        caching.region_cache.local.clear()
+        caches['default'].clear()
+        caching.columnar_stores.clear()
+
+        with override_settings(LZ_REGION_STREAM_MIN_SIZE=1, LZ_REGION_CACHE_BYTES=len(expected) - 1):
+            response = self.client.get(self.url, self.region)
+            self.assertEqual(b''.join(response.streaming_content), expected, 'Whole response is still sent')
+
+        key = caching.region_cache.make_key(self.study.files, '1', self.region['start'], self.region['end'],
+                                            layout='json')
+        self.assertIsNone(caching.region_cache.get(key), 'Too large to cache')
@@ -16,6 +16,8 @@ urlpatterns = [
     path('gwas/user-all/', views.GwasListViewUnprocessed.as_view(), name='gwas-user-all'),
     path('gwas/<slug>/', views.GwasDetailView.as_view(), name='gwas-metadata'),
     path('gwas/<slug>/data/', views.GwasRegionView.as_view(), name='gwas-region'),
+    path('ingest-metrics/', views.IngestMetricsView.as_view(), name='ingest-metrics'),
+    path('region-cache-metrics/', views.RegionCacheMetricsView.as_view(), name='region-cache-metrics'),
     # "Standardized" api schema; can be used to auto-create api clients.
     path('schema/', schema_view)
 ]
@@ -1,19 +1,29 @@
+import datetime
+import itertools
 import os
 import typing as ty
 
 from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import exceptions as drf_exceptions
 from rest_framework import permissions as drf_permissions
 from rest_framework import generics
 from rest_framework import renderers as drf_renderers
+from rest_framework import views as drf_views
+from rest_framework.response import Response
 
 from locuszoom_plotting_service.api.filters import GwasFilter
 from locuszoom_plotting_service.gwas import models as lz_models
+from util.ingest import columnar, validators
 
+from zorp.parsers import BasicVariant
 from zorp.sniffers import guess_gwas_standard
 
 from . import (
+    caching,
     permissions,
+    renderers,
     serializers
 )
 
@@ -67,14 +77,40 @@ class GwasDetailView(generics.RetrieveAPIView):
     lookup_field = 'slug'
 
 
+# Rows rendered at a time, when a region API response is streamed
+STREAM_CHUNK_ROWS = 2_000
+
+
+class _TabixRegionLines:
+    """
+    The header and the rows of one (non-empty) region of a tabix-indexed file, as lines of text
+
+    The reader iterates twice: first to find the columns (which stops at the first row), and then over every line.
+        Rows after the first are only read once, by the second pass.
+    """
+    def __init__(self, header: ty.List[str], first_row: str, rows: ty.Iterator[str]):
+        self._header = header
+        self._first_row = first_row
+        self._rows = rows
+
+    def __iter__(self) -> ty.Iterator[str]:
+        yield from self._header
+        yield self._first_row
+        yield from self._rows
+
+
 class GwasRegionView(generics.RetrieveAPIView):
     """
     Fetch the parsed GWAS data (such as from a file) for a specific region
 
     This is not a JSONAPI endpoint and it does not draw from a database. Therefore, it is intentionally allowed to use
         a different (more concise) format and disables default query param validation/ filtering behavior
+
+    By default, the response is a list of rows. Large regions are much faster to render as one list per field
+        (`?format=columns`; see `renderers.GwasColumnsRenderer`). Rows for large regions are sent as they are read
+        (see `LZ_REGION_STREAM_MIN_SIZE`), so that the client starts to receive data sooner.
     """
-    renderer_classes = [drf_renderers.JSONRenderer]
+    renderer_classes = [drf_renderers.JSONRenderer, renderers.GwasColumnsRenderer]
     filter_backends: list = []
     queryset = lz_models.AnalysisInfo.objects.ingested()
     serializer_class = serializers.GwasFileSerializer
@@ -86,24 +122,109 @@ class GwasRegionView(generics.RetrieveAPIView):
         """Unique scenario: a single model that returns a list of records"""
         return super(GwasRegionView, self).get_serializer(*args, many=True, **kwargs)
 
-    def get_object(self):
-        gwas = super(GwasRegionView, self).get_object()  # External-facing GWAS id given as slug in url
+    def retrieve(self, request, *args, **kwargs):
+        gwas = self.get_object()  # External-facing GWAS id given as slug in url
         chrom, start, end = self._query_params()
 
         if not os.path.isfile(gwas.files.normalized_gwas_path):
             raise drf_exceptions.NotFound
 
-        # We deliberately exclude missing pvalues because this endpoint is primarily aimed at association plots
-        reader = guess_gwas_standard(gwas.files.normalized_gwas_path)\
-            .add_filter('neg_log_pvalue')
+        # Responses for chromosomes that can never be in a file are not worth caching (and the key would be arbitrary
+        #   user input)
+        renderer = request.accepted_renderer
+        use_cache = chrom in validators.ALLOWED_CHROMS
+        key = caching.region_cache.make_key(gwas.files, chrom, start, end, layout=renderer.format)
+        payload = caching.region_cache.get(key) if use_cache else None
+        if payload is not None:
+            return HttpResponse(payload, content_type=renderer.media_type)
+
+        region = self._fetch_region(gwas.files, chrom, start, end)
+        if renderer.format == renderers.GwasColumnsRenderer.format:
+            # Built directly from the data, rather than with a serializer for each row
+            if isinstance(region, columnar.Region):
+                data = serializers.gwas_columns_from_region(region)
+            else:
+                data = serializers.gwas_columns_from_variants(list(region))
+        else:
+            rows = region.variants() if isinstance(region, columnar.Region) else region
+            if end - start >= settings.LZ_REGION_STREAM_MIN_SIZE:
+                return StreamingHttpResponse(self._stream_rows(rows, renderer, key if use_cache else None),
+                                             content_type=renderer.media_type)
+            data = self.get_serializer(list(rows)).data
+
+        payload = renderer.render(data)
+        if use_cache:
+            caching.region_cache.set(key, payload)
+        return HttpResponse(payload, content_type=renderer.media_type)
+
+    def _fetch_region(self, files: lz_models.AnalysisFileset, chrom: str, start: int, end: int) \
+            -> ty.Union[columnar.Region, ty.Iterator[BasicVariant]]:
+        """
+        The rows of a region: from the columnar store if the study has one, or else an iterator that reads the
+            tabix-indexed file
+        """
+        store = caching.columnar_stores.get(files.columnar_path)
+        if store is not None:
+            # Same rows as the tabix query below, without parsing text (older uploads may not have this copy)
+            return store.fetch(chrom, start, end)
+        return self._read_tabix(files.normalized_gwas_path, chrom, start, end)
+
+    def _read_tabix(self, path: str, chrom: str, start: int, end: int) -> ty.Iterator[BasicVariant]:
+        """
+        Parse rows as they are read. The file (and its index) stay open for later requests: it is returned to the pool
+            when the iterator is exhausted or closed.
+        """
+        with caching.tabix_pool.open(path) as tabix:
+            if chrom not in tabix.contigs:
+                # PySAM will throw a ValueError when tabixing to a chrom not present in the file (but it's ok with an
+                #   empty region in a known chromosome)
+                # Let's make the behavior the same: no known chromosome = no data for region
+                return
+            rows = tabix.fetch(chrom, start, end)
+            first_row = next(rows, None)
+            if first_row is None:
+                return
+            # We deliberately exclude missing pvalues because this endpoint is primarily aimed at association plots
+            reader = guess_gwas_standard(_TabixRegionLines(list(tabix.header), first_row, rows))\
+                .add_filter('neg_log_pvalue')
+            yield from reader
+
+    def _stream_rows(self, rows: ty.Iterator[BasicVariant], renderer: drf_renderers.BaseRenderer,
+                     cache_key: ty.Optional[str]) -> ty.Iterator[bytes]:
+        """
+        Render rows as a JSON list, one chunk at a time (the same bytes as rendering the whole list at once).
 
+        Rows are only read as the response is sent. If the client disconnects, the server stops iterating and closes
+            this generator, which closes `rows` (and so stops reading the file). Complete responses are cached, unless
+            they are larger than `LZ_REGION_CACHE_BYTES`: the parts of those are not kept in memory.
+        """
+        parts = [b'['] if cache_key else None  # type: ty.Optional[ty.List[bytes]]
+        size = 2
+        is_first = True
+        yield b'['
         try:
-            return list(reader.fetch(chrom, start, end))
-        except ValueError:
-            # PySAM will throw a ValueError when tabixing to a chrom not present in the file (but it's ok with an
-            #   empty region in a known chromosome)
-            # Let's make the behavior the same: no known chromosome = no data for region
-            return []
+            while True:
+                chunk = list(itertools.islice(rows, STREAM_CHUNK_ROWS))
+                if not chunk:
+                    break
+                # Render a list, and keep the items
+                part = renderer.render(self.get_serializer(chunk).data)[1:-1]
+                if not is_first:
+                    part = b',' + part
+                is_first = False
+                if parts is not None:
+                    size += len(part)
+                    if size > settings.LZ_REGION_CACHE_BYTES:
+                        parts = None
+                    else:
+                        parts.append(part)
+                yield part
+        finally:
+            rows.close()
+        yield b']'
+        if parts is not None:
+            parts.append(b']')
+            caching.region_cache.set(cache_key, b''.join(parts))
 
     def _query_params(self) -> ty.Tuple[str, int, int]:
         """
@@ -136,3 +257,39 @@ class GwasRegionView(generics.RetrieveAPIView):
                 f'Cannot handle requested region size. Max allowed is {settings.LZ_MAX_REGION_SIZE}')
 
         return chrom, start, end
+
+
+class IngestMetricsView(drf_views.APIView):
+    """
+    Resources used by each step of the ingest pipeline, summarized across all studies. Optionally, only consider
+        uploads from the last N days (`?days=N`).
+    """
+    schema = None  # This is a private endpoint for internal use; hide from documentation
+
+    renderer_classes = [drf_renderers.JSONRenderer]
+    permission_classes = (drf_permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        queryset = lz_models.IngestStageMetrics.objects.all()
+        days = request.query_params.get('days', None)
+        if days is not None:
+            try:
+                days = int(days)
+            except ValueError:
+                raise drf_exceptions.ParseError('"days" must be an integer')
+            queryset = queryset.filter(created__gte=timezone.now() - datetime.timedelta(days=days))
+        return Response({'data': list(queryset.summarize_by_stage())})
+
+
+class RegionCacheMetricsView(drf_views.APIView):
+    """
+    Hits and misses of the region API response cache, in the web process that handles this request (see
+        `api.caching`)
+    """
+    schema = None  # This is a private endpoint for internal use; hide from documentation
+
+    renderer_classes = [drf_renderers.JSONRenderer]
+    permission_classes = (drf_permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response({'data': caching.region_cache.stats()})
@@ -5,7 +5,7 @@ from django.contrib import admin
 
 from allauth.socialaccount.models import SocialToken
 
-from .models import AnalysisInfo
+from .models import AnalysisInfo, IngestStageMetrics
 
 
 # Certain other apps in the site register models that we don't want exposed to a public admin UI. For example,
@@ -44,3 +44,33 @@ class AnalysisInfoAdmin(admin.ModelAdmin):
 
 
 admin.site.register(AnalysisInfo, AnalysisInfoAdmin)
+
+
+class IngestStageMetricsAdmin(admin.ModelAdmin):
+    """Resources used by each step of the ingest pipeline. The list page also summarizes each step across studies."""
+    change_list_template = 'admin/gwas/ingeststagemetrics/change_list.html'
+
+    list_display = ['created', 'fileset', 'stage', 'succeeded', 'skipped', 'wall_time', 'cpu_time', 'rows',
+                    'rows_per_second', 'peak_rss']
+    list_filter = ['stage', 'succeeded', 'skipped']
+    ordering = ['-created']
+
+    def changelist_view(self, request, extra_context=None):
+        response = super(IngestStageMetricsAdmin, self).changelist_view(request, extra_context=extra_context)
+        try:
+            # Summarize the records that match the current filters
+            queryset = response.context_data['cl'].queryset
+        except (AttributeError, KeyError):
+            # Eg a redirect
+            return response
+        response.context_data['summary'] = queryset.summarize_by_stage()
+        return response
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(IngestStageMetrics, IngestStageMetricsAdmin)
@@ -1,5 +1,7 @@
 from django import forms
 
+from util.ingest import exceptions, validators
+
 from . import models
 
 
@@ -14,6 +16,24 @@ class AnalysisFilesetForm(forms.ModelForm):
         model = models.AnalysisFileset
         fields = ('parser_options', 'raw_gwas_file')
 
+    def clean_raw_gwas_file(self):
+        """
+        Reject files of the wrong type before they are stored. If the file was hashed as it was uploaded (see
+            `uploads`), keep the hash, so that the ingest pipeline does not need to read the file again.
+        """
+        upload = self.cleaned_data['raw_gwas_file']
+        content_type = getattr(upload, 'sniffed_content_type', None)
+        if content_type is not None:
+            try:
+                validators.standard_gwas_validator.validate_mimetype(content_type)
+            except exceptions.ValidationException as e:
+                raise forms.ValidationError(str(e))
+
+        sha256 = getattr(upload, 'sha256', None)
+        if sha256 is not None:
+            self.instance.file_sha256 = sha256
+        return upload
+
 
 class ViewLinkForm(forms.ModelForm):
     class Meta:
@@ -1,4 +1,6 @@
 """Querysets and managers that mediate interaction between the model and the database"""
+from django.db import models
+from django.db.models import functions
 from model_utils.managers import SoftDeletableQuerySet
 
 
@@ -22,3 +24,33 @@ class AnalysisInfoQuerySet(SoftDeletableQuerySet):
 
 
 AnalysisInfoManager = AnalysisInfoQuerySet.as_manager()
+
+
+class IngestStageMetricsQuerySet(models.QuerySet):
+    def summarize_by_stage(self):
+        """
+        Resources used by each step of the ingest pipeline, across all studies. Timings only consider steps that did
+            work and succeeded (skipped or failed steps are counted separately).
+        """
+        completed = models.Q(succeeded=True, skipped=False)
+        return self.values('stage').annotate(
+            runs=models.Count('id'),
+            failed=models.Count('id', filter=models.Q(succeeded=False)),
+            skipped=models.Count('id', filter=models.Q(skipped=True)),
+            mean_wall_time=models.Avg('wall_time', filter=completed),
+            max_wall_time=models.Max('wall_time', filter=completed),
+            mean_cpu_time=models.Avg('cpu_time', filter=completed),
+            total_rows=models.Sum('rows', filter=completed),
+            # Overall throughput, so that large studies count for more than small ones
+            rows_per_second=models.ExpressionWrapper(
+                models.Sum('rows', filter=completed) /
+                functions.NullIf(models.Sum('wall_time', filter=completed), 0),
+                output_field=models.FloatField()),
+            total_bytes_read=models.Sum('bytes_read', filter=completed),
+            total_bytes_written=models.Sum('bytes_written', filter=completed),
+            mean_peak_rss=models.Avg('peak_rss', filter=completed),
+            max_peak_rss=models.Max('peak_rss', filter=completed),
+        ).order_by('stage')
+
+
+IngestStageMetricsManager = IngestStageMetricsQuerySet.as_manager()
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.10 on 2026-10-18 20:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import locuszoom_plotting_service.gwas.models
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gwas', '0006_auto_20200214_1919'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedArtifacts',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('fingerprint', models.CharField(help_text='Identifies the raw file and all options that determine the outputs', max_length=64, unique=True)),
+                ('pipeline_path', models.CharField(default=locuszoom_plotting_service.gwas.models._pipeline_folder, help_text='Internal use only: path to folder of ingested data. Value auto-set.', max_length=32)),
+                ('ingest_status', models.IntegerField(choices=[(0, 'PENDING'), (1, 'FAILED'), (2, 'SUCCESS')], default=0, help_text='Whether the files are ready to use')),
+                ('processing_fileset', models.ForeignKey(help_text='The upload that is writing the files, if any', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='gwas.AnalysisFileset')),
+            ],
+            options={
+                'verbose_name_plural': 'Shared artifacts',
+            },
+        ),
+        migrations.AddField(
+            model_name='analysisfileset',
+            name='artifacts',
+            field=models.ForeignKey(help_text='Ingested data, which may be shared with identical uploads', null=True, on_delete=django.db.models.deletion.SET_NULL, to='gwas.SharedArtifacts'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.0.10 on 2026-10-18 20:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gwas', '0007_sharedartifacts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestStageMetrics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('stage', models.CharField(db_index=True, help_text='The name of the pipeline step', max_length=50)),
+                ('succeeded', models.BooleanField()),
+                ('skipped', models.BooleanField(default=False, help_text='The step had nothing to do (eg outputs were up to date)')),
+                ('wall_time', models.FloatField(help_text='Elapsed time (s)')),
+                ('cpu_time', models.FloatField(help_text='CPU time, including any child processes (s)')),
+                ('rows', models.BigIntegerField(help_text='Number of variants processed', null=True)),
+                ('rows_per_second', models.FloatField(null=True)),
+                ('bytes_read', models.BigIntegerField(help_text='Size of the files read by this step', null=True)),
+                ('bytes_written', models.BigIntegerField(help_text='Size of the files written by this step', null=True)),
+                ('peak_rss', models.BigIntegerField(help_text='Peak memory use of the worker process (bytes)', null=True)),
+                ('fileset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stage_metrics', to='gwas.AnalysisFileset')),
+            ],
+            options={
+                'verbose_name_plural': 'Ingest stage metrics',
+            },
+        ),
+    ]
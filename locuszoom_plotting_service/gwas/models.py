@@ -1,5 +1,9 @@
+import hashlib
+import json
 import logging
 import os
+import shutil
+import typing as ty
 import uuid
 
 from django.contrib.auth import get_user_model
@@ -171,31 +175,170 @@ class AnalysisFileset(TimeStampedModel):
     ingest_complete = models.DateTimeField(null=True,
                                            help_text='When the file finished processing (success OR failure)')
 
+    artifacts = models.ForeignKey('gwas.SharedArtifacts',
+                                  on_delete=models.SET_NULL,
+                                  null=True,
+                                  help_text='Ingested data, which may be shared with identical uploads')
+
     #######
     # Helpers defining where to find/ store each asset
+    def _artifacts_folder(self) -> str:
+        """
+        Most files written by the ingest pipeline are shared by all uploads of the same file (with the same options).
+            Uploads ingested before sharing existed keep everything in their own folder.
+        """
+        if self.artifacts is not None:
+            return util.get_shared_folder(self.artifacts, absolute_path=True)
+        return util.get_study_folder(self, absolute_path=True)
+
     @property
     def normalized_gwas_path(self):
         """Path to the normalized, tabix-indexed GWAS file"""
-        return os.path.join(util.get_study_folder(self, absolute_path=True), 'normalized.txt.gz')
+        return os.path.join(self._artifacts_folder(), 'normalized.txt.gz')
+
+    @property
+    def columnar_path(self):
+        """Folder with a columnar copy of the normalized file, which is faster to read for region queries"""
+        return os.path.join(self._artifacts_folder(), 'columns')
 
     @property
     def normalized_gwas_log_path(self):
         """Path to the normalized, tabix-indexed GWAS file"""
+        # Each upload has its own log, even if the data is shared
         return os.path.join(util.get_study_folder(self, absolute_path=True), 'normalized.log')
 
+    @property
+    def ingest_stats_path(self):
+        """Stats gathered while normalizing the file, which help later steps summarize the data in a single pass"""
+        return os.path.join(self._artifacts_folder(), 'ingest_stats.json')
+
     @property
     def manhattan_path(self):
         # PheWeb pipeline writes a JSON file that is used in entirety by frontend
-        return os.path.join(util.get_study_folder(self, absolute_path=True), 'manhattan.json')
+        return os.path.join(self._artifacts_folder(), 'manhattan.json')
 
     @property
     def qq_path(self):
-        return os.path.join(util.get_study_folder(self, absolute_path=True), 'qq.json')
+        return os.path.join(self._artifacts_folder(), 'qq.json')
+
+    @property
+    def top_hit_path(self):
+        """The strongest variant in the study, from which each study that shares this data creates its top hit view"""
+        return os.path.join(self._artifacts_folder(), 'top_hit.json')
+
+    def stage_manifest_path(self, stage: str) -> str:
+        """Record of the inputs and outputs of one stage of the ingest pipeline (see `util.ingest.manifests`)"""
+        return os.path.join(self._artifacts_folder(), f'{stage}.manifest.json')
 
     @property
     def tophits_path(self):
         # PheWeb pipeline writes a tabixed file that supports region queries # TODO: Implement
-        return os.path.join(util.get_study_folder(self, absolute_path=True), 'tophits.gz')
+        return os.path.join(self._artifacts_folder(), 'tophits.gz')
+
+    def release_artifacts(self):
+        """
+        Stop using the ingested data (eg when the study is deleted). Shared data is deleted along with the last upload
+            that uses it.
+        """
+        if self.artifacts_id is None:
+            return
+        with transaction.atomic():
+            # Lock the record, so that an identical upload cannot start using the data as it is being deleted
+            artifacts = SharedArtifacts.objects.select_for_update().get(pk=self.artifacts_id)
+            self.artifacts = None
+            self.save(update_fields=['artifacts'])
+            if artifacts.ingest_status == 0 and artifacts.processing_fileset_id is not None:
+                # Files are still being written. Whatever finishes the pipeline will clean up (see `finish`).
+                return
+            artifacts.delete_if_unused()
+
+
+class SharedArtifacts(TimeStampedModel):
+    """
+    The files written by the ingest pipeline (normalized file, tabix index, and summaries) for one raw file, ingested
+        with one set of options. Several uploads of the same file can use the same data, rather than each repeating the
+        same (slow) work. The data is deleted when no upload uses it.
+
+    While the files are being written, other uploads that need them wait for the upload that is doing the work
+        (`processing_fileset`), and are resumed when it finishes.
+    """
+    class Meta:
+        verbose_name_plural = 'Shared artifacts'
+
+    fingerprint = models.CharField(max_length=64, unique=True,
+                                   help_text='Identifies the raw file and all options that determine the outputs')
+    pipeline_path = models.CharField(max_length=32,
+                                     default=_pipeline_folder,
+                                     help_text='Internal use only: path to folder of ingested data. Value auto-set.')
+    ingest_status = models.IntegerField(choices=constants.INGEST_STATES, default=0,
+                                        help_text='Whether the files are ready to use')
+    processing_fileset = models.ForeignKey(AnalysisFileset,
+                                           related_name='+',
+                                           on_delete=models.SET_NULL,
+                                           null=True,
+                                           help_text='The upload that is writing the files, if any')
+
+    @staticmethod
+    def get_fingerprint(fileset: AnalysisFileset) -> str:
+        """Uploads with the same fingerprint would produce the same files"""
+        contents = json.dumps({
+            'raw_sha256': bytes(fileset.file_sha256).hex(),
+            'parser_options': fileset.parser_options,
+            'build': fileset.metadata.build,
+        }, sort_keys=True)
+        return hashlib.sha256(contents.encode('utf8')).hexdigest()
+
+    def finish(self, status: int) -> ty.List[int]:
+        """
+        Record that the processing upload has finished (success or failure). Must be called inside a transaction,
+            on a locked record.
+
+        :return: The IDs of other uploads waiting to use these files, which should now be resumed
+        """
+        waiting = list(self.analysisfileset_set.filter(ingest_status=0)
+                       .exclude(pk=self.processing_fileset_id)
+                       .values_list('pk', flat=True))
+        self.ingest_status = status
+        self.processing_fileset = None
+        self.save()
+        self.delete_if_unused()
+        return waiting
+
+    def delete_if_unused(self):
+        """Delete the files (and this record) if no upload uses them"""
+        if self.analysisfileset_set.exists():
+            return
+        target_path = util.get_shared_folder(self, absolute_path=True)
+        logger.info('Deleting shared data that is no longer used: {}'.format(target_path))
+        if os.path.isdir(target_path):
+            shutil.rmtree(target_path)
+        self.delete()
+
+
+class IngestStageMetrics(TimeStampedModel):
+    """
+    Resources used by one step of the ingest pipeline, for one upload (see `util.ingest.metrics`). Each run of a step
+        (including reruns) adds a new record.
+    """
+    objects = managers.IngestStageMetricsManager
+
+    class Meta:
+        verbose_name_plural = 'Ingest stage metrics'
+
+    fileset = models.ForeignKey(AnalysisFileset,
+                                related_name='stage_metrics',
+                                on_delete=models.CASCADE)
+    stage = models.CharField(max_length=50, db_index=True, help_text='The name of the pipeline step')
+    succeeded = models.BooleanField()
+    skipped = models.BooleanField(default=False, help_text='The step had nothing to do (eg outputs were up to date)')
+
+    wall_time = models.FloatField(help_text='Elapsed time (s)')
+    cpu_time = models.FloatField(help_text='CPU time, including any child processes (s)')
+    rows = models.BigIntegerField(null=True, help_text='Number of variants processed')
+    rows_per_second = models.FloatField(null=True)
+    bytes_read = models.BigIntegerField(null=True, help_text='Size of the files read by this step')
+    bytes_written = models.BigIntegerField(null=True, help_text='Size of the files written by this step')
+    peak_rss = models.BigIntegerField(null=True, help_text='Peak memory use of the worker process (bytes)')
 
 
 class OntologyTerm(models.Model):
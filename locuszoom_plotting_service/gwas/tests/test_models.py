@@ -0,0 +1,35 @@
+from django.test import TestCase
+
+from .. import models as lz_models
+from .factories import AnalysisFilesetFactory, AnalysisInfoFactory
+
+
+class TestSharedArtifacts(TestCase):
+    def test_identical_uploads_have_the_same_fingerprint(self):
+        first = AnalysisFilesetFactory(metadata=AnalysisInfoFactory(build='GRCh37'), file_sha256=b'\x01' * 32)
+        second = AnalysisFilesetFactory(metadata=AnalysisInfoFactory(build='GRCh37'), file_sha256=b'\x01' * 32)
+
+        self.assertEqual(lz_models.SharedArtifacts.get_fingerprint(first),
+                         lz_models.SharedArtifacts.get_fingerprint(second))
+
+        second.parser_options = {**second.parser_options, 'is_neg_log_pvalue': True}
+        self.assertNotEqual(lz_models.SharedArtifacts.get_fingerprint(first),
+                            lz_models.SharedArtifacts.get_fingerprint(second),
+                            'Parser options change the outputs')
+
+    def test_data_is_deleted_with_the_last_upload_that_uses_it(self):
+        artifacts = lz_models.SharedArtifacts.objects.create(fingerprint='a' * 64, ingest_status=2)
+        first = AnalysisInfoFactory().files
+        second = AnalysisInfoFactory().files
+        for fileset in (first, second):
+            fileset.artifacts = artifacts
+            fileset.save()
+
+        first.release_artifacts()
+        self.assertTrue(lz_models.SharedArtifacts.objects.filter(pk=artifacts.pk).exists(),
+                        'Data is still used by another study')
+        self.assertIn('shared', second.normalized_gwas_path, 'Shared data is stored separately from the study')
+
+        second.release_artifacts()
+        self.assertFalse(lz_models.SharedArtifacts.objects.filter(pk=artifacts.pk).exists(),
+                         'Data is deleted when no study uses it')
@@ -0,0 +1,62 @@
+import gzip
+import hashlib
+import json
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.test import SimpleTestCase
+
+from .. import forms as lz_forms
+from .. import uploads
+
+PARSER_OPTIONS = {'chrom_col': 1, 'pos_col': 2, 'ref_col': 3, 'alt_col': 4, 'pvalue_col': 5}
+
+
+def _upload(handler, contents: bytes, chunk_size: int = 10):
+    try:
+        handler.new_file('raw_gwas_file', 'gwas.txt', 'text/plain', len(contents))
+    except StopFutureHandlers:
+        # A handler that keeps the file in memory stops later handlers from storing it
+        pass
+    for start in range(0, len(contents), chunk_size):
+        handler.receive_data_chunk(contents[start:start + chunk_size], start)
+    return handler.file_complete(len(contents))
+
+
+class TestHashingUploadHandlers(SimpleTestCase):
+    def test_hashes_file_written_to_disk(self):
+        contents = gzip.compress(b'#chrom\tpos\tref\talt\tpvalue\n1\t100\tA\tC\t0.5\n')
+        upload = _upload(uploads.HashingTemporaryFileUploadHandler(), contents)
+
+        self.assertEqual(upload.sha256, hashlib.sha256(contents).digest())
+        self.assertIn(upload.sniffed_content_type, ['application/gzip', 'application/x-gzip'])
+        upload.seek(0)
+        self.assertEqual(upload.read(), contents, 'File was stored as usual')
+
+    def test_hashes_file_kept_in_memory(self):
+        contents = b'#chrom\tpos\tref\talt\tpvalue\n1\t100\tA\tC\t0.5\n'
+        handler = uploads.HashingMemoryFileUploadHandler()
+        handler.handle_raw_input(None, {}, len(contents), 'boundary')
+        upload = _upload(handler, contents)
+
+        self.assertEqual(upload.sha256, hashlib.sha256(contents).digest())
+        self.assertTrue(upload.sniffed_content_type.startswith('text/'))
+
+
+class TestAnalysisFilesetForm(SimpleTestCase):
+    def _make_form(self, content_type):
+        upload = SimpleUploadedFile('gwas.txt', b'contents')
+        upload.sha256 = b'\x01' * 32
+        upload.sniffed_content_type = content_type
+        return lz_forms.AnalysisFilesetForm(data={'parser_options': json.dumps(PARSER_OPTIONS)},
+                                            files={'raw_gwas_file': upload})
+
+    def test_keeps_hash_from_upload(self):
+        form = self._make_form('text/plain')
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.instance.file_sha256, b'\x01' * 32)
+
+    def test_rejects_wrong_file_type(self):
+        form = self._make_form('application/pdf')
+        self.assertFalse(form.is_valid())
+        self.assertIn('Only plaintext or gzipped files are accepted', str(form.errors['raw_gwas_file']))
@@ -0,0 +1,47 @@
+"""
+File upload handlers that inspect GWAS files while they are being received
+
+Django writes each upload to disk (or memory) in chunks. These handlers also hash each chunk, and sniff the file type
+    from the first chunk, so that the ingest pipeline does not need to read the stored file again just to hash it.
+"""
+import hashlib
+
+import magic
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class _HashingMixin:
+    """
+    Add `sha256` (digest bytes) and `sniffed_content_type` to each uploaded file, computed from the chunks that this
+        handler stores. (the content type sent by the browser is based on the file name, and can't be trusted)
+    """
+    def new_file(self, *args, **kwargs):
+        self._sha256 = hashlib.sha256()
+        self._sniffed_content_type = None
+        self._num_bytes = 0
+        return super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        result = super().receive_data_chunk(raw_data, start)
+        if result is None:
+            # This handler stored the chunk (otherwise, the chunk is passed to the next handler, which hashes it)
+            if start == 0:
+                self._sniffed_content_type = magic.from_buffer(raw_data, mime=True)
+            self._sha256.update(raw_data)
+            self._num_bytes += len(raw_data)
+        return result
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None and self._num_bytes == file_size:
+            file.sha256 = self._sha256.digest()
+            file.sniffed_content_type = self._sniffed_content_type
+        return file
+
+
+class HashingMemoryFileUploadHandler(_HashingMixin, MemoryFileUploadHandler):
+    """Small uploads, which are kept in memory"""
+
+
+class HashingTemporaryFileUploadHandler(_HashingMixin, TemporaryFileUploadHandler):
+    """Large uploads, which are streamed to a temporary file"""
@@ -24,6 +24,18 @@ def get_study_folder(instance, *args, absolute_path=False):
         return relative
 
 
+def get_shared_folder(instance, *args, absolute_path=False):
+    """
+    Ingested data that can be used by several uploads (of the same file) lives in a separate folder, so that it is not
+        removed along with any one study
+    """
+    relative = os.path.join('shared', get_study_folder(instance))
+    if absolute_path:
+        return os.path.join(settings.MEDIA_ROOT, relative)
+    else:
+        return relative
+
+
 def get_gwas_raw_fn(instance, filename):
     """Used only on initial upload; afterwards, all access to the raw file will be through a model field"""
     # FIXME: Audit this for path issues, eg a gwas filename with relative path fields (`../../gwas.json`)
@@ -28,6 +28,7 @@ from django.http import (
     HttpResponseRedirect,
 )
 
+from ..api import caching as api_caching
 from . import forms as lz_forms
 from . import models as lz_models
 from . import permissions as lz_permissions
@@ -179,7 +180,8 @@ class GwasDelete(lz_permissions.GwasOwner, DeleteView):
         We do things in this order so as not to retain data that the user thought was deleted
         """
         gwas = self.get_object()
-        # The same gwas file might be revised or re-processed, and we want to delete all known copies.
+        # The same gwas file might be revised or re-processed, and we want to delete all known copies. Ingested data
+        #   may also be used by other studies (with an identical upload): it is only deleted when the last one is gone.
         for fileset in gwas.analysisfileset_set.all():
             target_path = util.get_study_folder(fileset, absolute_path=True)
             logger.info('User has requested that we delete media folder: {}'.format(target_path))
@@ -189,6 +191,10 @@ class GwasDelete(lz_permissions.GwasOwner, DeleteView):
                 raise Exception('Cannot find the data requested for deletion')
 
             shutil.rmtree(target_path)
+            # Close open handles to the data in this process (other processes notice that the files are gone)
+            api_caching.tabix_pool.invalidate(fileset.normalized_gwas_path)
+            api_caching.columnar_stores.invalidate(fileset.columnar_path)
+            fileset.release_artifacts()
         return super(GwasDelete, self).delete(request, *args, **kwargs)
 
 
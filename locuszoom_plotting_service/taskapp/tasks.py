@@ -1,8 +1,11 @@
+import datetime
 import functools
 import os
+import typing as ty
 
+import billiard
 from celery.utils.log import get_task_logger
-from celery import shared_task
+from celery import chord, shared_task
 from django.conf import settings
 from django.core.mail import mail_admins, send_mail
 from django.db.models import signals
@@ -11,6 +14,7 @@ from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
 
+import zorp
 from zorp import (
     parsers,
     sniffers,
@@ -19,8 +23,18 @@ from zorp import (
 
 from locuszoom_plotting_service.gwas import models
 from util.ingest import (
+    columnar,
     exceptions,
+    genes,
+    manhattan,
+    manifests,
+    metrics,
     processors,
+    qq,
+    rsids,
+    sorting,
+    sources,
+    summarizers,
     validators
 )
 
@@ -31,6 +45,9 @@ logger = get_task_logger(__name__)
 def lz_file_prep(step_name):
     """Prepare a task that operates on files, and logs success/ failure.
     The tasks we define here ACTUALLY receive IDs, which are magically converted into a DB instance before being run
+
+    The time and memory used by each step are stored in the database. Steps also receive the metrics object, to record
+        how much data they processed.
     """
     def decorator(func):
         @functools.wraps(func)
@@ -41,8 +58,15 @@ def lz_file_prep(step_name):
                 timezone.now().replace(microsecond=0).isoformat(),
                 step_name
             )
+            succeeded = False
+            stage_metrics = metrics.StageMetrics()
             try:
-                func(self, instance)
+                # A step may return a note for the log (eg if it was skipped)
+                with stage_metrics.measure():
+                    note = func(self, instance, stage_metrics)
+                succeeded = True
+                if note:
+                    message += note + '\n'
                 message += '[success][{}] Step completed\n'.format(timezone.now().replace(microsecond=0).isoformat())
             except (exceptions.UnexpectedIngestException, Exception) as e:
                 message += '[failure][{}] An error prevented this step from completing\n'.format(
@@ -58,38 +82,97 @@ def lz_file_prep(step_name):
             finally:
                 with open(log_path, 'a+') as f:
                     f.write(message)
+                _save_metrics(instance, func.__name__, stage_metrics, succeeded)
+            # Steps that run in parallel (as a group) cannot stop each other, so the callback that runs after the
+            #   group uses this to decide whether ingestion succeeded
+            return succeeded
         return inner
     return decorator
 
 
-@shared_task(bind=True)
-@lz_file_prep("Calculate SHA256")
-def hash_contents(self, instance: models.AnalysisFileset):
-    """Store a unique hash of the file contents"""
-    sha256 = processors.get_file_sha256(os.path.join(settings.MEDIA_ROOT, instance.raw_gwas_file.name))
-    instance.file_sha256 = sha256
-    instance.save()
+def _save_metrics(instance: models.AnalysisFileset, stage: str, stage_metrics: metrics.StageMetrics, succeeded: bool):
+    """Record the resources used by one step. This is for monitoring only, and never causes ingestion to fail."""
+    try:
+        models.IngestStageMetrics.objects.create(fileset=instance, stage=stage, succeeded=succeeded,
+                                                 **stage_metrics.as_dict())
+    except Exception:
+        logger.exception('Could not save metrics for ingest step: {}'.format(stage))
 
 
 @shared_task(bind=True)
-@lz_file_prep("Normalize GWAS file format")
-def normalize_gwas(self, instance: models.AnalysisFileset):
+@lz_file_prep("Calculate SHA256 and normalize GWAS file format")
+def normalize_gwas(self, instance: models.AnalysisFileset, stage_metrics: metrics.StageMetrics):
+    """
+    Hash, validate, and normalize the raw upload.
+
+    If the same file has already been ingested with the same options (by any user), the existing data is used instead
+        (see `models.SharedArtifacts`). If another upload is still working on it, this upload waits for that one to
+        finish, and is then resumed.
+    """
     metadata = instance.metadata
 
     src_path = os.path.join(settings.MEDIA_ROOT, instance.raw_gwas_file.name)
-    dest_path = instance.normalized_gwas_path
     parser_options = instance.parser_options
 
+    # Uploads through the website are hashed as they are received (see `gwas.uploads`). Files that were added some other
+    #   way are hashed below, as they are read, so they can't share data with identical uploads on this first run.
+    is_hashed = bool(instance.file_sha256)
+    if is_hashed and not _claim_artifacts(instance):
+        self.request.chain = None
+        stage_metrics.skipped = True
+        # Normally resumed by the other upload when it finishes. Check later, in case that never happens.
+        resume_if_stuck.apply_async((instance.pk,), countdown=settings.LZ_SHARED_DATA_CLAIM_TIMEOUT)
+        return '[waiting] An identical upload is being processed. This study will use the same data when it is ready.'
+
+    dest_path = instance.normalized_gwas_path
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    columnar_path = instance.columnar_path
     log_path = instance.normalized_gwas_log_path
 
+    # A rerun (or an upload of a file that has been seen before) can skip this step if the outputs are up to date
+    manifest = manifests.StageManifest(
+        instance.stage_manifest_path('normalize'), 'normalize',
+        inputs=_normalize_inputs(instance),
+        code=manifests.code_version(columnar, processors, rsids, sorting, summarizers),
+        outputs=[dest_path, f'{dest_path}.tbi', os.path.join(columnar_path, columnar.META_FILENAME),
+                 instance.ingest_stats_path],
+    )
+    if manifest.is_current():
+        stage_metrics.skipped = True
+        return '[skipped] The normalized file is up to date'
+    manifest.invalidate()
+
     parser = parsers.GenericGwasLineParser(**parser_options)
-    reader = sniffers.guess_gwas_generic(src_path, parser=parser, skip_errors=True)
+    # The file is read (and decompressed) on another thread, while this one parses it
+    source = sources.ReadAheadLineSource(src_path)
+    reader = sniffers.guess_gwas_generic(source, parser=parser, skip_errors=True)
+    study_stats = summarizers.StudyStatsSummarizer()
+    rsid_annotator = rsids.RsidAnnotator.for_build(metadata.build, test=settings.DEBUG)
 
     is_valid = False
     try:
-        is_valid = validators.standard_gwas_validator.validate(src_path, reader)
+        is_valid = validators.standard_gwas_validator.validate_file_type(src_path) and \
+            processors.validate_and_normalize(reader, dest_path, metadata.build, debug_mode=settings.DEBUG,
+                                              consumers=[study_stats], rsid_annotator=rsid_annotator,
+                                              columnar_path=columnar_path)
     except z_exc.TooManyBadLinesException as e:
         raise e
+    except exceptions.UnsortedDataException as e:
+        if not settings.LZ_SORT_UNSORTED_UPLOADS:
+            raise
+        # Read the file again, and sort the rows before they are normalized
+        logger.info(f"GWAS '{src_path}' is not sorted; sorting before normalization: {e}")
+        with open(log_path, 'a+') as f:
+            f.write(f'[sort] {e}. The rows will be sorted before the file is normalized.\n')
+        reader = sniffers.guess_gwas_generic(source, parser=parser, skip_errors=True)
+        study_stats = summarizers.StudyStatsSummarizer()
+        rsid_annotator = rsids.RsidAnnotator.for_build(metadata.build, test=settings.DEBUG)
+        is_valid = processors.sort_and_normalize(
+            reader, dest_path, metadata.build, debug_mode=settings.DEBUG,
+            tmp_dir=os.path.dirname(src_path),
+            memory_budget=settings.LZ_SORT_MEMORY_BYTES, disk_budget=settings.LZ_SORT_DISK_BYTES,
+            consumers=[study_stats], rsid_annotator=rsid_annotator, columnar_path=columnar_path)
+        logger.info('GWAS file contents successfully sorted and validated')
     else:
         logger.info('GWAS file contents successfully validated')
     finally:
@@ -97,6 +180,8 @@ def normalize_gwas(self, instance: models.AnalysisFileset):
         with open(log_path, 'a+') as f:
             for n, reason, _ in reader.errors:
                 f.write('Excluded row {} from output due to parse error: {}\n'.format(n, reason))
+            if rsid_annotator.num_variants:
+                f.write(f'[rsid] {rsid_annotator.summary()}\n')
             if is_valid:
                 f.write('[success] The GWAS file passed validation. Read the logs carefully, in case any specific lines failed to parse.\n')  # noqa
             else:
@@ -106,42 +191,210 @@ def normalize_gwas(self, instance: models.AnalysisFileset):
         logger.info(f"Could not load GWAS '{src_path}' because contents failed to validate")
         raise exceptions.ValidationException(f'Validation failed for study ID {instance.metadata.slug}')
 
-    # For now the writer expects a temp file name, and it creates the .gz version internally
-    tmp_normalized_path = dest_path.replace('.txt.gz', '.txt')
-    processors.normalize_contents(reader, tmp_normalized_path, metadata.build, debug_mode=settings.DEBUG)
+    if not is_hashed:
+        # Store a unique hash of the file contents
+        instance.file_sha256 = source.sha256
+        instance.save()
+
+    processors.write_json(study_stats.get_result(), instance.ingest_stats_path)
+    manifest.save()
+
+    stage_metrics.rows = rsid_annotator.num_variants
+    stage_metrics.bytes_read = metrics.file_sizes(src_path)
+    stage_metrics.bytes_written = metrics.file_sizes(*manifest.outputs)
+
+
+def _claim_artifacts(instance: models.AnalysisFileset) -> bool:
+    """
+    Find (or create) the shared data for this upload, and decide who writes it
+
+    A claim normally ends when the upload that made it succeeds or fails (see `mark_success` and `mark_failure`). If
+        its worker died instead, the claim expires after `LZ_SHARED_DATA_CLAIM_TIMEOUT` seconds, and the next upload
+        that needs the data does the work. (uploads that were already waiting are restarted by `resume_if_stuck`)
+
+    :return: False if another upload is writing the data, and this upload must wait for it
+    """
+    fingerprint = models.SharedArtifacts.get_fingerprint(instance)
+    expired = timezone.now() - datetime.timedelta(seconds=settings.LZ_SHARED_DATA_CLAIM_TIMEOUT)
+    with transaction.atomic():
+        artifacts, _ = models.SharedArtifacts.objects.select_for_update().get_or_create(
+            fingerprint=fingerprint,
+            defaults={'processing_fileset': instance},
+        )
+        is_waiting = artifacts.ingest_status == 0 and artifacts.processing_fileset_id not in (None, instance.pk)
+        if is_waiting and artifacts.modified < expired:
+            logger.warning(f'Shared data {artifacts.pk} was claimed by gwas id {artifacts.processing_fileset_id} '
+                           f'at {artifacts.modified}, which never finished; gwas id {instance.pk} will redo the work')
+            is_waiting = False
+        if not is_waiting and artifacts.ingest_status != 2:
+            # New data, or an earlier attempt failed: this upload does the work
+            artifacts.processing_fileset = instance
+            artifacts.ingest_status = 0
+            artifacts.save()
+        instance.artifacts = artifacts
+        instance.save()
+    return not is_waiting
+
+
+def _finish_artifacts(fileset_id: int, status: int):
+    """When the upload that writes shared data is done, resume any identical uploads that are waiting for it"""
+    with transaction.atomic():
+        artifacts = models.SharedArtifacts.objects.select_for_update().filter(processing_fileset_id=fileset_id).first()
+        if artifacts is None:
+            return
+        waiting = artifacts.finish(status)
+        for pk in waiting:
+            # If the data could not be created, the next upload will try again (and report its own errors)
+            transaction.on_commit(lambda pk=pk: total_pipeline(pk).apply_async())
 
 
 @shared_task(bind=True)
-@lz_file_prep("QQ plots and top hit detection")
-def summarize_gwas(self, instance: models.AnalysisFileset):
-    """Generate "summary" files based on the overall study contents; uses PheWeb loader code"""
-    normalized_path = instance.normalized_gwas_path
-    qq_path = instance.qq_path
+def resume_if_stuck(self, fileset_id: int):
+    """
+    Runs some time after an upload starts to wait for an identical upload to write the shared data. If the upload is
+        still waiting, and the shared data has not changed for `LZ_SHARED_DATA_CLAIM_TIMEOUT` seconds (eg the worker for
+        the other upload was killed, or could not queue the restart), run the pipeline again: it takes over the expired
+        claim (see `_claim_artifacts`). Otherwise, check again when the claim would expire.
+    """
+    instance = models.AnalysisFileset.objects.select_related('artifacts').filter(pk=fileset_id).first()
+    if instance is None or instance.ingest_status != 0 or instance.artifacts is None:
+        # Deleted, finished, or never waited
+        return
 
-    # Find top hit
-    best_row = processors.get_top_hit(normalized_path)
-    top_hit = models.RegionView.objects.create(
-        gwas=instance.metadata,
-        label='Top hit',
-        chrom=best_row.chrom,
-        start=max(best_row.pos - 250_000, 1),
-        end=best_row.pos + 250_000
+    expires = instance.artifacts.modified + datetime.timedelta(seconds=settings.LZ_SHARED_DATA_CLAIM_TIMEOUT)
+    remaining = (expires - timezone.now()).total_seconds()
+    if remaining > 0:
+        resume_if_stuck.apply_async((fileset_id,), countdown=int(remaining) + 1)
+        return
+
+    logger.warning(f'gwas id {fileset_id} was never resumed after waiting for shared data {instance.artifacts.pk}; '
+                   'restarting the ingest pipeline')
+    total_pipeline(fileset_id).apply_async()
+
+
+def _normalize_inputs(instance: models.AnalysisFileset) -> ty.Optional[dict]:
+    """Everything (besides code) that determines the normalized file"""
+    if not instance.file_sha256:
+        return None
+    return {
+        'raw_sha256': bytes(instance.file_sha256).hex(),
+        'parser_options': instance.parser_options,
+        'build': instance.metadata.build,
+        'rsid_test_mode': settings.DEBUG,
+        'zorp': zorp.__version__,
+    }
+
+
+def _summary_manifest(instance: models.AnalysisFileset, stage: str, code: dict, outputs: ty.Sequence[str],
+                      **options) -> manifests.StageManifest:
+    """A manifest for a step that summarizes the normalized file (and stats), with the given options"""
+    normalized = manifests.read_checksums(instance.stage_manifest_path('normalize'))
+    return manifests.StageManifest(
+        instance.stage_manifest_path(stage), stage,
+        inputs={'normalized': normalized, 'build': instance.metadata.build, **options} if normalized else None,
+        code=code,
+        outputs=outputs,
     )
-    instance.metadata.top_hit_view = top_hit
-    instance.metadata.save()
 
-    # Generate files
-    processors.generate_qq(normalized_path, qq_path)
+
+def _summarize(task, instance: models.AnalysisFileset, summaries: ty.Sequence[str],
+               stage_metrics: metrics.StageMetrics) -> list:
+    """
+    Calculate some of the summaries for a study (see `summarizers.make_study_summarizers`), in a single read of the
+        normalized file. Time spent on each summary is written to the ingest log.
+    """
+    normalized_path = instance.normalized_gwas_path
+    study_stats = processors.read_json(instance.ingest_stats_path, default={})
+    stage_metrics.bytes_read = metrics.file_sizes(normalized_path)
+
+    # Large studies can be summarized one chromosome at a time, in a pool of processes (configured per queue). This
+    #   requires stats gathered during normalization, which studies ingested by older versions may not have.
+    queue = (task.request.delivery_info or {}).get('routing_key')
+    num_workers = settings.LZ_SUMMARY_WORKERS.get(queue, 1)
+    chroms = summarizers.get_chroms(study_stats)
+    make_consumers = functools.partial(summarizers.make_study_summarizers, instance.metadata.build, study_stats,
+                                       summaries=summaries,
+                                       fold_threshold=settings.LZ_MANHATTAN_FOLD_THRESHOLD,
+                                       mergeable=num_workers > 1 and chroms is not None)
+    consumers = make_consumers()
+    try:
+        if num_workers > 1 and chroms is not None:
+            logger.info(f'Summarizing {len(chroms)} chromosomes with {num_workers} processes')
+            # Celery's fork of multiprocessing allows child processes inside a (daemonic) prefork worker
+            with billiard.Pool(num_workers) as pool:
+                return processors.summarize_contents_by_chrom(normalized_path, consumers, chroms, make_consumers,
+                                                              map_func=pool.map)
+        else:
+            return processors.summarize_contents(normalized_path, consumers)
+    finally:
+        stage_metrics.rows = consumers[0].num_variants
+        with open(instance.normalized_gwas_log_path, 'a+') as f:
+            for summarizer in consumers:
+                f.write(f'[summary] {summarizer.label}: {summarizer.elapsed:.2f} s\n')
 
 
 @shared_task(bind=True)
-@lz_file_prep("Prepare a manhattan plot")
-def manhattan_plot(self, instance: models.AnalysisFileset):
-    # This is a separate task because it can be quite slow
+@lz_file_prep("Top hit detection and QQ plot")
+def summarize_gwas(self, instance: models.AnalysisFileset, stage_metrics: metrics.StageMetrics):
+    """
+    Generate "summary" files based on the overall study contents; uses PheWeb loader code
+
+    The top hit and QQ plot are calculated from a single read of the normalized file
+    """
     metadata = instance.metadata
-    normalized_path = instance.normalized_gwas_path
-    manhattan_path = instance.manhattan_path
-    processors.generate_manhattan(metadata.build, normalized_path, manhattan_path)
+    manifest = _summary_manifest(instance, 'summarize', manifests.code_version(summarizers, qq),
+                                 [instance.qq_path, instance.top_hit_path])
+    if manifest.is_current():
+        # The files may have been written for another study that uses the same data
+        if metadata.top_hit_view is None:
+            _create_top_hit_view(metadata, processors.read_json(instance.top_hit_path))
+        stage_metrics.skipped = True
+        return '[skipped] The top hit and QQ plot are up to date'
+    manifest.invalidate()
+
+    best_row, qq_data = _summarize(self, instance, ['top_hit', 'qq'], stage_metrics)
+
+    # Generate files
+    top_hit = {'chrom': best_row.chrom, 'pos': best_row.pos, 'ref': best_row.ref, 'alt': best_row.alt}
+    processors.write_json(top_hit, instance.top_hit_path)
+    processors.write_json(qq_data, instance.qq_path)
+    manifest.save()
+    stage_metrics.bytes_written = metrics.file_sizes(*manifest.outputs)
+
+    _create_top_hit_view(metadata, top_hit)
+
+
+def _create_top_hit_view(metadata: models.AnalysisInfo, top_hit: dict):
+    """Suggest a region around the strongest variant in the study"""
+    view = models.RegionView.objects.create(
+        gwas=metadata,
+        label='Top hit',
+        chrom=top_hit['chrom'],
+        start=max(top_hit['pos'] - 250_000, 1),
+        end=top_hit['pos'] + 250_000
+    )
+    metadata.top_hit_view = view
+    metadata.save()
+
+
+@shared_task(bind=True)
+@lz_file_prep("Generate manhattan plot")
+def manhattan_plot(self, instance: models.AnalysisFileset, stage_metrics: metrics.StageMetrics):
+    """
+    Generate manhattan plot data. This is the slowest summary, so it is calculated separately, at the same time as
+        the other summaries (usually on another worker).
+    """
+    manifest = _summary_manifest(instance, 'manhattan', manifests.code_version(summarizers, manhattan, genes),
+                                 [instance.manhattan_path], fold_threshold=settings.LZ_MANHATTAN_FOLD_THRESHOLD)
+    if manifest.is_current():
+        stage_metrics.skipped = True
+        return '[skipped] The manhattan plot is up to date'
+    manifest.invalidate()
+
+    manhattan_data, = _summarize(self, instance, ['manhattan'], stage_metrics)
+    processors.write_json(manhattan_data, instance.manhattan_path)
+    manifest.save()
+    stage_metrics.bytes_written = metrics.file_sizes(*manifest.outputs)
 
 
 @shared_task(bind=True)
@@ -152,6 +405,7 @@ def mark_success(self, fileset_id):
     instance.ingest_status = 2
     instance.ingest_complete = timezone.now()
     instance.save()
+    _finish_artifacts(fileset_id, 2)
 
     # The parent object needs to know which instance is the current newest / best one to display
     metadata = instance.metadata
@@ -166,18 +420,31 @@ def mark_success(self, fileset_id):
               [metadata.owner.email])
 
 
+@shared_task(bind=True)
+def mark_success_if_all(self, results: ty.List[bool], fileset_id: int):
+    """
+    Runs after a group of steps that ran in parallel. If any step failed, it has already notified the user (see
+        `lz_file_prep`), so only a complete success needs to be reported.
+    """
+    if all(results):
+        mark_success(fileset_id)
+
+
 @shared_task(bind=True)
 def mark_failure(self, fileset_id):
     """
     Mark a task as failed, and email site admins (for every failure).
     Eventually, we can dial back the error emails a bit.
     """
-    instance = models.AnalysisFileset.objects.get(pk=fileset_id)
-
     logger.exception(f'Ingestion pipeline failed for gwas id: {fileset_id}')
-    instance.ingest_status = 1
-    instance.ingest_complete = timezone.now()
-    instance.save()
+    # Steps that run in parallel may both fail; only report each failed upload once
+    is_changed = models.AnalysisFileset.objects.filter(pk=fileset_id).exclude(ingest_status=1)\
+        .update(ingest_status=1, ingest_complete=timezone.now())
+    if not is_changed:
+        return
+    _finish_artifacts(fileset_id, 1)
+
+    instance = models.AnalysisFileset.objects.get(pk=fileset_id)
 
     metadata = instance.metadata
     log_url = reverse('gwas:gwas-ingest-log', kwargs={'slug': metadata.slug})
@@ -193,13 +460,18 @@ def mark_failure(self, fileset_id):
 
 
 def total_pipeline(fileset_id: int):
-    """Combine discrete tasks into a total pipeline"""
+    """
+    Combine discrete tasks into a total pipeline
+
+    Steps after normalization only read the normalized file, and do not depend on each other. They run in parallel
+        (as a chord), and the callback decides whether the upload succeeded.
+    """
     return (
-        hash_contents.si(fileset_id) |
         normalize_gwas.si(fileset_id) |
-        summarize_gwas.si(fileset_id) |
-        manhattan_plot.si(fileset_id) |
-        mark_success.si(fileset_id)
+        chord(
+            [summarize_gwas.si(fileset_id), manhattan_plot.si(fileset_id)],
+            mark_success_if_all.s(fileset_id)
+        )
     ).on_error(mark_failure.si(fileset_id))
 
 
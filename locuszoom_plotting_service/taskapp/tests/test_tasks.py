@@ -0,0 +1,144 @@
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from zorp import sniffers
+
+from locuszoom_plotting_service.gwas import models as lz_models
+from locuszoom_plotting_service.gwas.tests.factories import AnalysisFilesetFactory, AnalysisInfoFactory
+
+from .. import tasks
+
+
+# Rows for each chromosome are not contiguous, and positions are out of order
+UNSORTED_GWAS = (
+    b'#chrom\tpos\tref\talt\tpvalue\n'
+    b'2\t100\tA\tC\t0.5\n'
+    b'1\t200\tA\tC\t0.1\n'
+    b'1\t100\tG\tT\t0.2\n'
+    b'2\t50\tA\tC\t0.3\n'
+)
+
+
+SORTED_GWAS = (
+    b'#chrom\tpos\tref\talt\tpvalue\n'
+    b'1\t100\tG\tT\t0.2\n'
+    b'1\t200\tA\tC\t0.1\n'
+)
+
+
+class TestNormalizeGwas(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+
+    def _make_upload(self, contents: bytes):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            fileset = AnalysisFilesetFactory(metadata=AnalysisInfoFactory(build='GRCh37'))
+            fileset.raw_gwas_file.save('gwas.txt', ContentFile(contents))
+        return fileset
+
+    def test_sorts_unsorted_upload(self):
+        fileset = self._make_upload(UNSORTED_GWAS)
+        # The test lookup for rsids is used in debug mode
+        with override_settings(MEDIA_ROOT=self.media_root, LZ_SORT_UNSORTED_UPLOADS=True, DEBUG=True):
+            self.assertTrue(tasks.normalize_gwas(fileset.pk), 'Step completed')
+            fileset.refresh_from_db()
+            rows = [(row.chrom, row.pos) for row in sniffers.guess_gwas_standard(fileset.normalized_gwas_path)]
+            with open(fileset.normalized_gwas_log_path) as f:
+                log = f.read()
+
+        self.assertEqual(rows, [('1', 100), ('1', 200), ('2', 50), ('2', 100)])
+        self.assertIn('[sort] Positions must be sorted', log, 'Rows were sorted after the first error')
+        self.assertEqual(bytes(fileset.file_sha256), hashlib.sha256(UNSORTED_GWAS).digest(),
+                         'File without an upload hash was hashed as it was read')
+
+
+class TestClaimArtifacts(TestCase):
+    def setUp(self):
+        self.first = AnalysisFilesetFactory(metadata=AnalysisInfoFactory(build='GRCh37'), file_sha256=b'\x01' * 32)
+        self.second = AnalysisFilesetFactory(metadata=AnalysisInfoFactory(build='GRCh37'), file_sha256=b'\x01' * 32)
+
+    def test_identical_upload_waits(self):
+        self.assertTrue(tasks._claim_artifacts(self.first))
+        self.assertFalse(tasks._claim_artifacts(self.second), 'Waits for the first upload to write the data')
+
+    @override_settings(LZ_SHARED_DATA_CLAIM_TIMEOUT=60 * 60)
+    def test_expired_claim_is_taken_over(self):
+        self.assertTrue(tasks._claim_artifacts(self.first))
+        # The worker for the first upload died without marking it as failed
+        lz_models.SharedArtifacts.objects.update(modified=timezone.now() - datetime.timedelta(hours=2))
+
+        self.assertTrue(tasks._claim_artifacts(self.second), 'Does the work itself')
+        artifacts = lz_models.SharedArtifacts.objects.get()
+        self.assertEqual(artifacts.processing_fileset_id, self.second.pk)
+        self.assertEqual(artifacts.ingest_status, 0)
+
+
+@override_settings(LZ_SHARED_DATA_CLAIM_TIMEOUT=60 * 60, DEBUG=True)
+class TestWaitingUpload(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.first, self.second = [self._make_upload(SORTED_GWAS) for _ in range(2)]
+
+    def _make_upload(self, contents: bytes):
+        fileset = AnalysisFilesetFactory(metadata=AnalysisInfoFactory(build='GRCh37'),
+                                         file_sha256=hashlib.sha256(contents).digest())
+        fileset.raw_gwas_file.save('gwas.txt', ContentFile(contents))
+        return fileset
+
+    def test_completes_when_first_upload_never_finishes(self):
+        # The first upload claims the shared data, then its worker is killed
+        self.assertTrue(tasks._claim_artifacts(self.first))
+
+        with mock.patch.object(tasks.resume_if_stuck, 'apply_async') as check_later:
+            self.assertTrue(tasks.normalize_gwas(self.second.pk))
+        check_later.assert_called_once_with((self.second.pk,), countdown=60 * 60)
+        self.second.refresh_from_db()
+        self.assertFalse(os.path.isfile(self.second.normalized_gwas_path), 'Waited for the first upload')
+
+        # Nothing has resumed the second upload when the check runs
+        lz_models.SharedArtifacts.objects.update(modified=timezone.now() - datetime.timedelta(hours=2))
+        with mock.patch.object(tasks, 'total_pipeline') as pipeline:
+            tasks.resume_if_stuck(self.second.pk)
+        pipeline.assert_called_once_with(self.second.pk)
+
+        # The restarted pipeline takes over the expired claim
+        self.assertTrue(tasks.normalize_gwas(self.second.pk))
+        self.second.refresh_from_db()
+        self.assertEqual(self.second.artifacts.processing_fileset_id, self.second.pk)
+        rows = [(row.chrom, row.pos) for row in sniffers.guess_gwas_standard(self.second.normalized_gwas_path)]
+        self.assertEqual(rows, [('1', 100), ('1', 200)])
+
+    def test_checks_again_until_claim_expires(self):
+        self.assertTrue(tasks._claim_artifacts(self.first))
+        self.assertFalse(tasks._claim_artifacts(self.second))
+        lz_models.SharedArtifacts.objects.update(modified=timezone.now() - datetime.timedelta(minutes=50))
+
+        with mock.patch.object(tasks.resume_if_stuck, 'apply_async') as check_later, \
+                mock.patch.object(tasks, 'total_pipeline') as pipeline:
+            tasks.resume_if_stuck(self.second.pk)
+        pipeline.assert_not_called()
+        (args,), kwargs = check_later.call_args
+        self.assertEqual(args, (self.second.pk,))
+        self.assertTrue(9 * 60 < kwargs['countdown'] <= 10 * 60 + 1, 'Checks when the claim would expire')
+
+    def test_finished_upload_is_not_restarted(self):
+        self.assertTrue(tasks._claim_artifacts(self.first))
+        self.assertFalse(tasks._claim_artifacts(self.second))
+        lz_models.AnalysisFileset.objects.filter(pk=self.second.pk).update(ingest_status=2)
+
+        with mock.patch.object(tasks, 'total_pipeline') as pipeline:
+            tasks.resume_if_stuck(self.second.pk)
+        pipeline.assert_not_called()
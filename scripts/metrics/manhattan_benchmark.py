@@ -0,0 +1,78 @@
+"""
+Measure the time and memory needed to build Manhattan plot data for a very large study, using synthetic variants.
+
+Time spent creating the synthetic variants is not counted. Peak memory is the peak RSS of the whole process, so run
+    one benchmark per process. The RSS before any variants are binned (mostly python, zorp, and numpy) is also shown.
+
+    Sample usage:
+    `python3 scripts/metrics/manhattan_benchmark.py --num-variants 10000000`
+"""
+import argparse
+import math
+from pathlib import Path
+import random
+import resource
+import sys
+import time
+
+from zorp.parsers import BasicVariant
+
+sys.path.append(str(Path(__file__).parent.parent.parent.resolve()))
+
+from util.ingest import manhattan  # noqa
+
+
+CHUNK_SIZE = 10_000
+
+
+def make_chunks(num_variants: int, seed: int):
+    rand = random.Random(seed)
+    chrom, pos = 1, 0
+    for start in range(0, num_variants, CHUNK_SIZE):
+        chunk = []
+        for i in range(start, min(start + CHUNK_SIZE, num_variants)):
+            if i and i % (num_variants // 22 + 1) == 0:
+                chrom, pos = chrom + 1, 0
+            pos += rand.randint(1, 600)
+            if i % 1000 == 0:
+                # A few strong signals, so that there are peaks
+                qval = rand.expovariate(0.1)
+            else:
+                qval = -math.log10(1 - rand.random())
+            chunk.append(BasicVariant(str(chrom), pos, None, 'A', 'C', qval, None, None, None))
+        yield chunk
+
+
+def _peak_rss_mb() -> float:
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main(num_variants: int, seed: int):
+    initial_rss = _peak_rss_mb()
+    binner = manhattan.Binner()
+    processing = 0.0
+    for chunk in make_chunks(num_variants, seed):
+        start = time.perf_counter()
+        binner.process_chunk(chunk)
+        processing += time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = binner.get_result()
+    finishing = time.perf_counter() - start
+
+    print('Manhattan benchmark: {:,} variants'.format(num_variants))
+    print('  {:<24} {:8.2f} s'.format('process variants', processing))
+    print('  {:<24} {:8.2f} s'.format('get_result', finishing))
+    print('  {:<24} {:8} bins, {} unbinned'.format('result', len(result['variant_bins']),
+                                                   len(result['unbinned_variants'])))
+    print('  {:<24} {:8.0f} MB'.format('RSS before binning', initial_rss))
+    print('  {:<24} {:8.0f} MB'.format('peak RSS', _peak_rss_mb()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the Manhattan plot calculations on synthetic data')
+    parser.add_argument('--num-variants', type=int, default=10_000_000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    main(args.num_variants, args.seed)
@@ -0,0 +1,99 @@
+"""
+Measure the time needed to build QQ plot data for a very large study, using synthetic variants.
+
+Each part of the QQ calculation is timed separately: feeding chunks of variants to the summarizer, building the
+    final plot data (with and without MAF strata), the exact (sorted list) algorithm, and confidence intervals.
+    Time spent creating the synthetic variants is not counted.
+
+    Sample usage:
+    `python3 scripts/metrics/qq_benchmark.py --num-variants 10000000`
+"""
+import argparse
+import collections
+import math
+from pathlib import Path
+import random
+import sys
+import time
+
+from zorp.parsers import BasicVariant
+
+sys.path.append(str(Path(__file__).parent.parent.parent.resolve()))
+
+from util.ingest import qq, summarizers  # noqa
+
+
+CHUNK_SIZE = 100_000
+
+
+def make_chunks(num_variants: int, with_maf: bool, seed: int):
+    rand = random.Random(seed)
+    for start in range(0, num_variants, CHUNK_SIZE):
+        chunk = []
+        for i in range(start, min(start + CHUNK_SIZE, num_variants)):
+            if i % 100 == 0:
+                # A few strong signals, which extend past the visible range of the plot
+                qval = rand.expovariate(0.2)
+            else:
+                qval = -math.log10(1 - rand.random())
+            af = rand.random() if with_maf else None
+            chunk.append(BasicVariant('1', i + 1, None, 'A', 'C', qval, None, None, af))
+        yield chunk
+
+
+def time_summarizer(num_variants: int, with_maf: bool, seed: int) -> dict:
+    maf_counts = None
+    if with_maf:
+        stats = summarizers.StudyStatsSummarizer()
+        for chunk in make_chunks(num_variants, with_maf, seed):
+            stats.process_chunk(chunk)
+        maf_counts = stats.get_result()['maf_counts']
+
+    summarizer = summarizers.QQSummarizer(maf_counts=maf_counts)
+    processing = 0.0
+    for chunk in make_chunks(num_variants, with_maf, seed):
+        start = time.perf_counter()
+        summarizer.process_chunk(chunk)
+        processing += time.perf_counter() - start
+
+    start = time.perf_counter()
+    summarizer.get_result()
+    return {'process_chunk': processing, 'get_result': time.perf_counter() - start}
+
+
+def time_exact(num_variants: int, seed: int) -> dict:
+    qvals = [v.neg_log_pvalue for chunk in make_chunks(num_variants, False, seed) for v in chunk]
+    qvals.sort(reverse=True)
+    start = time.perf_counter()
+    qq.compute_qq(qvals)
+    return {'compute_qq': time.perf_counter() - start}
+
+
+def time_confidence_intervals(num_variants: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(100):
+        list(qq.get_confidence_intervals(num_variants))
+    return {'get_confidence_intervals (x100)': time.perf_counter() - start}
+
+
+def main(num_variants: int, seed: int, skip_exact: bool):
+    timings = collections.OrderedDict()
+    timings['QQ (no MAF)'] = time_summarizer(num_variants, False, seed)
+    timings['QQ (MAF strata)'] = time_summarizer(num_variants, True, seed)
+    if not skip_exact:
+        timings['Exact QQ from sorted list'] = time_exact(num_variants, seed)
+    timings['Confidence intervals'] = time_confidence_intervals(num_variants)
+
+    print('QQ benchmark: {:,} variants'.format(num_variants))
+    for label, parts in timings.items():
+        for part, elapsed in parts.items():
+            print('  {:<28} {:<32} {:8.2f} s'.format(label, part, elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the QQ plot calculations on synthetic data')
+    parser.add_argument('--num-variants', type=int, default=10_000_000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-exact', action='store_true', help='Skip the (memory hungry) exact QQ algorithm')
+    args = parser.parse_args()
+    main(args.num_variants, args.seed, args.skip_exact)
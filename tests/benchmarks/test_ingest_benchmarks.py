@@ -0,0 +1,160 @@
+"""
+Benchmarks of the ingest hot paths, on synthetic studies of realistic size (see `tests.ingest.synthetic`)
+
+These are slow, and are skipped unless the study sizes are given. Results (time, plus the peak RSS of each run in
+    `extra_info`) are saved as JSON by pytest-benchmark, so that two runs can be compared:
+
+    `LZ_BENCHMARK_SIZES=100000,1000000,10000000 pytest tests/benchmarks --benchmark-autosave`
+    `LZ_BENCHMARK_SIZES=100000,1000000,10000000 pytest tests/benchmarks --benchmark-compare`
+
+    (or `--benchmark-json=<path>` to write one file.) Each benchmark runs once per size, unless `LZ_BENCHMARK_ROUNDS`
+    is set. Synthetic files are created before timing starts, and are shared by all benchmarks of the same size.
+"""
+import os
+
+import numpy as np
+import pytest
+from zorp import parsers, sniffers
+
+from util.ingest import (
+    manhattan,
+    metrics,
+    processors,
+    qq,
+    summarizers,
+    validators,
+)
+
+from ..ingest.synthetic import SyntheticGwas
+
+
+SIZES = [int(size) for size in os.environ.get('LZ_BENCHMARK_SIZES', '').split(',') if size]
+ROUNDS = int(os.environ.get('LZ_BENCHMARK_ROUNDS', 1))
+BUILD = 'GRCh38'
+CHUNK_SIZE = 10_000
+
+pytestmark = pytest.mark.skipif(not SIZES, reason='Set LZ_BENCHMARK_SIZES (eg "100000,1000000") to run benchmarks')
+
+
+class Study:
+    """A synthetic study, written to disk in raw and normalized form"""
+    def __init__(self, folder: str, num_variants: int):
+        self.folder = folder
+        self.num_variants = num_variants
+        self.gwas = SyntheticGwas(num_variants)
+        self.raw_path = self.gwas.write(os.path.join(folder, 'raw.txt'))
+
+        self.normalized_path = os.path.join(folder, 'normalized.txt.gz')
+        stats = summarizers.StudyStatsSummarizer()
+        processors.validate_and_normalize(self.reader(), self.normalized_path, BUILD, debug_mode=True,
+                                          consumers=[stats])
+        self.stats = stats.get_result()
+        # Inputs for the QQ functions, as `summarizers.QQSummarizer` prepares them
+        self.mafs = np.array([round(variant.maf, qq.MAF_SIGFIGS) for variant in self.gwas.variants()])
+        qvals = self.gwas.arrays()['neg_log_pvalue']
+        self.qq_qvals = np.where(np.isinf(qvals), 1000, qvals)
+
+    def reader(self):
+        parser = parsers.GenericGwasLineParser(**self.gwas.parser_options)
+        return sniffers.guess_gwas_generic(self.raw_path, parser=parser, skip_errors=True)
+
+    def chunks(self):
+        """(chrom, pos, qval, QQ qval, rounded maf) arrays, in chunks of the size that the summarizers receive"""
+        arrays = self.gwas.arrays()
+        for start in range(0, self.num_variants, CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            yield arrays['chrom'][start:end], arrays['pos'][start:end], arrays['neg_log_pvalue'][start:end], \
+                self.qq_qvals[start:end], self.mafs[start:end]
+
+
+@pytest.fixture(scope='module', params=SIZES, ids=lambda size: f'{size:,}')
+def study(request, tmp_path_factory) -> Study:
+    return Study(str(tmp_path_factory.mktemp(f'study_{request.param}')), request.param)
+
+
+def run(benchmark, study: Study, func, *args):
+    """Time one call of the function (per round), and record the peak memory used during the call"""
+    peaks = []
+
+    def measured():
+        stage = metrics.StageMetrics()
+        with stage.measure():
+            result = func(*args)
+        peaks.append(stage.peak_rss)
+        return result
+
+    result = benchmark.pedantic(measured, rounds=ROUNDS, iterations=1)
+    benchmark.extra_info['num_variants'] = study.num_variants
+    benchmark.extra_info['peak_rss'] = max(peaks)
+    return result
+
+
+class TestProcessors:
+    def test_get_file_sha256(self, benchmark, study):
+        run(benchmark, study, processors.get_file_sha256, study.raw_path)
+
+    def test_normalize_contents(self, benchmark, study):
+        dest_path = os.path.join(study.folder, 'bench_normalized.txt')
+        assert run(benchmark, study, lambda: processors.normalize_contents(study.reader(), dest_path, BUILD,
+                                                                           debug_mode=True))
+
+    def test_validate_and_normalize(self, benchmark, study):
+        dest_path = os.path.join(study.folder, 'bench_validated.txt.gz')
+        assert run(benchmark, study, lambda: processors.validate_and_normalize(
+            study.reader(), dest_path, BUILD, debug_mode=True, consumers=[summarizers.StudyStatsSummarizer()]))
+
+    def test_summarize_contents(self, benchmark, study):
+        run(benchmark, study, lambda: processors.summarize_contents(
+            study.normalized_path, summarizers.make_study_summarizers(BUILD, study.stats)))
+
+    def test_generate_manhattan(self, benchmark, study):
+        dest_path = os.path.join(study.folder, 'manhattan.json')
+        assert run(benchmark, study, processors.generate_manhattan, BUILD, study.normalized_path, dest_path)
+
+    def test_generate_qq(self, benchmark, study):
+        dest_path = os.path.join(study.folder, 'qq.json')
+        assert run(benchmark, study, processors.generate_qq, study.normalized_path, dest_path)
+
+    def test_get_top_hit(self, benchmark, study):
+        run(benchmark, study, processors.get_top_hit, study.normalized_path)
+
+
+class TestValidators:
+    def test_validate(self, benchmark, study):
+        assert run(benchmark, study,
+                   lambda: validators.standard_gwas_validator.validate(study.raw_path, study.reader()))
+
+
+class TestManhattan:
+    def test_binner(self, benchmark, study):
+        def bin_study():
+            binner = manhattan.Binner(max_qval=study.stats['max_neg_log_pvalue'])
+            for chroms, positions, qvals, _, _ in study.chunks():
+                binner.process_arrays(chroms, positions, qvals, lambda row: {
+                    'chrom': chroms[row], 'pos': int(positions[row]), 'neg_log_pvalue': float(qvals[row])})
+            return binner.get_result()
+
+        run(benchmark, study, bin_study)
+
+
+class TestQQ:
+    def test_unstratified(self, benchmark, study):
+        def make_qq():
+            histogram = qq.QvalHistogram()
+            for _, _, _, qvals, _ in study.chunks():
+                histogram.update(qvals)
+            return qq.make_qq_unstratified_from_histogram(histogram, include_qq=True)
+
+        run(benchmark, study, make_qq)
+
+    def test_stratified(self, benchmark, study):
+        def make_qq():
+            strata = qq.MafStrata(study.stats['maf_counts'])
+            histograms = [qq.QvalHistogram() for _ in range(strata.num_ranges)]
+            for _, _, _, qvals, mafs in study.chunks():
+                assigned = strata.assign_many(mafs.tolist())
+                for idx, histogram in enumerate(histograms):
+                    histogram.update(qvals[assigned == idx])
+            return qq.make_qq_stratified_from_histograms(strata, histograms)
+
+        run(benchmark, study, make_qq)
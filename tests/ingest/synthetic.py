@@ -0,0 +1,150 @@
+"""
+Deterministic synthetic GWAS data, for tests and benchmarks of the ingest pipeline at realistic sizes
+
+Most variants are null (uniform pvalues). A few peaks are added, where variants close to the peak center have much
+    stronger pvalues, and a small fraction of rows have p=0 (pvalue underflow). The same options (and seed) always
+    give the same data.
+"""
+import gzip
+import math
+import typing as ty
+
+import numpy as np
+from zorp.parsers import BasicVariant
+
+
+# Approximate lengths of GRCh37 autosomes and X (bp). Variants are spread over chromosomes in proportion to length.
+HUMAN_CHROMS = (
+    ('1', 249_250_621), ('2', 243_199_373), ('3', 198_022_430), ('4', 191_154_276), ('5', 180_915_260),
+    ('6', 171_115_067), ('7', 159_138_663), ('8', 146_364_022), ('9', 141_213_431), ('10', 135_534_747),
+    ('11', 135_006_516), ('12', 133_851_895), ('13', 115_169_878), ('14', 107_349_540), ('15', 102_531_392),
+    ('16', 90_354_753), ('17', 81_195_210), ('18', 78_077_248), ('19', 59_128_983), ('20', 63_025_520),
+    ('21', 48_129_895), ('22', 51_304_566), ('X', 155_270_560),
+)
+
+# The columns of files written by `SyntheticGwas.write` (1-based, as used by zorp parsers)
+PARSER_OPTIONS = {
+    'chrom_col': 1,
+    'pos_col': 2,
+    'ref_col': 3,
+    'alt_col': 4,
+    'pvalue_col': 5,
+    'is_neg_log_pvalue': False,
+}
+
+_BASES = np.array(list('ACGT'))
+
+
+class SyntheticGwas:
+    """A reproducible set of GWAS results, which can be written to a file or used directly"""
+    def __init__(self, num_variants: int, *,
+                 chroms: ty.Sequence[ty.Tuple[str, int]] = HUMAN_CHROMS,
+                 num_peaks: int = 20,
+                 peak_width: int = 200_000,
+                 peak_neg_log_pvalue: float = 30.0,
+                 with_af: bool = True,
+                 underflow_rate: float = 1e-5,
+                 seed: int = 1):
+        """
+        :param num_variants: The number of rows
+        :param chroms: (name, length) for each chromosome, in file order
+        :param num_peaks: Number of association signals. Each peak is centered on a random variant.
+        :param peak_width: Variants within this distance (bp) of a peak center are stronger than the null
+        :param peak_neg_log_pvalue: -log10(pvalue) at the center of each peak
+        :param with_af: Whether to include an alt allele frequency column
+        :param underflow_rate: Fraction of rows with a pvalue of exactly 0
+        :param seed: Seed for the random number generator
+        """
+        self.num_variants = num_variants
+        self.chroms = chroms
+        self.num_peaks = num_peaks
+        self.peak_width = peak_width
+        self.peak_neg_log_pvalue = peak_neg_log_pvalue
+        self.with_af = with_af
+        self.underflow_rate = underflow_rate
+        self.seed = seed
+        self._arrays = None  # type: ty.Optional[dict]
+
+    @property
+    def parser_options(self) -> dict:
+        options = dict(PARSER_OPTIONS)
+        if self.with_af:
+            options['allele_freq_col'] = 6
+        return options
+
+    def arrays(self) -> dict:
+        """
+        The data as numpy arrays (one per column): chrom, pos, ref, alt, pvalue, neg_log_pvalue, and (optionally)
+            alt_allele_freq. Rows are sorted by position within each chromosome.
+        """
+        if self._arrays is not None:
+            return self._arrays
+        rand = np.random.RandomState(self.seed)
+        n = self.num_variants
+
+        # Spread variants over chromosomes in proportion to length, with unique sorted positions in each
+        lengths = np.array([length for _, length in self.chroms], dtype=np.float64)
+        counts = np.floor(lengths / lengths.sum() * n).astype(np.int64)
+        counts[:n - counts.sum()] += 1
+        chrom_codes = np.repeat(np.arange(len(self.chroms)), counts)
+        positions = np.empty(n, dtype=np.int64)
+        start = 0
+        for (_, length), count in zip(self.chroms, counts.tolist()):
+            if count > length:
+                raise ValueError('Too many variants for the chromosome length')
+            gaps = rand.random_sample(count) + 1e-9
+            # Cumulative random gaps give sorted positions; the rank keeps them unique
+            scaled = np.floor(np.cumsum(gaps) / gaps.sum() * (length - count)).astype(np.int64)
+            positions[start:start + count] = scaled + np.arange(1, count + 1)
+            start += count
+
+        alleles = np.array([rand.choice(4, 2, replace=False) for _ in range(16)])
+        allele_pairs = alleles[rand.randint(0, 16, n)]
+        ref, alt = _BASES[allele_pairs[:, 0]], _BASES[allele_pairs[:, 1]]
+
+        # Null pvalues, plus peaks that fall off with distance from the center
+        neg_log_pvalue = -np.log10(1 - rand.random_sample(n))
+        for center in rand.randint(0, n, self.num_peaks if n else 0).tolist():
+            same_chrom = chrom_codes == chrom_codes[center]
+            distance = np.abs(positions - positions[center])
+            in_peak = same_chrom & (distance < self.peak_width)
+            strength = self.peak_neg_log_pvalue * (1 - distance[in_peak] / self.peak_width)
+            neg_log_pvalue[in_peak] = np.maximum(neg_log_pvalue[in_peak], strength * rand.uniform(0.5, 1.0))
+        pvalue = 10 ** -neg_log_pvalue
+        underflow = rand.random_sample(n) < self.underflow_rate
+        pvalue[underflow] = 0
+        neg_log_pvalue[underflow] = math.inf
+
+        self._arrays = {
+            'chrom': np.array([name for name, _ in self.chroms])[chrom_codes],
+            'pos': positions,
+            'ref': ref,
+            'alt': alt,
+            'pvalue': pvalue,
+            'neg_log_pvalue': neg_log_pvalue,
+        }
+        if self.with_af:
+            self._arrays['alt_allele_freq'] = np.round(rand.uniform(0.001, 0.999, n), 3)
+        return self._arrays
+
+    def variants(self) -> ty.Iterator[BasicVariant]:
+        """The data as zorp variants, in file order"""
+        arrays = self.arrays()
+        afs = arrays['alt_allele_freq'].tolist() if self.with_af else [None] * self.num_variants
+        for chrom, pos, ref, alt, neg_log_pvalue, af in zip(arrays['chrom'].tolist(), arrays['pos'].tolist(),
+                                                            arrays['ref'].tolist(), arrays['alt'].tolist(),
+                                                            arrays['neg_log_pvalue'].tolist(), afs):
+            yield BasicVariant(chrom, pos, None, ref, alt, neg_log_pvalue, None, None, af)
+
+    def write(self, path: str, *, chunk_size: int = 100_000) -> str:
+        """Write a tab-delimited file with a header row (gzip compressed if the name ends in .gz)"""
+        arrays = self.arrays()
+        columns = ['chrom', 'pos', 'ref', 'alt', 'pvalue'] + (['alt_allele_freq'] if self.with_af else [])
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wt') as f:
+            f.write('#' + '\t'.join(columns) + '\n')
+            for start in range(0, self.num_variants, chunk_size):
+                chunk = [arrays[name][start:start + chunk_size].tolist() for name in columns]
+                chunk[4] = ['{:.6g}'.format(pvalue) for pvalue in chunk[4]]
+                f.writelines('\t'.join(map(str, row)) + '\n' for row in zip(*chunk))
+        return path
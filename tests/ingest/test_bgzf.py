@@ -0,0 +1,51 @@
+"""Tests of the single-pass BGZF writer and tabix index"""
+import gzip
+import os
+import random
+
+import pysam
+from zorp.parsers import BasicVariant
+
+from util.ingest import bgzf, helpers
+
+from .synthetic import SyntheticGwas
+
+
+def _write_with_pysam(variants, path):
+    """The normalized file, as written by zorp (plain text, then compressed and indexed by pysam)"""
+    with open(path, 'w') as f:
+        f.write('#' + '\t'.join(helpers.NORMALIZED_COLUMNS) + '\n')
+        for variant in variants:
+            f.write('\t'.join('.' if getattr(variant, name) is None else str(getattr(variant, name))
+                              for name in helpers.NORMALIZED_COLUMNS) + '\n')
+    return pysam.tabix_index(path, force=True, preset='vcf')
+
+
+class TestWriteTabixed:
+    def test_matches_bgzip_and_tabix(self, tmpdir):
+        variants = list(SyntheticGwas(20_000, chroms=[('1', 5_000_000), ('2', 800_000), ('X', 3_000_000)]).variants())
+        # Long alleles span several windows of the index, and a very long allele spans several blocks of the file
+        variants[100] = BasicVariant('1', variants[100].pos, None, 'A' * 50_000, 'C', 1.0, None, None, None)
+        variants[200] = BasicVariant('1', variants[200].pos, None, 'G' * 100_000, 'T', 1.0, None, None, None)
+
+        expected_path = _write_with_pysam(variants, os.path.join(tmpdir, 'expected.txt'))
+        actual_path = bgzf.write_tabixed(variants, os.path.join(tmpdir, 'actual.txt.gz'), helpers.NORMALIZED_COLUMNS,
+                                         threads=2)
+
+        with gzip.open(expected_path, 'rb') as expected, gzip.open(actual_path, 'rb') as actual:
+            assert actual.read() == expected.read(), 'Same contents'
+
+        expected_tabix, actual_tabix = pysam.TabixFile(expected_path), pysam.TabixFile(actual_path)
+        assert actual_tabix.contigs == expected_tabix.contigs
+        rand = random.Random(1)
+        for _ in range(500):
+            chrom = rand.choice(expected_tabix.contigs)
+            start = rand.randint(0, 5_000_000)
+            end = start + rand.choice([1, 1_000, 50_000, 1_000_000])
+            assert list(actual_tabix.fetch(chrom, start, end)) == list(expected_tabix.fetch(chrom, start, end)), \
+                'Same rows found by a region query'
+
+    def test_single_thread(self, tmpdir):
+        variants = list(SyntheticGwas(100, chroms=[('1', 10_000)]).variants())
+        path = bgzf.write_tabixed(variants, os.path.join(tmpdir, 'out.txt.gz'), helpers.NORMALIZED_COLUMNS, threads=1)
+        assert len(list(pysam.TabixFile(path).fetch('1'))) == 100
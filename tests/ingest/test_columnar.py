@@ -0,0 +1,102 @@
+"""Tests of the columnar copy of the normalized file"""
+import math
+import os
+import random
+
+import pytest
+from zorp import parsers, sniffers
+from zorp.parsers import BasicVariant
+
+from util.ingest import columnar, exceptions, processors, sources
+
+from .synthetic import SyntheticGwas
+from .test_bgzf import _write_with_pysam
+from .test_processors import SAMPLE_FILE
+
+
+def _as_dicts(variants):
+    return [variant.to_dict() for variant in variants]
+
+
+def _write_store(variants, folder):
+    writer = columnar.ColumnarWriter(folder)
+    try:
+        for variant in variants:
+            writer(variant)
+        writer.finish()
+    finally:
+        writer.close()
+    return columnar.ColumnarStore(folder)
+
+
+class TestColumnarStore:
+    def test_same_rows_as_tabix(self, tmpdir):
+        variants = list(SyntheticGwas(20_000, chroms=[('1', 5_000_000), ('2', 800_000), ('X', 3_000_000)]).variants())
+        # Long alleles overlap regions that start after them; some values are missing, and some pvalues underflow
+        variants[100] = BasicVariant('1', variants[100].pos, 'rs100', 'A' * 5_000, 'C', 1.0, 0.5, 0.1, None)
+        variants[200] = BasicVariant('1', variants[200].pos, None, None, None, None, None, None, 0.2)
+        variants[-1] = BasicVariant('X', variants[-1].pos, 'rs300', 'G', 'GTTT', math.inf, -0.5, 0.1, 0.3)
+        tabix_path = _write_with_pysam(variants, os.path.join(tmpdir, 'normalized.txt'))
+        tabix = sniffers.guess_gwas_standard(tabix_path).add_filter('neg_log_pvalue')
+        store = _write_store(variants, os.path.join(tmpdir, 'columns'))
+
+        assert store.chroms == ['1', '2', 'X']
+        rand = random.Random(1)
+        regions = [('1', variants[100].pos + 100, variants[100].pos + 200),
+                   ('1', variants[200].pos - 1, variants[200].pos),
+                   ('X', variants[-1].pos - 1, variants[-1].pos)]
+        for _ in range(500):
+            start = rand.randint(0, 5_000_000)
+            regions.append((rand.choice(store.chroms), start, start + rand.choice([1, 1_000, 50_000, 500_000])))
+        for chrom, start, end in regions:
+            assert _as_dicts(store.fetch(chrom, start, end).variants()) == _as_dicts(tabix.fetch(chrom, start, end)), \
+                'Same rows found by a region query'
+
+    def test_region_columns(self, tmpdir):
+        variants = [
+            BasicVariant('1', 10, 'rs1', 'A', 'C', 2.0, None, None, None),
+            BasicVariant('1', 20, None, 'A', 'G', 3.0, 0.5, 0.1, 0.25),
+            BasicVariant('1', 30, 'rs3', 'C', 'A', None, None, None, None),
+        ]
+        region = _write_store(variants, os.path.join(tmpdir, 'columns')).fetch('1', 0, 100)
+        assert len(region) == 2, 'Rows without a pvalue are excluded'
+        assert region.pos.tolist() == [10, 20]
+        assert region.neg_log_pvalue.tolist() == [2.0, 3.0]
+        assert math.isnan(region.beta[0]) and region.beta[1] == 0.5
+        assert region.ref == ['A', 'A']
+        assert region.alt == ['C', 'G']
+        assert region.rsid == ['rs1', None]
+
+    def test_unknown_chrom_is_empty(self, tmpdir):
+        store = _write_store([BasicVariant('1', 10, None, 'A', 'C', 2.0, None, None, None)],
+                             os.path.join(tmpdir, 'columns'))
+        region = store.fetch('22', 0, 1_000)
+        assert len(region) == 0
+        assert list(region.variants()) == []
+
+    def test_written_during_normalization(self, tmpdir):
+        parser = parsers.GenericGwasLineParser(chrom_col=1, pos_col=2, ref_col=3, alt_col=4, pvalue_col=5)
+        reader = sniffers.guess_gwas_generic(sources.ReadAheadLineSource(SAMPLE_FILE), parser=parser, skip_errors=True)
+        dest_path = os.path.join(tmpdir, 'normalized.txt.gz')
+        columnar_path = os.path.join(tmpdir, 'columns')
+
+        assert processors.validate_and_normalize(reader, dest_path, 'GRCh38', columnar_path=columnar_path)
+        assert sorted(os.listdir(tmpdir)) == ['columns', 'normalized.txt.gz', 'normalized.txt.gz.tbi'], \
+            'Temp files removed'
+        assert columnar.ColumnarStore.exists(columnar_path)
+
+        store = columnar.ColumnarStore(columnar_path)
+        tabix = sniffers.guess_gwas_standard(dest_path).add_filter('neg_log_pvalue')
+        for chrom in store.chroms:
+            assert _as_dicts(store.fetch(chrom, 0, 300_000_000).variants()) == \
+                _as_dicts(tabix.fetch(chrom, 0, 300_000_000))
+
+    def test_not_written_for_invalid_file(self, tmpdir):
+        lines = ['#chrom\tpos\tref\talt\tpvalue\n', '1\t200\tA\tC\t0.5\n', '1\t100\tA\tC\t0.5\n']
+        parser = parsers.GenericGwasLineParser(chrom_col=1, pos_col=2, ref_col=3, alt_col=4, pvalue_col=5)
+        reader = sniffers.guess_gwas_generic(lines, parser=parser, skip_errors=True)
+        columnar_path = os.path.join(tmpdir, 'columns')
+        with pytest.raises(exceptions.UnsortedDataException):
+            processors.validate_and_normalize(reader, os.path.join(tmpdir, 'normalized.txt.gz'), 'GRCh38',
+                                              columnar_path=columnar_path)
+        assert os.listdir(tmpdir) == [], 'No partial store left behind'
@@ -0,0 +1,49 @@
+"""Tests of nearest gene annotation"""
+import random
+
+from genelocator import GeneLocator
+import genelocator.exception as gene_exc
+
+from util.ingest import genes
+
+
+def _make_genes(num_genes, seed=1):
+    rand = random.Random(seed)
+    rv = []
+    for i in range(num_genes):
+        start = rand.randint(1, 1_000_000)
+        rv.append({'chrom': rand.choice(['1', '2']), 'start': start, 'end': start + rand.randint(1, 50_000),
+                   'ensg': f'ENSG{i:05}', 'symbol': f'GENE{i}'})
+    return rv
+
+
+class TestGeneIndex:
+    def test_matches_gene_locator(self):
+        gene_list = _make_genes(200)
+        locator = GeneLocator(gene_list)
+        index = genes.GeneIndex(gene_list)
+
+        rand = random.Random(2)
+        variants = [{'chrom': rand.choice(['1', 'chr2', '3']), 'pos': rand.randint(1, 1_100_000)}
+                    for _ in range(2000)]
+        index.annotate(variants)
+
+        for variant in variants:
+            try:
+                expected = [{'symbol': gene['symbol'], 'ensg': gene['ensg']}
+                            for gene in locator.at(variant['chrom'], variant['pos'])]
+            except (gene_exc.BadCoordinateException, gene_exc.NoResultsFoundException, KeyError):
+                expected = []
+            assert variant['nearest_genes'] == expected, f'Same genes for {variant}'
+
+    def test_returns_overlapping_genes_by_start(self):
+        index = genes.GeneIndex([
+            {'chrom': 'chr1', 'start': 50, 'end': 200, 'ensg': 'ENSG2', 'symbol': 'LATE'},
+            {'chrom': 'chr1', 'start': 10, 'end': 100, 'ensg': 'ENSG1', 'symbol': 'EARLY'},
+        ])
+        assert index.nearest_genes('1', [75, 20, 150, 500]) == [
+            [{'symbol': 'EARLY', 'ensg': 'ENSG1'}, {'symbol': 'LATE', 'ensg': 'ENSG2'}],
+            [{'symbol': 'EARLY', 'ensg': 'ENSG1'}],
+            [{'symbol': 'LATE', 'ensg': 'ENSG2'}],
+            [{'symbol': 'LATE', 'ensg': 'ENSG2'}],
+        ], 'Positions can be given in any order'
@@ -0,0 +1,180 @@
+"""Tests of the pool of open tabix files"""
+import os
+import shutil
+
+import pytest
+
+from util.ingest import handles
+
+from .synthetic import SyntheticGwas
+from .test_bgzf import _write_with_pysam
+from .test_columnar import _write_store
+
+
+@pytest.fixture
+def tabix_paths(tmpdir):
+    first = _write_with_pysam(SyntheticGwas(100, chroms=[('1', 10_000)]).variants(),
+                              os.path.join(tmpdir, 'first.txt'))
+    second = _write_with_pysam(SyntheticGwas(100, chroms=[('2', 10_000)], seed=2).variants(),
+                               os.path.join(tmpdir, 'second.txt'))
+    return first, second
+
+
+class TestTabixPool:
+    def test_reuses_open_file(self, tabix_paths):
+        path, _ = tabix_paths
+        pool = handles.TabixPool(max_open=2)
+        with pool.open(path) as tabix:
+            expected = list(tabix.fetch('1', 0, 5_000))
+        with pool.open(path) as again:
+            assert again is tabix, 'Same handle used for the next request'
+            assert list(again.fetch('1', 0, 5_000)) == expected
+        assert pool.num_open == 1
+
+    def test_concurrent_requests_get_separate_handles(self, tabix_paths):
+        path, _ = tabix_paths
+        pool = handles.TabixPool(max_open=1)
+        with pool.open(path) as first, pool.open(path) as second:
+            assert first is not second
+            assert pool.num_open == 2
+        assert pool.num_open == 1, 'Handles beyond the limit are closed when returned'
+        assert pool.num_idle == 1
+
+    def test_evicts_least_recently_used(self, tabix_paths):
+        first_path, second_path = tabix_paths
+        pool = handles.TabixPool(max_open=1)
+        with pool.open(first_path) as first:
+            pass
+        with pool.open(second_path) as second:
+            pass
+        assert pool.num_open == 1
+        with pool.open(second_path) as handle:
+            assert handle is second
+        with pool.open(first_path) as handle:
+            assert handle is not first, 'Oldest file was closed'
+
+    def test_forgets_files_that_are_closed(self, tabix_paths):
+        first_path, second_path = tabix_paths
+        pool = handles.TabixPool(max_open=1)
+        with pool.open(first_path):
+            pass
+        with pool.open(second_path):
+            assert first_path in pool._signatures, 'Tracked while a handle is open'
+        assert list(pool._signatures) == [second_path], 'Evicted file is no longer tracked'
+
+        with pool.open(first_path), pool.open(second_path):
+            pass
+        assert list(pool._signatures) == [first_path], 'Handle beyond the limit closed when returned'
+
+        with pytest.raises(RuntimeError):
+            with pool.open(second_path):
+                raise RuntimeError
+        assert pool.num_open == 1
+        assert list(pool._signatures) == [first_path], 'Handle closed after an error'
+
+    def test_replaced_file_is_reopened(self, tabix_paths):
+        path, other_path = tabix_paths
+        pool = handles.TabixPool(max_open=2)
+        with pool.open(path) as old:
+            pass
+
+        # Re-ingest replaces both files
+        shutil.copy(other_path, f'{path}.new')
+        shutil.copy(f'{other_path}.tbi', f'{path}.tbi.new')
+        os.replace(f'{path}.new', path)
+        os.replace(f'{path}.tbi.new', f'{path}.tbi')
+
+        with pool.open(path) as new:
+            assert new is not old
+            assert new.contigs == ['2']
+        assert pool.num_open == 1, 'Old handle was closed'
+
+    def test_deleted_file(self, tabix_paths):
+        path, _ = tabix_paths
+        pool = handles.TabixPool(max_open=2)
+        with pool.open(path):
+            pass
+        os.remove(path)
+        with pytest.raises(FileNotFoundError):
+            with pool.open(path):
+                pass
+        assert pool.num_open == 0
+
+    def test_invalidate_folder(self, tabix_paths):
+        first_path, _ = tabix_paths
+        pool = handles.TabixPool(max_open=2)
+        for path in tabix_paths:
+            with pool.open(path):
+                pass
+        pool.invalidate(os.path.dirname(first_path))
+        assert pool.num_open == 0
+
+    def test_stopped_generator_returns_handle(self, tabix_paths):
+        path, _ = tabix_paths
+        pool = handles.TabixPool(max_open=2)
+
+        def rows():
+            with pool.open(path) as tabix:
+                yield from tabix.fetch('1')
+
+        iterator = rows()
+        next(iterator)
+        iterator.close()
+        assert pool.num_open == 1
+        assert pool.num_idle == 1, 'Handle can be used again'
+
+
+@pytest.fixture
+def store_folders(tmpdir):
+    folders = [os.path.join(tmpdir, name, 'columns') for name in ('first', 'second')]
+    for folder, chrom in zip(folders, ['1', '2']):
+        _write_store(SyntheticGwas(100, chroms=[(chrom, 10_000)]).variants(), folder)
+    return folders
+
+
+class TestColumnarStorePool:
+    def test_reuses_open_store(self, store_folders):
+        folder, _ = store_folders
+        pool = handles.ColumnarStorePool(max_open=2)
+        store = pool.get(folder)
+        assert store.chroms == ['1']
+        assert pool.get(folder) is store, 'Same store used for the next request'
+        assert len(pool) == 1
+
+    def test_evicts_least_recently_used(self, store_folders):
+        first_folder, second_folder = store_folders
+        pool = handles.ColumnarStorePool(max_open=1)
+        first = pool.get(first_folder)
+        second = pool.get(second_folder)
+        assert len(pool) == 1
+        assert pool.get(second_folder) is second
+        assert pool.get(first_folder) is not first, 'Oldest store was dropped'
+
+    def test_replaced_store_is_reopened(self, store_folders):
+        folder, _ = store_folders
+        pool = handles.ColumnarStorePool(max_open=2)
+        old = pool.get(folder)
+
+        # Re-ingest writes a new store
+        _write_store(SyntheticGwas(100, chroms=[('3', 10_000)]).variants(), folder)
+        new = pool.get(folder)
+        assert new is not old
+        assert new.chroms == ['3']
+        assert len(pool) == 1
+
+    def test_missing_store(self, store_folders):
+        folder, _ = store_folders
+        pool = handles.ColumnarStorePool(max_open=2)
+        pool.get(folder)
+        shutil.rmtree(folder)
+        assert pool.get(folder) is None
+        assert len(pool) == 0
+
+    def test_invalidate_folder(self, store_folders):
+        pool = handles.ColumnarStorePool(max_open=2)
+        for folder in store_folders:
+            pool.get(folder)
+        pool.invalidate(os.path.dirname(store_folders[0]))
+        assert len(pool) == 1, 'Only the store inside the folder was dropped'
+        pool.invalidate(os.path.dirname(os.path.dirname(store_folders[0])))
+        assert len(pool) == 0
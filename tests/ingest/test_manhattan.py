@@ -0,0 +1,120 @@
+"""Tests of Manhattan plot binning"""
+import math
+import random
+
+import numpy as np
+import pytest
+
+from zorp.parsers import BasicVariant
+
+from util.ingest import manhattan
+
+
+def _make_variants(num_variants, seed=1):
+    rand = random.Random(seed)
+    variants = []
+    pos = 0
+    for i in range(num_variants):
+        pos += rand.randint(1, 20_000)
+        # Mostly null, plus some peaks. Strong hits change the qval bin size partway through the file.
+        kind = rand.random()
+        if kind < 0.02:
+            qval = rand.uniform(30, 50)
+        elif kind < 0.1:
+            qval = rand.uniform(5, 25)
+        else:
+            qval = rand.uniform(0, 3)
+        variants.append(BasicVariant('1' if i < num_variants // 2 else '2', pos, None, 'A', 'G', round(qval, 2),
+                                     None, None, None))
+    return variants
+
+
+class TestOccupiedBins:
+    def test_unique_pairs_in_order(self):
+        bins = manhattan.OccupiedBins()
+        bins.add(3, 0.525)
+        bins.add_many(np.array([3, 1, 3, 1]), np.array([0.125, 0.175, 0.525, 0.175]))
+        bins.add(1, 0.025)
+        assert list(bins.items()) == [(1, [0.025, 0.175]), (3, [0.125, 0.525])]
+
+    def test_merges_buffered_pairs(self, monkeypatch):
+        monkeypatch.setattr(manhattan.OccupiedBins, 'FLUSH_SIZE', 4)
+        bins = manhattan.OccupiedBins()
+        for _ in range(3):
+            bins.add_many(np.array([2, 2, 5]), np.array([1.1, 1.3, 1.1]))
+            bins.add(2, math.nan)
+        assert len(bins._pos_bin_ids) == 4, 'Duplicates removed as pairs are merged'
+        assert list(bins.items()) == [(2, [1.1, 1.3, math.inf]), (5, [1.1])], 'NaN is kept once, as infinity'
+
+
+class TestBinner:
+    def test_chunk_size_does_not_change_result(self):
+        variants = _make_variants(5000)
+        one_at_a_time = manhattan.Binner(num_unbinned=50, peak_max_count=20)
+        for variant in variants:
+            one_at_a_time.process_variant(variant)
+        chunked = manhattan.Binner(num_unbinned=50, peak_max_count=20)
+        for start in range(0, len(variants), 700):
+            chunked.process_chunk(variants[start:start + 700])
+
+        assert chunked.get_result() == one_at_a_time.get_result()
+
+    def test_only_loads_variants_that_may_be_shown(self):
+        variants = _make_variants(5000)
+        binner = manhattan.Binner(num_unbinned=50, peak_max_count=20)
+        loaded = []
+
+        def get_variant(row):
+            loaded.append(row)
+            return dict(variants[row].to_dict(), pvalue=variants[row].pvalue)
+
+        binner.process_arrays(np.array([v.chrom for v in variants]),
+                              np.array([v.pos for v in variants]),
+                              np.array([v.neg_log_pvalue for v in variants]),
+                              get_variant)
+        result = binner.get_result()
+
+        assert len(result['unbinned_variants']) == 70, 'Top hits and peaks were found'
+        assert len(loaded) < len(variants) // 2, 'Most variants were binned without creating a dict'
+        assert sum(len(b['qvals']) + len(b['qval_extents']) for b in result['variant_bins']) > 0, 'Created bins'
+
+    def test_bin_size_can_be_fixed_in_advance(self):
+        variants = _make_variants(5000)
+        max_qval = max(v.neg_log_pvalue for v in variants)
+        binner = manhattan.Binner(num_unbinned=50, peak_max_count=20, max_qval=max_qval)
+        binner.process_chunk(variants)
+        result = binner.get_result()
+
+        bin_size = manhattan.get_qval_bin_size(max_qval)
+        assert bin_size == 0.2, 'Bin size suits a folded plot'
+        for b in result['variant_bins']:
+            for qval in b['qvals'] + [q for extent in b['qval_extents'] for q in extent]:
+                assert (qval - bin_size / 2) / bin_size == pytest.approx(round((qval - bin_size / 2) / bin_size)), \
+                    'Every bin uses the same resolution'
+
+    def test_bin_size_uses_fold_threshold(self):
+        assert manhattan.get_qval_bin_size(15) == 0.05
+        assert manhattan.get_qval_bin_size(30) == 0.1
+        assert manhattan.get_qval_bin_size(30, fold_threshold=10) == 0.2
+
+
+class TestPartialBinner:
+    def test_merged_parts_match_a_single_read(self):
+        variants = _make_variants(5000)
+        max_qval = max(v.neg_log_pvalue for v in variants)
+        expected = manhattan.Binner(num_unbinned=50, peak_max_count=20, max_qval=max_qval)
+        expected.process_chunk(variants)
+
+        parts = []
+        for chrom in ('1', '2'):
+            part = manhattan.PartialBinner(num_unbinned=50, peak_max_count=20, max_qval=max_qval)
+            part.process_chunk([v for v in variants if v.chrom == chrom])
+            parts.append(part)
+        parts[0].merge(parts[1])
+
+        assert len(parts[0]._candidates) < len(variants) // 2, 'Most variants were binned right away'
+        assert parts[0].get_result() == expected.get_result(), 'Same result as reading the whole file'
+
+    def test_requires_fixed_bin_size(self):
+        with pytest.raises(ValueError):
+            manhattan.PartialBinner()
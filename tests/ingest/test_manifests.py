@@ -0,0 +1,45 @@
+"""Tests of pipeline stage manifests"""
+import os
+import types
+
+from util.ingest import manifests
+
+
+def _make_manifest(tmpdir, inputs, version=1):
+    output = os.path.join(tmpdir, 'out.json')
+    code = manifests.code_version(types.SimpleNamespace(__name__='some.module', VERSION=version))
+    return manifests.StageManifest(os.path.join(tmpdir, 'stage.manifest.json'), 'stage',
+                                   inputs=inputs, code=code, outputs=[output]), output
+
+
+class TestStageManifest:
+    def test_skips_stage_with_same_inputs(self, tmpdir):
+        manifest, output = _make_manifest(tmpdir, {'raw_sha256': 'abc'})
+        assert not manifest.is_current(), 'Stage has never run'
+        with open(output, 'w') as f:
+            f.write('{}')
+        saved = manifest.save()
+
+        assert saved['outputs']['out.json']['size'] == 2, 'Recorded output size'
+        assert manifests.read_checksums(manifest.path) == {'out.json': manifests.file_checksum(output)}
+        assert _make_manifest(tmpdir, {'raw_sha256': 'abc'})[0].is_current(), 'Same inputs can be skipped'
+
+    def test_reruns_stage_when_anything_changes(self, tmpdir):
+        manifest, output = _make_manifest(tmpdir, {'raw_sha256': 'abc'})
+        with open(output, 'w') as f:
+            f.write('{}')
+        manifest.save()
+
+        assert not _make_manifest(tmpdir, {'raw_sha256': 'def'})[0].is_current(), 'Inputs changed'
+        assert not _make_manifest(tmpdir, {'raw_sha256': 'abc'}, version=2)[0].is_current(), 'Code changed'
+        assert not _make_manifest(tmpdir, None)[0].is_current(), 'Unknown inputs are never skipped'
+        os.remove(output)
+        assert not manifest.is_current(), 'Output is missing'
+
+    def test_invalidate(self, tmpdir):
+        manifest, output = _make_manifest(tmpdir, {'raw_sha256': 'abc'})
+        with open(output, 'w') as f:
+            f.write('{}')
+        manifest.save()
+        manifest.invalidate()
+        assert not manifest.is_current(), 'A stage that is running is not current'
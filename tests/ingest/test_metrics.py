@@ -0,0 +1,24 @@
+"""Tests of resource measurement for ingest steps"""
+from util.ingest import metrics
+
+
+class TestStageMetrics:
+    def test_measures_time_and_memory(self):
+        stage = metrics.StageMetrics()
+        with stage.measure():
+            data = bytearray(50 * 2 ** 20)
+            sum(range(100_000))
+        del data
+
+        assert stage.wall_time > 0, 'Measured elapsed time'
+        assert stage.cpu_time >= 0, 'Measured CPU time'
+        assert stage.peak_rss >= 50 * 2 ** 20, 'Peak memory includes memory used during the step'
+        assert stage.rows_per_second is None, 'Throughput is only known when the step records rows'
+
+        stage.rows = 1000
+        assert stage.as_dict()['rows_per_second'] == 1000 / stage.wall_time
+
+    def test_file_sizes(self, tmpdir):
+        path = tmpdir.join('a.txt')
+        path.write('abc')
+        assert metrics.file_sizes(str(path), str(tmpdir.join('missing.txt'))) == 3, 'Missing files are ignored'
@@ -1,8 +1,12 @@
+import functools
+import json
 import os
+import random
 
+import pytest
 from zorp import parsers, sniffers
 
-from util.ingest import processors
+from util.ingest import exceptions, processors, sources, summarizers, validators
 
 
 # A sample file with enough data to be worth meaningfully processing
@@ -46,3 +50,83 @@ class TestPipelineTasks:
         status = processors.generate_qq(SAMPLE_NORM, expected)
         assert status is True
         assert os.path.isfile(expected), 'QQ data created'
+
+    def test_validates_and_normalizes(self, tmpdir):
+        parser = parsers.GenericGwasLineParser(chrom_col=1, pos_col=2, ref_col=3, alt_col=4, pvalue_col=5)
+        source = sources.ReadAheadLineSource(SAMPLE_FILE)
+        reader = sniffers.guess_gwas_generic(source, parser=parser, skip_errors=True)
+        dest_path = os.path.join(tmpdir, 'normalized.txt.gz')
+
+        status = processors.validate_and_normalize(reader, dest_path, 'GRCh38', debug_mode=True)
+        assert status is True, 'Normalization completed successfully'
+        assert os.path.isfile(dest_path), 'Normalized file written'
+        assert os.path.isfile(f'{dest_path}.tbi'), 'Normalized file was tabix indexed'
+        assert sorted(os.listdir(tmpdir)) == ['normalized.txt.gz', 'normalized.txt.gz.tbi'], 'Temp files removed'
+        assert source.sha256 == processors.get_file_sha256(SAMPLE_FILE), 'Hash computed in the same pass'
+
+    def _normalize_lines(self, lines, tmpdir):
+        parser = parsers.GenericGwasLineParser(chrom_col=1, pos_col=2, ref_col=3, alt_col=4, pvalue_col=5)
+        reader = sniffers.guess_gwas_generic(['#chrom\tpos\tref\talt\tpvalue\n'] + lines, parser=parser,
+                                             skip_errors=True)
+        return processors.validate_and_normalize(reader, os.path.join(tmpdir, 'normalized.txt.gz'), 'GRCh38',
+                                                 columnar_path=os.path.join(tmpdir, 'columns'))
+
+    def test_unsorted_rows_give_validation_message(self, tmpdir):
+        # The only problem is near the end of the file, after many valid rows
+        num_rows = validators.BLOCK_SIZE * 2 + 10
+        lines = [f'1\t{pos}\tA\tC\t0.5\n' for pos in range(1, num_rows)] + ['1\t5\tA\tC\t0.5\n']
+        with pytest.raises(exceptions.UnsortedDataException,
+                           match=f'Position chr1:5 should not follow chr1:{num_rows - 1}'):
+            self._normalize_lines(lines, tmpdir)
+        assert os.listdir(tmpdir) == [], 'No partial files left behind'
+
+    def test_non_contiguous_chroms_give_validation_message(self, tmpdir):
+        lines = ['1\t100\tA\tC\t0.5\n', '2\t100\tA\tC\t0.5\n', '1\t200\tA\tC\t0.5\n']
+        with pytest.raises(exceptions.UnsortedDataException,
+                           match='Chromosomes must be sorted .* Error at position: chr1:200'):
+            self._normalize_lines(lines, tmpdir)
+        assert os.listdir(tmpdir) == [], 'No partial files left behind'
+
+    def test_summarizes_each_chromosome_separately(self, tmpdir):
+        # Chromosomes are fetched via the tabix index, which is created during normalization
+        parser = parsers.GenericGwasLineParser(chrom_col=1, pos_col=2, ref_col=3, alt_col=4, pvalue_col=5)
+        reader = sniffers.guess_gwas_generic(SAMPLE_FILE, parser=parser, skip_errors=True)
+        stats = summarizers.StudyStatsSummarizer()
+        dest_path = os.path.join(tmpdir, 'normalized.txt.gz')
+        processors.validate_and_normalize(reader, dest_path, 'GRCh38', debug_mode=True, consumers=[stats])
+        study_stats = stats.get_result()
+        chroms = summarizers.get_chroms(study_stats)
+        assert len(chroms) > 1, 'Found every chromosome in the file'
+
+        expected = processors.summarize_contents(dest_path,
+                                                 summarizers.make_study_summarizers('GRCh38', study_stats))
+        make_consumers = functools.partial(summarizers.make_study_summarizers, 'GRCh38', study_stats, mergeable=True)
+        actual = processors.summarize_contents_by_chrom(dest_path, make_consumers(), chroms, make_consumers)
+
+        assert actual[0].to_dict() == expected[0].to_dict(), 'Same top hit'
+        assert json.dumps(actual[1:]) == json.dumps(expected[1:]), 'Same QQ and manhattan plot data'
+
+    def test_summarizes_each_chromosome_with_missing_maf(self, tmpdir):
+        # The first variant has MAF, but the first variant of a later chromosome does not
+        rand = random.Random(1)
+        lines = ['#chrom\tpos\tref\talt\tpvalue\taf\n']
+        for chrom in ['1', '2', '3']:
+            for pos in range(1, 2_000):
+                af = 'NA' if pos == 1 and chrom != '1' or rand.random() < 0.1 else f'{rand.random():.3f}'
+                lines.append(f'{chrom}\t{pos}\tA\tC\t{rand.random():.4g}\t{af}\n')
+        parser = parsers.GenericGwasLineParser(chrom_col=1, pos_col=2, ref_col=3, alt_col=4, pvalue_col=5,
+                                               allele_freq_col=6)
+        reader = sniffers.guess_gwas_generic(lines, parser=parser, skip_errors=True)
+        stats = summarizers.StudyStatsSummarizer()
+        dest_path = os.path.join(tmpdir, 'normalized.txt.gz')
+        processors.validate_and_normalize(reader, dest_path, 'GRCh38', debug_mode=True, consumers=[stats])
+        study_stats = stats.get_result()
+        assert study_stats['has_maf'] is True
+
+        expected_qq, = processors.summarize_contents(dest_path, [summarizers.QQSummarizer()])
+        make_consumers = functools.partial(summarizers.make_study_summarizers, 'GRCh38', study_stats,
+                                           summaries=['qq'], mergeable=True)
+        actual_qq, = processors.summarize_contents_by_chrom(dest_path, make_consumers(), ['1', '2', '3'],
+                                                            make_consumers)
+        assert 'by_maf' in actual_qq
+        assert json.dumps(actual_qq) == json.dumps(expected_qq), 'Same QQ plot data as reading the whole file'
@@ -0,0 +1,188 @@
+"""Tests of QQ plot calculations"""
+import collections
+import math
+import random
+
+import numpy as np
+import pytest
+import scipy.stats
+
+from util.ingest import qq
+from util.ingest.exceptions import QQPlotException
+
+
+def _make_qvals(num_variants, seed=1):
+    rand = random.Random(seed)
+    # Mostly null associations, plus a few strong signals that extend past the visible range of the plot
+    qvals = [-math.log10(1 - rand.random()) for _ in range(num_variants)]
+    qvals += [rand.expovariate(0.2) for _ in range(num_variants // 100)]
+    return qvals
+
+
+class TestQvalHistogram:
+    @pytest.mark.parametrize('num_variants', [10, 1000, 50_000])
+    def test_matches_exact_qq(self, num_variants):
+        qvals = _make_qvals(num_variants)
+        exact = qq.make_qq_unstratified([qq.Variant(qval, None) for qval in qvals], include_qq=True)
+
+        histogram = qq.QvalHistogram()
+        histogram.update(qvals)
+        approx = qq.make_qq_unstratified_from_histogram(histogram, include_qq=True)
+
+        assert approx['count'] == exact['count']
+        assert approx['qq']['max_exp_qval'] == exact['qq']['max_exp_qval']
+        # Any difference is bounded: a point can only move to an adjacent bin on the observed axis
+        obs_step = max(obs for _, obs in exact['qq']['bins']) / qq.NUM_BINS
+        for actual, expected in [(approx, exact), (exact, approx)]:
+            for exp_value, obs_value in actual['qq']['bins']:
+                assert any(exp_value == other_exp and abs(obs_value - other_obs) <= obs_step * 1.001
+                           for other_exp, other_obs in expected['qq']['bins'])
+        assert approx['gc_lambda'] == exact['gc_lambda'], 'Exact qvals are kept for genomic control'
+
+    @pytest.mark.parametrize('seed', [1, 2, 3])
+    def test_gc_lambda_within_documented_error(self, seed):
+        # Once there are too many exact qvals to keep, GC lambdas are not expected to match the list-based algorithm
+        #   exactly (see the notes on `QVAL_RESOLUTION`). The quantile used is at most one bucket away from the exact
+        #   one, which bounds the difference in lambda.
+        qvals = sorted(_make_qvals(300_000, seed=seed), reverse=True)
+        exact = qq.make_qq_unstratified([qq.Variant(qval, None) for qval in qvals], include_qq=False)
+
+        histogram = qq.QvalHistogram(exact_limit=1000)
+        histogram.update(qvals)
+        approx = qq.make_qq_unstratified_from_histogram(histogram, include_qq=False)
+
+        assert approx['gc_lambda'].keys() == exact['gc_lambda'].keys()
+        for perc, value in exact['gc_lambda'].items():
+            quantile = float(perc)
+            exact_qval = qvals[int(len(qvals) * quantile)]
+            lowest = qq.gc_value(10 ** -exact_qval, quantile)
+            highest = qq.gc_value(10 ** -(exact_qval + 1 / qq.QVAL_RESOLUTION), quantile)
+            assert (highest - lowest) / lowest < 5.4e-4
+            # Allow for rounding to 5 significant figures
+            assert lowest - 1e-4 <= approx['gc_lambda'][perc] <= highest + 1e-4
+
+    def test_merge_equals_single_histogram(self):
+        qvals = _make_qvals(1000)
+        whole = qq.QvalHistogram()
+        whole.update(qvals)
+
+        first, second = qq.QvalHistogram(), qq.QvalHistogram()
+        first.update(qvals[:300])
+        second.update(qvals[300:])
+        first.merge(second)
+
+        assert len(first) == len(whole)
+        for merged, single in zip(first.descending(), whole.descending()):
+            assert np.array_equal(merged, single)
+
+    def test_keeps_exact_qvals_up_to_limit(self):
+        qvals = _make_qvals(1000)
+        first, second = qq.QvalHistogram(exact_limit=len(qvals)), qq.QvalHistogram(exact_limit=len(qvals))
+        first.update(qvals[:300])
+        second.update(qvals[300:])
+        first.merge(second)
+        assert sorted(first.exact()) == sorted(qvals)
+
+        first.update([1.0])
+        assert first.exact() is None, 'Too many qvals to keep'
+        assert len(first) == len(qvals) + 1
+
+        small, large = qq.QvalHistogram(), qq.QvalHistogram(exact_limit=10)
+        large.update(qvals)
+        small.merge(large)
+        assert small.exact() is None, 'Merged with a histogram that did not keep its qvals'
+
+    def test_buffers_large_updates(self):
+        qvals = _make_qvals(1000)
+        buffered = qq.QvalHistogram()
+        buffered.FLUSH_SIZE = 64
+        for start in range(0, len(qvals), 10):
+            buffered.update(qvals[start:start + 10])
+        whole = qq.QvalHistogram()
+        whole.update(qvals)
+
+        assert len(buffered) == len(whole)
+        for actual, expected in zip(buffered.descending(), whole.descending()):
+            assert np.array_equal(actual, expected)
+
+
+class TestComputeQQ:
+    def test_matches_per_variant_calculation(self):
+        # The per-variant algorithm from PheWeb, which the array-based version must reproduce exactly
+        qvals = sorted(_make_qvals(5000, seed=3), reverse=True)
+        max_exp_qval = -math.log10(0.5 / len(qvals))
+        max_obs_qval = qq._get_max_obs_qval(np.array(qvals), max_exp_qval)
+        expected = set()
+        for i, obs_qval in enumerate(qvals):
+            if obs_qval <= max_obs_qval:
+                exp_bin = int(-math.log10((i + 0.5) / len(qvals)) / max_exp_qval * qq.NUM_BINS)
+                expected.add((exp_bin, int(obs_qval / max_obs_qval * qq.NUM_BINS)))
+
+        assert qq.compute_qq(qvals) == qq._format_qq(expected, max_exp_qval, max_obs_qval)
+
+    @pytest.mark.parametrize('num_variants', [2, 1000, 2.5])
+    def test_confidence_intervals_match_scalar_calculation(self, num_variants):
+        intervals = list(qq.get_confidence_intervals(num_variants))
+        variant_counts = [num_variants - 1] + [2 ** x for x in reversed(range(math.ceil(math.log2(num_variants))))]
+        assert len(intervals) == len(variant_counts)
+        for interval, variant_count in zip(intervals, variant_counts):
+            rv = scipy.stats.beta(variant_count, num_variants - variant_count)
+            assert interval['y_min'] == round(-math.log10(rv.ppf(0.975)), 2)
+            assert interval['y_max'] == round(-math.log10(rv.ppf(0.025)), 2)
+
+
+class TestMafStrata:
+    @pytest.mark.parametrize('num_variants', [2, 5, 1000])
+    def test_matches_sorted_strata(self, num_variants):
+        rand = random.Random(2)
+        variants = [qq.Variant(qval, rand.choice([0.01, 0.05, 0.2, 0.5, None]))
+                    for qval in _make_qvals(num_variants)]
+        exact = qq.make_qq_stratified(variants)
+
+        counts = collections.Counter(v.maf for v in variants)
+        strata = qq.MafStrata(counts.items())
+        histograms = [qq.QvalHistogram() for _ in range(qq.NUM_MAF_RANGES)]
+        for v in variants:
+            histograms[strata.assign(v.maf)].update([v.qval])
+        streamed = qq.make_qq_stratified_from_histograms(strata, histograms)
+
+        for expected, actual in zip(exact, streamed):
+            assert actual['maf_range'] == expected['maf_range']
+            assert actual['count'] == expected['count']
+            if expected['qq']:
+                assert actual['qq']['max_exp_qval'] == expected['qq']['max_exp_qval']
+
+    def test_assigns_chunks_in_file_order(self):
+        rand = random.Random(3)
+        mafs = [rand.choice([0.01, 0.05, 0.2, None]) for _ in range(1000)]
+        counts = collections.Counter(mafs).items()
+
+        one_at_a_time = qq.MafStrata(counts)
+        expected = [one_at_a_time.assign(maf) for maf in mafs]
+        chunked = qq.MafStrata(counts)
+        actual = [stratum for start in range(0, len(mafs), 128)
+                  for stratum in chunked.assign_many(mafs[start:start + 128]).tolist()]
+
+        assert actual == expected
+
+    def test_can_skip_earlier_parts_of_the_file(self):
+        rand = random.Random(4)
+        mafs = [rand.choice([0.01, 0.05, 0.2, None]) for _ in range(1000)]
+        counts = collections.Counter(mafs).items()
+        whole_file = qq.MafStrata(counts)
+        whole_file.assign_many(mafs[:600])
+        expected = whole_file.assign_many(mafs[600:]).tolist()
+
+        later_part = qq.MafStrata(counts)
+        later_part.skip(collections.Counter(mafs[:600]).items())
+        assert later_part.assign_many(mafs[600:]).tolist() == expected
+        with pytest.raises(QQPlotException):
+            later_part.skip([(0.01, 1)])
+
+    def test_rejects_counts_that_do_not_match(self):
+        strata = qq.MafStrata([(0.1, 1)])
+        strata.assign(0.1)
+        with pytest.raises(QQPlotException):
+            strata.assign(0.1)
+        with pytest.raises(QQPlotException):
+            strata.assign(0.2)
@@ -0,0 +1,107 @@
+"""Tests of rsID annotation"""
+import collections
+import os
+import random
+import struct
+
+import lmdb
+import msgpack
+from zorp import lookups
+from zorp.parsers import BasicVariant
+
+from util.ingest import rsids
+
+
+def _make_lookup(path, seed=1):
+    """A small lookup file in the same format as the (very large) dbSNP lookup used by zorp"""
+    rand = random.Random(seed)
+    env = lmdb.open(path, subdir=False, max_dbs=25, map_size=2 ** 26)
+    for chrom in ('1', '2', 'X'):
+        db = env.open_db(bytes(chrom, 'utf8'), integerkey=True)
+        with env.begin(write=True, db=db) as txn:
+            for pos in rand.sample(range(1, 100_000), 5_000):
+                alleles = {'{}/{}'.format(*rand.sample('ACGT', 2)): rand.randint(1, 10 ** 9) for _ in range(2)}
+                txn.put(struct.pack('I', pos), msgpack.packb(alleles))
+    env.close()
+
+
+class TestRsidAnnotator:
+    def test_matches_lookup(self, tmpdir):
+        path = os.path.join(tmpdir, 'rsids.lmdb')
+        _make_lookup(path)
+        finder = lookups.SnpToRsid(path)
+
+        rand = random.Random(2)
+        variants = []
+        for chrom in ('1', '2', '3', 'X'):
+            positions = sorted(rand.randint(1, 101_000) for _ in range(5_000))
+            variants.extend(BasicVariant(chrom, pos, None, *rand.sample('ACGT', 2), 1.0, None, None, None)
+                            for pos in positions)
+        # Rows that are out of order are still found
+        variants.extend(rand.sample(variants, 100))
+
+        expected = [finder(v.chrom, v.pos, v.ref, v.alt) for v in variants]
+        annotator = rsids.RsidAnnotator(finder)
+        actual = [annotator(v) for v in variants]
+        annotator.close()
+
+        assert actual == expected
+        assert annotator.num_found == sum(rsid is not None for rsid in expected) > 0, 'Counted the rsIDs found'
+        assert annotator.num_variants == len(variants), 'Counted every variant'
+
+
+class _CountingCursor:
+    """Wraps an LMDB cursor, and counts the searches"""
+    def __init__(self, cursor, counts):
+        self._cursor = cursor
+        self._counts = counts
+
+    def set_range(self, key):
+        self._counts['set_range'] += 1
+        return self._cursor.set_range(key)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingAnnotator(rsids.RsidAnnotator):
+    def __init__(self, finder):
+        super(_CountingAnnotator, self).__init__(finder)
+        self.counts = collections.Counter()
+
+    def _start_chrom(self, chrom):
+        super(_CountingAnnotator, self)._start_chrom(chrom)
+        if self._cursor is not None:
+            self._cursor = _CountingCursor(self._cursor, self.counts)
+
+
+class TestRsidAnnotatorSearches:
+    def test_steps_through_consecutive_positions(self, tmpdir):
+        path = os.path.join(tmpdir, 'rsids.lmdb')
+        _make_lookup(path)
+        finder = lookups.SnpToRsid(path)
+        with finder.env.begin(db=finder.env.open_db(b'1', integerkey=True)) as txn:
+            record_positions = [struct.unpack('I', key)[0] for key, _ in txn.cursor()]
+
+        # Every record, plus rows between records
+        variants = [BasicVariant('1', pos, None, 'A', 'C', 1.0, None, None, None)
+                    for record_pos in record_positions for pos in (record_pos, record_pos + 1)]
+        annotator = _CountingAnnotator(finder)
+        actual = [annotator(v) for v in variants]
+        annotator.close()
+
+        assert actual == [finder(v.chrom, v.pos, v.ref, v.alt) for v in variants]
+        assert annotator.counts['set_range'] == 1, 'Only the first row of the chromosome needs a search'
+
+    def test_searches_across_large_gaps(self, tmpdir):
+        path = os.path.join(tmpdir, 'rsids.lmdb')
+        _make_lookup(path)
+        finder = lookups.SnpToRsid(path)
+
+        variants = [BasicVariant('1', pos, None, 'A', 'C', 1.0, None, None, None) for pos in (10, 50_000, 99_000)]
+        annotator = _CountingAnnotator(finder)
+        actual = [annotator(v) for v in variants]
+        annotator.close()
+
+        assert actual == [finder(v.chrom, v.pos, v.ref, v.alt) for v in variants]
+        assert annotator.counts['set_range'] == 3, 'A new search for each gap of many records'
@@ -0,0 +1,79 @@
+"""Tests of the external sort for uploads whose rows are out of order"""
+import gzip
+import os
+import random
+
+import pytest
+from zorp import sniffers
+
+from util.ingest import exceptions, processors, sorting, validators
+
+from .synthetic import SyntheticGwas
+
+
+def _shuffled(gwas):
+    variants = list(gwas.variants())
+    random.Random(4).shuffle(variants)
+    return variants
+
+
+def _read_rows(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        return f.readlines()
+
+
+class TestSortVariants:
+    def test_sorts_with_spill_files(self, tmpdir):
+        gwas = SyntheticGwas(2000, chroms=[('1', 100_000), ('10', 100_000), ('2', 100_000), ('X', 100_000)])
+        out_path = os.path.join(tmpdir, 'sorted.txt')
+
+        num_rows = sorting.sort_variants(_shuffled(gwas), out_path, tmp_dir=tmpdir,
+                                         memory_budget=20_000, disk_budget=10 ** 7)
+        assert num_rows == 2000
+
+        # The sorted file can be read (and validated) as a standard file
+        reader = sniffers.guess_gwas_standard(out_path)
+        assert validators.standard_gwas_validator._validate_contents(reader)
+        rows = [(variant.chrom, variant.pos) for variant in sniffers.guess_gwas_standard(out_path)]
+        assert [chrom for chrom, _ in rows[::500]] == ['1', '2', '10', 'X'], 'Chromosomes are in natural order'
+        assert sorted(rows) == sorted((variant.chrom, variant.pos) for variant in gwas.variants())
+
+        assert os.listdir(tmpdir) == ['sorted.txt'], 'Temporary files were removed'
+
+    def test_rejects_invalid_chrom_before_sorting(self, tmpdir):
+        variants = _shuffled(SyntheticGwas(100, chroms=[('1', 10_000)]))
+        variants[50].chrom = 'NOTACHROM'
+        with pytest.raises(exceptions.ValidationException, match='not a valid chromosome name'):
+            sorting.sort_variants(variants, os.path.join(tmpdir, 'sorted.txt'), tmp_dir=tmpdir,
+                                  memory_budget=10 ** 6, disk_budget=10 ** 6)
+
+    def test_limits_temporary_files(self, tmpdir):
+        variants = _shuffled(SyntheticGwas(2000, chroms=[('1', 100_000)]))
+        with pytest.raises(exceptions.ValidationException, match='too large to be sorted'):
+            sorting.sort_variants(variants, os.path.join(tmpdir, 'sorted.txt'), tmp_dir=tmpdir,
+                                  memory_budget=20_000, disk_budget=20_000)
+        assert os.listdir(tmpdir) == [], 'Temporary files were removed'
+
+
+class TestSortAndNormalize:
+    def test_matches_sorted_upload(self, tmpdir):
+        gwas = SyntheticGwas(1000, chroms=[('1', 100_000), ('2', 100_000)], underflow_rate=0.01)
+        sorted_dest = os.path.join(tmpdir, 'sorted.txt.gz')
+
+        # Rows from an unsorted upload end up in the same normalized file as a sorted upload of the same data
+        expected_path = os.path.join(tmpdir, 'expected.txt')
+        sorting.sort_variants(gwas.variants(), expected_path, tmp_dir=tmpdir, memory_budget=10 ** 7, disk_budget=0)
+        processors.validate_and_normalize(sniffers.guess_gwas_standard(expected_path), sorted_dest, 'GRCh38',
+                                          debug_mode=True)
+
+        unsorted_dest = os.path.join(tmpdir, 'unsorted.txt.gz')
+        assert processors.sort_and_normalize(_shuffled(gwas), unsorted_dest, 'GRCh38', debug_mode=True,
+                                             tmp_dir=str(tmpdir), memory_budget=20_000, disk_budget=10 ** 7)
+        assert _read_rows(unsorted_dest) == _read_rows(sorted_dest)
+
+    def test_unsorted_rows_are_detected(self):
+        checker = validators.RowOrderChecker()
+        checker.check('1', 100)
+        with pytest.raises(exceptions.UnsortedDataException):
+            checker.check('1', 99)
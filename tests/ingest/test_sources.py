@@ -0,0 +1,52 @@
+"""Tests of line sources that wrap raw uploads"""
+import gzip
+import os
+import threading
+
+import pytest
+
+from util.ingest import processors, sources
+
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), 'fixtures/gwas.tab')
+SAMPLE_GZ = os.path.join(os.path.dirname(__file__), 'fixtures/gwas.tab.gz')
+
+
+class TestReadAheadLineSource:
+    @pytest.mark.parametrize('path', [SAMPLE_FILE, SAMPLE_GZ])
+    def test_same_lines_as_reading_directly(self, path):
+        with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as f:
+            expected = list(f)
+        source = sources.ReadAheadLineSource(path, batch_size=1024, max_batches=2)
+        assert list(source) == expected
+        assert list(source) == expected, 'Can be read more than once'
+
+    @pytest.mark.parametrize('path', [SAMPLE_FILE, SAMPLE_GZ])
+    def test_hash_matches_standalone_hash(self, path):
+        source = sources.ReadAheadLineSource(path, batch_size=1024, max_batches=2)
+        lines = list(source)
+        assert len(lines) > 1, 'Lines were read from the file'
+        assert source.sha256 == processors.get_file_sha256(path), 'Hash matches a separate read of the file'
+
+    def test_partial_read_has_no_hash(self):
+        # The reader thread can only get one small batch ahead, so it stops long before the end of the file
+        source = sources.ReadAheadLineSource(SAMPLE_GZ, batch_size=100, max_batches=1)
+        iterator = iter(source)
+        next(iterator)
+        iterator.close()
+        with pytest.raises(ValueError):
+            source.sha256  # noqa
+
+    def test_stops_reading_when_caller_stops(self):
+        source = sources.ReadAheadLineSource(SAMPLE_GZ, batch_size=100, max_batches=1)
+        iterator = iter(source)
+        next(iterator)
+        iterator.close()
+        assert not any(thread.name == 'read-ahead' for thread in threading.enumerate()), 'Reader thread has ended'
+
+    def test_reports_read_errors(self, tmpdir):
+        path = os.path.join(tmpdir, 'truncated.gz')
+        with open(SAMPLE_GZ, 'rb') as f, open(path, 'wb') as out:
+            out.write(f.read()[:-100])
+        with pytest.raises(EOFError):
+            list(sources.ReadAheadLineSource(path))
@@ -0,0 +1,41 @@
+"""Tests of the single-pass summary step"""
+import os
+
+from zorp import sniffers
+
+from util.ingest import summarizers
+
+
+SAMPLE_NORM = os.path.join(os.path.dirname(__file__), 'fixtures/gwas.tab.gz')
+
+
+class TestSummarize:
+    def test_fans_out_to_all_summarizers(self):
+        reader = sniffers.guess_gwas_standard(SAMPLE_NORM).add_filter('neg_log_pvalue')
+        consumers = [
+            summarizers.TopHitSummarizer(),
+            summarizers.QQSummarizer(),
+            summarizers.ManhattanSummarizer('GRCh38'),
+        ]
+
+        best_row, qq_data, manhattan_data = summarizers.summarize(reader, consumers, chunk_size=10)
+
+        assert (best_row.chrom, best_row.pos) == ('8', 142477218), 'Found top hit'
+        assert qq_data['overall']['count'] == 89, 'QQ plot saw every variant'
+        assert len(manhattan_data['unbinned_variants']) > 0, 'Manhattan plot has top hits'
+        assert all(summarizer.elapsed > 0 for summarizer in consumers), 'Timing is tracked for every summarizer'
+
+    def test_study_stats_are_available_to_later_steps(self):
+        reader = sniffers.guess_gwas_standard(SAMPLE_NORM).add_filter('neg_log_pvalue')
+        stats = summarizers.StudyStatsSummarizer()
+        reader.add_transform(summarizers.as_transform(stats))
+        max_qval = max(variant.neg_log_pvalue for variant in reader)
+
+        result = stats.get_result()
+        assert sum(count for _, count in result['maf_counts']) == 89, 'Counted every variant'
+        assert result['max_neg_log_pvalue'] == max_qval, 'Found the largest qval'
+
+    def test_summaries_can_be_calculated_separately(self):
+        consumers = summarizers.make_study_summarizers('GRCh38', {}, summaries=['manhattan', 'top_hit'])
+        assert [type(c) for c in consumers] == [summarizers.ManhattanSummarizer, summarizers.TopHitSummarizer], \
+            'Creates only the summarizers requested, in order'
@@ -0,0 +1,32 @@
+"""Tests of the synthetic GWAS data used by benchmarks"""
+import math
+import os
+
+from zorp import parsers, sniffers
+
+from util.ingest import validators
+
+from .synthetic import SyntheticGwas
+
+
+class TestSyntheticGwas:
+    def test_is_deterministic(self):
+        first = [v.to_dict() for v in SyntheticGwas(1000, seed=3).variants()]
+        second = [v.to_dict() for v in SyntheticGwas(1000, seed=3).variants()]
+        assert first == second, 'Same seed gives the same data'
+        assert first != [v.to_dict() for v in SyntheticGwas(1000, seed=4).variants()], 'Seed changes the data'
+
+    def test_writes_a_valid_file(self, tmpdir):
+        gwas = SyntheticGwas(5000, chroms=[('1', 10_000), ('2', 20_000)], num_peaks=2, underflow_rate=0.01)
+        path = gwas.write(os.path.join(tmpdir, 'gwas.txt.gz'))
+
+        parser = parsers.GenericGwasLineParser(**gwas.parser_options)
+        reader = sniffers.guess_gwas_generic(path, parser=parser)
+        assert validators.standard_gwas_validator.validate(path, reader), 'Sorted, and in a supported format'
+
+        variants = list(sniffers.guess_gwas_generic(path, parser=parser))
+        assert len(variants) == 5000
+        assert [v.chrom for v in variants].count('2') == 3333, 'Variants are spread by chromosome length'
+        assert any(math.isinf(v.neg_log_pvalue) for v in variants), 'Some rows have pvalue underflow'
+        assert max(v.neg_log_pvalue for v in variants if not math.isinf(v.neg_log_pvalue)) > 10, 'Has peaks'
+        assert all(v.maf is not None for v in variants), 'Has allele frequencies'
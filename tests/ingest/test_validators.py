@@ -1,4 +1,5 @@
 import os
+import random
 
 import pytest
 
@@ -9,6 +10,7 @@ from util.ingest import (
 from zorp import (
     parsers, sniffers
 )
+from zorp.parsers import BasicVariant
 
 
 class TestStandardGwasValidator:
@@ -83,3 +85,44 @@ class TestStandardGwasValidator:
         reader = sniffers.guess_gwas_generic(sample_fn, parser=parser)
         is_valid = validators.standard_gwas_validator.validate(sample_fn, reader)
         assert is_valid
+
+
+def _first_error(checker: validators.RowOrderChecker, rows) -> str:
+    try:
+        for chrom, pos in rows:
+            checker(BasicVariant(chrom, pos, None, 'A', 'C', 1.0, None, None, None))
+        checker.finish()
+    except val_exc.ValidationException as e:
+        return str(e)
+    return ''
+
+
+def _first_error_in_blocks(rows, block_size: int) -> str:
+    checker = validators.RowOrderChecker()
+    try:
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            checker.check_block([chrom for chrom, _ in block], [pos for _, pos in block])
+        checker.finish()
+    except val_exc.ValidationException as e:
+        return str(e)
+    return ''
+
+
+class TestRowOrderChecker:
+    def test_blocks_give_the_same_errors_as_single_rows(self):
+        rand = random.Random(1)
+        for _ in range(300):
+            # Mostly valid data, with a few rows out of place (and some invalid chroms)
+            rows = [(chrom, pos) for chrom in ['1', '2', 'X'] for pos in sorted(rand.choices(range(1, 30), k=20))]
+            for _ in range(rand.randint(0, 2)):
+                rows.insert(rand.randrange(len(rows)), rand.choice(rows))
+            if rand.random() < 0.2:
+                rows.insert(rand.randrange(len(rows)), ('chr1', 5))
+
+            expected = _first_error(validators.RowOrderChecker(), rows)
+            for block_size in (1, 2, 7, 1000):
+                assert _first_error_in_blocks(rows, block_size) == expected, f'Same result for rows: {rows}'
+
+    def test_requires_data(self):
+        assert _first_error(validators.RowOrderChecker(), []) == 'File must contain at least one row of data'
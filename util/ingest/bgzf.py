@@ -0,0 +1,319 @@
+"""
+Write a bgzip-compressed, tabix-indexed file in a single pass
+
+BGZF is a series of independent gzip blocks (each holding at most 64 KB of data), so the blocks can be compressed in
+    parallel. A location in the file is a "virtual offset": the position of a block in the compressed file, plus a
+    position inside the uncompressed block. The tabix index maps regions of each chromosome to these offsets; it is
+    built as rows are written, so the file is never written out uncompressed (and then read again) just to index it.
+
+The index uses the same settings as `tabix -p vcf`: chrom and pos are the first two columns, and a row spans the
+    length of the ref allele (column 4). See the SAM/tabix specifications for details of both formats.
+"""
+import array
+import collections
+import concurrent.futures
+import operator
+import os
+import struct
+import typing as ty
+import zlib
+
+import numpy as np
+
+# The largest amount of data in one block. (same as htslib, so that a block always fits in 64 KB after compression)
+BLOCK_SIZE = 0xff00
+
+# The empty block that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Number of threads used to compress blocks (compression releases the GIL)
+THREADS = min(4, os.cpu_count() or 1)
+
+# Tabix binning scheme: 6 levels of bins, with the smallest bins (and linear index windows) spanning 16 KB
+_MIN_SHIFT = 14
+_DEPTH = 5
+_META_BIN = 37450
+
+# Rows are indexed in batches of this size (per chromosome), using arrays
+_BATCH_SIZE = 100_000
+
+_HEADER = struct.Struct('<4BI2BH2BHH')
+_TRAILER = struct.Struct('<II')
+
+
+def compress_block(data: bytes, level: int = 6) -> bytes:
+    """Compress up to `BLOCK_SIZE` bytes into a single BGZF block"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER.size + len(payload) + _TRAILER.size
+    if block_size > 0x10000:
+        # Data that can't be compressed is stored as-is, so that the block still fits in 64 KB
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+        block_size = _HEADER.size + len(payload) + _TRAILER.size
+    header = _HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1)
+    return header + payload + _TRAILER.pack(zlib.crc32(data), len(data))
+
+
+def _reg2bin(begs: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """The smallest bin that contains each (0-based, half open) interval"""
+    lasts = ends - 1
+    bins = np.zeros(len(begs), dtype=np.int64)
+    found = np.zeros(len(begs), dtype=bool)
+    level_start = ((1 << (_DEPTH * 3)) - 1) // 7
+    shift = _MIN_SHIFT
+    for level in range(_DEPTH, 0, -1):
+        fits = ~found & (begs >> shift == lasts >> shift)
+        bins[fits] = level_start + (begs[fits] >> shift)
+        found |= fits
+        shift += 3
+        level_start -= 1 << ((level - 1) * 3)
+    return bins
+
+
+class _ChromIndex:
+    """
+    The bins and linear index of one chromosome. Offsets are "block-relative" until `TabixIndex.save`.
+
+    Rows are collected in arrays, and indexed one batch at a time.
+    """
+    def __init__(self):
+        self.bins = collections.OrderedDict()  # type: ty.Dict[int, ty.List[ty.List[int]]]
+        self.linear = np.zeros(0, dtype=np.uint64)  # Unset windows are the largest possible offset
+        self.first_offset = None  # type: ty.Optional[int]
+        self.last_offset = None  # type: ty.Optional[int]
+        self.num_rows = 0
+
+        self._last_bin = None  # type: ty.Optional[int]
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self.begs, self.ends, self.start_offsets, self.end_offsets = (array.array('q') for _ in range(4))
+
+    def finish_batch(self):
+        if not self.begs:
+            return
+        begs = np.maximum(np.frombuffer(self.begs, dtype=np.int64), 0)
+        ends = np.maximum(np.frombuffer(self.ends, dtype=np.int64), begs + 1)
+        start_offsets = np.frombuffer(self.start_offsets, dtype=np.int64).astype(np.uint64)
+        end_offsets = np.frombuffer(self.end_offsets, dtype=np.int64).astype(np.uint64)
+
+        if self.first_offset is None:
+            self.first_offset = int(start_offsets[0])
+        self.last_offset = int(end_offsets[-1])
+        self.num_rows += len(begs)
+
+        # Consecutive rows in the same bin are one chunk of the file (which may continue from the last batch). If a
+        #   chunk starts in the same block where the last chunk of its bin ended, the two are joined, so that the reader
+        #   seeks less often.
+        bins = _reg2bin(begs, ends)
+        run_starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+        run_ends = np.concatenate([run_starts[1:], [len(bins)]]) - 1
+        for bin_number, start, end in zip(bins[run_starts].tolist(), start_offsets[run_starts].tolist(),
+                                          end_offsets[run_ends].tolist()):
+            chunks = self.bins.get(bin_number)
+            if chunks is None:
+                self.bins[bin_number] = [[start, end]]
+            elif bin_number == self._last_bin or chunks[-1][1] >> 16 == start >> 16:
+                chunks[-1][1] = end
+            else:
+                chunks.append([start, end])
+            self._last_bin = bin_number
+
+        # Each window of the linear index has the offset of the first row that overlaps it. Most rows overlap one
+        #   window, but long alleles can overlap several.
+        first_windows, last_windows = begs >> _MIN_SHIFT, (ends - 1) >> _MIN_SHIFT
+        num_extra = last_windows - first_windows
+        extra = np.repeat(np.arange(len(begs)), num_extra)
+        if len(extra):
+            extra_windows = first_windows[extra] + np.arange(1, len(extra) + 1) - \
+                np.repeat(np.cumsum(num_extra) - num_extra, num_extra)
+            windows = np.concatenate([first_windows, extra_windows])
+            offsets = np.concatenate([start_offsets, start_offsets[extra]])
+        else:
+            windows, offsets = first_windows, start_offsets
+        num_windows = int(last_windows.max()) + 1
+        if num_windows > len(self.linear):
+            unset = np.full(num_windows - len(self.linear), np.iinfo(np.uint64).max, dtype=np.uint64)
+            self.linear = np.concatenate([self.linear, unset])
+        np.minimum.at(self.linear, windows, offsets)
+
+        self._reset_batch()
+
+    def finish(self):
+        self.finish_batch()
+        # Windows that no row overlaps start at the next row (so, the offset of the next window that has one)
+        self.linear = np.minimum.accumulate(self.linear[::-1])[::-1]
+
+
+class TabixIndex:
+    """
+    A tabix index, built one row at a time (in file order). Rows must be sorted, with each chromosome contiguous.
+
+    Offsets given to `push` are "block-relative" (see `BgzfWriter`): block number, rather than file position. They are
+        converted to real virtual offsets when the file is complete and all blocks sizes are known.
+    """
+    def __init__(self):
+        self._chroms = collections.OrderedDict()  # type: ty.Dict[str, _ChromIndex]
+        self._current = None  # type: ty.Optional[_ChromIndex]
+        self._current_chrom = None  # type: ty.Optional[str]
+
+    def push(self, chrom: str, beg: int, end: int, start_offset: int, end_offset: int):
+        """Add a row spanning the interval [beg, end) (0-based) of the chromosome"""
+        current = self._current
+        if chrom != self._current_chrom:
+            if chrom in self._chroms:
+                raise ValueError(f'Rows for chromosome {chrom} must be contiguous')
+            if current is not None:
+                current.finish()
+            current = self._current = self._chroms[chrom] = _ChromIndex()
+            self._current_chrom = chrom
+        current.begs.append(beg)
+        current.ends.append(end)
+        current.start_offsets.append(start_offset)
+        current.end_offsets.append(end_offset)
+        if len(current.begs) >= _BATCH_SIZE:
+            current.finish_batch()
+
+    def save(self, out_path: str, block_offsets: ty.Sequence[int]):
+        """Write the index. `block_offsets` is the position of each block in the compressed file."""
+        if self._current is not None:
+            self._current.finish()
+            self._current = self._current_chrom = None
+
+        block_offsets = np.array(block_offsets, dtype=np.uint64)
+
+        def real(offsets) -> np.ndarray:
+            offsets = np.asarray(offsets, dtype=np.uint64)
+            return block_offsets[offsets >> np.uint64(16)] << np.uint64(16) | (offsets & np.uint64(0xffff))
+
+        names = b''.join(chrom.encode('ascii') + b'\0' for chrom in self._chroms)
+        # Preset "vcf": format, column of chrom, begin, and end, meta character, lines to skip
+        parts = [b'TBI\1', struct.pack('<8i', len(self._chroms), 2, 1, 2, 0, ord('#'), 0, len(names)), names]
+        bin_header = struct.Struct('<Ii')
+        for chrom_index in self._chroms.values():
+            chunk_offsets = real([value for chunks in chrom_index.bins.values()
+                                  for chunk in chunks for value in chunk]).astype('<u8').tobytes()
+            parts.append(struct.pack('<i', len(chrom_index.bins) + 1))
+            position = 0
+            for bin_number, chunks in chrom_index.bins.items():
+                size = len(chunks) * 16
+                parts.append(bin_header.pack(bin_number, len(chunks)))
+                parts.append(chunk_offsets[position:position + size])
+                position += size
+            # Statistics about the chromosome, in a "pseudo-bin" (as written by htslib)
+            first_offset, last_offset = real([chrom_index.first_offset, chrom_index.last_offset]).tolist()
+            parts.append(struct.pack('<Ii4Q', _META_BIN, 2, first_offset, last_offset, chrom_index.num_rows, 0))
+
+            parts.append(struct.pack('<i', len(chrom_index.linear)))
+            parts.append(real(chrom_index.linear).astype('<u8').tobytes())
+
+        with BgzfWriter(out_path, threads=1) as writer:
+            writer.write(b''.join(parts))
+
+
+class BgzfWriter:
+    """
+    Write a BGZF file, compressing blocks in parallel. Blocks are always written in order.
+
+    `tell` returns a "block-relative" virtual offset (block number, rather than position in the file), because the size
+        of a block is not known until it has been compressed. `block_offsets` (available after `close`) converts them.
+    """
+    def __init__(self, out_path: str, *, threads: int = THREADS, level: int = 6):
+        self._handle = open(out_path, 'wb')
+        self._level = level
+        self._buffer = bytearray()
+        self._num_blocks = 0
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads) if threads > 1 else None
+        self._pending = collections.deque()  # type: ty.Deque[concurrent.futures.Future]
+        self._max_pending = threads * 4
+
+        self.block_offsets = []  # type: ty.List[int]
+
+    def tell(self) -> int:
+        return self._num_blocks << 16 | len(self._buffer)
+
+    def write(self, data: bytes):
+        """Write data, which may be split across blocks"""
+        while data:
+            space = BLOCK_SIZE - len(self._buffer)
+            self._buffer += data[:space]
+            data = data[space:]
+            if len(self._buffer) >= BLOCK_SIZE:
+                self.flush()
+
+    def flush(self):
+        """Compress the current block (if it has any data)"""
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        self._num_blocks += 1
+        if self._executor is None:
+            self._write_block(compress_block(data, self._level))
+            return
+        self._pending.append(self._executor.submit(compress_block, data, self._level))
+        while len(self._pending) >= self._max_pending or (self._pending and self._pending[0].done()):
+            self._write_block(self._pending.popleft().result())
+
+    def _write_block(self, block: bytes):
+        self.block_offsets.append(self._handle.tell())
+        self._handle.write(block)
+
+    def close(self):
+        try:
+            self.flush()
+            while self._pending:
+                self._write_block(self._pending.popleft().result())
+            self.block_offsets.append(self._handle.tell())
+            self._handle.write(EOF_BLOCK)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_tabixed(rows: ty.Iterable, out_path: str, columns: ty.Sequence[str], *, threads: int = THREADS) -> str:
+    """
+    Write rows (eg parsed variants) as a tab-delimited, bgzip-compressed file at `out_path`, with a tabix index at
+        `{out_path}.tbi`. The file has the same contents as `readers.BaseReader.write` (missing values are `.`).
+
+    Rows must be sorted by position, with all rows of each chromosome together; each row needs `chrom`, `pos`, and `ref`
+    """
+    index = TabixIndex()
+    get_values = operator.attrgetter(*columns)
+    with BgzfWriter(out_path, threads=threads) as writer:
+        # Lines are collected until the block is full. A line never spans two blocks, unless it is longer than a block.
+        block = [('#' + '\t'.join(columns) + '\n').encode('utf-8')]
+        block_used = len(block[0])
+        block_start = writer.tell()
+        for row in rows:
+            line = ('\t'.join(['.' if value is None else str(value) for value in get_values(row)]) + '\n').encode()
+            size = len(line)
+            if block_used + size > BLOCK_SIZE:
+                writer.write(b''.join(block))
+                writer.flush()
+                block, block_used, block_start = [], 0, writer.tell()
+            if size <= BLOCK_SIZE:
+                start = block_start | block_used
+                block.append(line)
+                block_used += size
+                end = block_start | block_used
+            else:
+                # The line starts a new block, and the next line starts after it
+                start = block_start
+                writer.write(line)
+                writer.flush()
+                block_start = end = writer.tell()
+            beg = row.pos - 1
+            index.push(row.chrom, beg, beg + len(row.ref or '.'), start, end)
+        writer.write(b''.join(block))
+    index.save(f'{out_path}.tbi', writer.block_offsets)
+    return out_path
@@ -0,0 +1,347 @@
+"""
+A columnar copy of the normalized GWAS data, for fast region queries
+
+The normalized (tabix-indexed) file is the format for downloads and other tools, but each region query must decompress
+    and parse many rows of text. This store keeps each column of each chromosome in a separate binary file, which is
+    memory-mapped when read: a region is found by binary search on the (sorted) positions, and the numeric columns
+    of the region are slices of the mapped files, without copying or parsing.
+
+Layout (one folder per chromosome, plus `meta.json`, which is written last):
+- Fixed-width arrays, one value per row: `pos` (int64), `neg_log_pvalue`, `beta`, `stderr_beta`, `alt_allele_freq`
+    (float64; missing values are NaN).
+- `ref` and `alt` (int32): codes into a dictionary of the alleles used in the chromosome (missing values are -1).
+    The dictionary is stored as UTF-8 text (`alleles.values`) with the offset of each entry (`alleles.offsets`).
+- `rsid`: the text of each row (`rsid.values`), with offsets (missing values are empty).
+"""
+import json
+import math
+import os
+import shutil
+import typing as ty
+
+import numpy as np
+from zorp.parsers import BasicVariant
+
+
+# Increment when a change alters the layout of the files (see `manifests`)
+VERSION = 1
+
+FLOAT_COLUMNS = ('neg_log_pvalue', 'beta', 'stderr_beta', 'alt_allele_freq')
+
+_DTYPES = {
+    'pos': np.dtype('<i8'),
+    'neg_log_pvalue': np.dtype('<f8'),
+    'beta': np.dtype('<f8'),
+    'stderr_beta': np.dtype('<f8'),
+    'alt_allele_freq': np.dtype('<f8'),
+    'ref': np.dtype('<i4'),
+    'alt': np.dtype('<i4'),
+    'alleles.offsets': np.dtype('<i8'),
+    'rsid.offsets': np.dtype('<i8'),
+}
+
+META_FILENAME = 'meta.json'
+
+# Rows are written to disk in batches of this size, so that memory use does not depend on the size of the file
+_BATCH_SIZE = 100_000
+
+
+def _text(value: ty.Optional[str]) -> ty.Optional[str]:
+    # The normalized file writes missing values as ".", and reads them back as missing (None)
+    return None if value is None or value == '.' else value
+
+
+class _ChromWriter:
+    """Append the rows of one chromosome to its column files"""
+    def __init__(self, folder: str):
+        os.makedirs(folder)
+        self.num_rows = 0
+        self.max_ref_length = 1
+        self._handles = {name: open(os.path.join(folder, name), 'wb')
+                         for name in ('pos', *FLOAT_COLUMNS, 'ref', 'alt', 'alleles.values', 'alleles.offsets',
+                                      'rsid.values', 'rsid.offsets')}
+        self._alleles = {}  # type: ty.Dict[str, int]
+        self._new_alleles = []  # type: ty.List[bytes]
+        self._alleles_size = 0
+        self._rsids_size = 0
+        self._handles['alleles.offsets'].write(np.zeros(1, dtype=_DTYPES['alleles.offsets']).tobytes())
+        self._handles['rsid.offsets'].write(np.zeros(1, dtype=_DTYPES['rsid.offsets']).tobytes())
+        self._rows = []  # type: ty.List[BasicVariant]
+
+    def append(self, variant: BasicVariant):
+        self._rows.append(variant)
+        if len(self._rows) >= _BATCH_SIZE:
+            self.flush()
+
+    def _allele_code(self, allele: ty.Optional[str]) -> int:
+        allele = _text(allele)
+        if allele is None:
+            return -1
+        code = self._alleles.get(allele)
+        if code is None:
+            code = self._alleles[allele] = len(self._alleles)
+            self._new_alleles.append(allele.encode('utf-8'))
+        return code
+
+    def flush(self):
+        rows = self._rows
+        if not rows:
+            return
+        self._rows = []
+        handles = self._handles
+
+        handles['pos'].write(np.array([row.pos for row in rows], dtype=_DTYPES['pos']).tobytes())
+        for name in FLOAT_COLUMNS:
+            values = [getattr(row, name) for row in rows]
+            handles[name].write(np.array([math.nan if value is None else value for value in values],
+                                         dtype=_DTYPES[name]).tobytes())
+
+        refs = [_text(row.ref) for row in rows]
+        self.max_ref_length = max(self.max_ref_length, max(len(ref) if ref else 1 for ref in refs))
+        for name, alleles in (('ref', refs), ('alt', [row.alt for row in rows])):
+            codes = [self._allele_code(allele) for allele in alleles]
+            handles[name].write(np.array(codes, dtype=_DTYPES[name]).tobytes())
+        if self._new_alleles:
+            new_alleles, self._new_alleles = self._new_alleles, []
+            offsets = np.cumsum([len(allele) for allele in new_alleles], dtype=_DTYPES['alleles.offsets'])
+            offsets += self._alleles_size
+            handles['alleles.values'].write(b''.join(new_alleles))
+            handles['alleles.offsets'].write(offsets.tobytes())
+            self._alleles_size = int(offsets[-1])
+
+        rsids = [(_text(row.rsid) or '').encode('utf-8') for row in rows]
+        offsets = np.cumsum([len(rsid) for rsid in rsids], dtype=_DTYPES['rsid.offsets']) + self._rsids_size
+        handles['rsid.values'].write(b''.join(rsids))
+        handles['rsid.offsets'].write(offsets.tobytes())
+        self._rsids_size = int(offsets[-1])
+        self.num_rows += len(rows)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for handle in self._handles.values():
+                handle.close()
+
+
+class ColumnarWriter:
+    """
+    Write the columnar store, one row at a time (in the order of the normalized file). Can be registered directly as a
+        zorp reader transform. The store can only be read after `finish`.
+
+    Rows must be sorted, with each chromosome contiguous. (other checks report unsorted files; such rows are ignored)
+    """
+    def __init__(self, folder: str):
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        self._folder = folder
+        self._chroms = {}  # type: ty.Dict[str, dict]
+        self._current_chrom = None  # type: ty.Optional[str]
+        self._current = None  # type: ty.Optional[_ChromWriter]
+
+    def __call__(self, variant: BasicVariant) -> BasicVariant:
+        chrom = variant.chrom
+        if chrom != self._current_chrom:
+            self._finish_chrom()
+            self._current_chrom = chrom
+            if chrom not in self._chroms:
+                self._current = _ChromWriter(os.path.join(self._folder, chrom))
+        if self._current is not None:
+            self._current.append(variant)
+        return variant
+
+    def _finish_chrom(self):
+        if self._current is not None:
+            self._current.close()
+            self._chroms[self._current_chrom] = {
+                'rows': self._current.num_rows,
+                'max_ref_length': self._current.max_ref_length,
+            }
+            self._current = None
+
+    def finish(self):
+        self._finish_chrom()
+        meta = {'version': VERSION, 'chroms': self._chroms}
+        with open(os.path.join(self._folder, META_FILENAME), 'w') as f:
+            json.dump(meta, f)
+
+    def close(self):
+        """Release open files (eg if the rows could not be written)"""
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+
+def _load(folder: str, name: str, length: int) -> np.ndarray:
+    if not length:
+        return np.zeros(0, dtype=_DTYPES.get(name, np.uint8))
+    return np.memmap(os.path.join(folder, name), dtype=_DTYPES.get(name, np.uint8), mode='r', shape=(length,))
+
+
+def _decode(values: np.ndarray, offsets: np.ndarray) -> ty.List[str]:
+    """Strings from concatenated UTF-8 text, and the offset where each string starts (plus the end of the last)"""
+    offsets = offsets.tolist()
+    if not offsets:
+        return []
+    text = values[offsets[0]:offsets[-1]].tobytes()
+    first = offsets[0]
+    return [text[start - first:end - first].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class Region:
+    """
+    The rows of one region of a chromosome. Numeric columns are arrays (usually, read-only views of the stored files).
+        Missing values are NaN (floats), -1 (allele codes), or None (text, once decoded).
+    """
+    def __init__(self, chrom: str, store: '_ChromColumns', rows: ty.Union[slice, np.ndarray]):
+        self.chrom = chrom
+        self._store = store
+        self._rows = rows  # Usually a slice (so that the columns are views), unless some rows must be skipped
+
+        self.pos = store.pos[rows]
+        self.neg_log_pvalue = store.columns['neg_log_pvalue'][rows]
+        self.beta = store.columns['beta'][rows]
+        self.stderr_beta = store.columns['stderr_beta'][rows]
+        self.alt_allele_freq = store.columns['alt_allele_freq'][rows]
+
+    def __len__(self):
+        return len(self.pos)
+
+    def _alleles(self, name: str) -> ty.List[ty.Optional[str]]:
+        codes = self._store.columns[name][self._rows]
+        if not len(codes):
+            return []
+        unique = np.unique(codes)
+        names = {code: self._store.allele(code) for code in unique.tolist()}
+        return [names[code] for code in codes.tolist()]
+
+    @property
+    def ref(self) -> ty.List[ty.Optional[str]]:
+        return self._alleles('ref')
+
+    @property
+    def alt(self) -> ty.List[ty.Optional[str]]:
+        return self._alleles('alt')
+
+    @property
+    def rsid(self) -> ty.List[ty.Optional[str]]:
+        rows = self._rows
+        offsets = self._store.rsid_offsets
+        if isinstance(rows, slice):
+            rsids = _decode(self._store.rsid_values, offsets[rows.start:rows.stop + 1])
+        else:
+            rsids = [_decode(self._store.rsid_values, offsets[row:row + 2])[0] for row in rows.tolist()]
+        return [rsid or None for rsid in rsids]
+
+    def variants(self) -> ty.Iterator[BasicVariant]:
+        """The rows as zorp variants (the same values as reading the region from the normalized file)"""
+        floats = [[None if math.isnan(value) else value for value in column.tolist()]
+                  for column in (self.neg_log_pvalue, self.beta, self.stderr_beta, self.alt_allele_freq)]
+        for pos, rsid, ref, alt, neg_log_pvalue, beta, stderr_beta, alt_allele_freq in zip(
+                self.pos.tolist(), self.rsid, self.ref, self.alt, *floats):
+            yield BasicVariant(self.chrom, pos, rsid, ref, alt, neg_log_pvalue, beta, stderr_beta, alt_allele_freq)
+
+
+class _ChromColumns:
+    """The memory-mapped files of one chromosome"""
+    def __init__(self, folder: str, num_rows: int, max_ref_length: int):
+        self.num_rows = num_rows
+        self.max_ref_length = max_ref_length
+        self.pos = _load(folder, 'pos', num_rows)
+        self.columns = {name: _load(folder, name, num_rows) for name in (*FLOAT_COLUMNS, 'ref', 'alt')}
+
+        # Offsets of each dictionary entry (or rsid), plus the end of the last one
+        self.allele_offsets = np.fromfile(os.path.join(folder, 'alleles.offsets'), dtype=_DTYPES['alleles.offsets'])
+        self.allele_values = _load(folder, 'alleles.values', int(self.allele_offsets[-1]))
+        self.rsid_offsets = _load(folder, 'rsid.offsets', num_rows + 1)
+        self.rsid_values = _load(folder, 'rsid.values', int(self.rsid_offsets[-1]) if num_rows else 0)
+
+    @classmethod
+    def empty(cls) -> '_ChromColumns':
+        """A chromosome with no rows"""
+        columns = cls.__new__(cls)
+        columns.num_rows = 0
+        columns.max_ref_length = 1
+        columns.pos = np.zeros(0, dtype=_DTYPES['pos'])
+        columns.columns = {name: np.zeros(0, dtype=_DTYPES[name]) for name in (*FLOAT_COLUMNS, 'ref', 'alt')}
+        columns.allele_offsets = np.zeros(1, dtype=_DTYPES['alleles.offsets'])
+        columns.allele_values = np.zeros(0, dtype=np.uint8)
+        columns.rsid_offsets = np.zeros(1, dtype=_DTYPES['rsid.offsets'])
+        columns.rsid_values = np.zeros(0, dtype=np.uint8)
+        return columns
+
+    def allele(self, code: int) -> ty.Optional[str]:
+        if code < 0:
+            return None
+        return _decode(self.allele_values, self.allele_offsets[code:code + 2])[0]
+
+    def ref_lengths(self, rows: slice) -> np.ndarray:
+        # Missing alleles are written as "." (length 1). Only the first entry of `lengths` is ever used for them.
+        codes = self.columns['ref'][rows]
+        lengths = np.concatenate([np.diff(self.allele_offsets), [1]])
+        return np.where(codes < 0, 1, lengths[codes])
+
+
+class ColumnarStore:
+    """
+    Read regions from the columnar store. Files are opened (mapped) the first time that each chromosome is used.
+    """
+    def __init__(self, folder: str):
+        self._folder = folder
+        with open(os.path.join(folder, META_FILENAME), 'r') as f:
+            self._meta = json.load(f)
+        if self._meta.get('version') != VERSION:
+            raise ValueError('Unsupported version of the columnar store')
+        self._chroms = {}  # type: ty.Dict[str, _ChromColumns]
+
+    @staticmethod
+    def exists(folder: str) -> bool:
+        """Whether a complete store is present"""
+        return os.path.isfile(os.path.join(folder, META_FILENAME))
+
+    @property
+    def chroms(self) -> ty.List[str]:
+        return list(self._meta['chroms'])
+
+    def _get_chrom(self, chrom: str) -> ty.Optional[_ChromColumns]:
+        if chrom not in self._chroms:
+            info = self._meta['chroms'].get(chrom)
+            if info is None:
+                return None
+            self._chroms[chrom] = _ChromColumns(os.path.join(self._folder, chrom),
+                                                info['rows'], info['max_ref_length'])
+        return self._chroms[chrom]
+
+    def fetch(self, chrom: str, start: int, end: int) -> Region:
+        """
+        The rows that overlap a region, with the same rules as a tabix query of the normalized file (`fetch(chrom,
+            start, end)`, with 0-based, half-open coordinates): each row spans the length of its ref allele. Rows with
+            no pvalue are excluded.
+
+        A chromosome that is not in the file has no rows.
+        """
+        columns = self._get_chrom(chrom)
+        if columns is None:
+            return Region(chrom, _ChromColumns.empty(), slice(0, 0))
+        pos = columns.pos
+
+        # A row at `pos` spans [pos - 1, pos - 1 + len(ref)). Only rows near the start can begin before the region.
+        first = int(np.searchsorted(pos, start - columns.max_ref_length + 2, side='left'))
+        last = int(np.searchsorted(pos, end, side='right'))
+        first = min(first, last)
+        rows = slice(first, last)  # type: ty.Union[slice, np.ndarray]
+
+        starts_before = int(np.searchsorted(pos, start + 1, side='left')) - first
+        keep = None
+        if starts_before > 0:
+            early = slice(first, first + starts_before)
+            keep = np.ones(last - first, dtype=bool)
+            keep[:starts_before] = pos[early] - 1 + columns.ref_lengths(early) > start
+        missing = np.isnan(columns.columns['neg_log_pvalue'][first:last])
+        if missing.any():
+            keep = ~missing if keep is None else keep & ~missing
+
+        if keep is not None and not keep.all():
+            rows = np.flatnonzero(keep) + first
+        return Region(chrom, columns, rows)
@@ -22,6 +22,11 @@ class ValidationException(BaseIngestException):
     DEFAULT_MESSAGE = 'Validation failed'
 
 
+class UnsortedDataException(ValidationException):
+    # The rows are valid, but out of order. These files can be sorted (see `sorting`).
+    DEFAULT_MESSAGE = 'Data must be sorted by chromosome and position'
+
+
 class ManhattanExeption(BaseIngestException):
     DEFAULT_MESSAGE = 'Could not generate Manhattan plot'
 
@@ -0,0 +1,119 @@
+"""
+Annotate variants with the nearest gene(s)
+
+The gene locator for each build is large (an interval tree of every gene) and slow to load. Instead of loading it for
+    every study and looking up variants one at a time, each process keeps one sorted index of genes per build, and
+    annotates a whole list of variants in a single sorted sweep per chromosome. Results are the same as
+    `GeneLocator.at`.
+"""
+import functools
+import heapq
+import re
+import typing as ty
+
+from genelocator import get_genelocator
+import numpy as np
+
+
+CHROM_PREFIX = re.compile('^chr')
+
+# Increment if the nearest genes could change (eg a new gene dataset). See `manifests`.
+VERSION = 1
+
+
+def _chrom_helper(chrom: str) -> str:
+    """Chromosome names as used by the gene locator, eg chr1 -> 1 and MT -> M"""
+    chrom = CHROM_PREFIX.sub('', chrom)
+    return 'M' if chrom == 'MT' else chrom
+
+
+class _ChromGenes:
+    """The genes on one chromosome, sorted by start and by end (ties are kept in the original order of the genes)"""
+    def __init__(self, starts: ty.List[int], ends: ty.List[int], genes: ty.List[dict]):
+        self.genes = genes
+        self.by_start = np.argsort(starts, kind='stable')
+        self.starts = np.array(starts, dtype=np.int64)[self.by_start]
+        # The end of each gene, in order of start
+        self.ends_by_start = np.array(ends, dtype=np.int64)[self.by_start]
+        self.by_end = np.argsort(ends, kind='stable')
+        self.ends = np.array(ends, dtype=np.int64)[self.by_end]
+
+
+class GeneIndex:
+    """A sorted index of genes on each chromosome, used to find the nearest gene(s) for many positions at once"""
+    def __init__(self, genes: ty.Iterable[dict]):
+        """genes is like [{chrom: "1", start: 123, end: 234, ensg: "ENSG00345", symbol: "ACG4"},...]"""
+        by_chrom = {}  # type: ty.Dict[str, ty.Tuple[list, list, list]]
+        for gene in genes:
+            starts, ends, infos = by_chrom.setdefault(_chrom_helper(gene['chrom']), ([], [], []))
+            starts.append(gene['start'])
+            ends.append(gene['end'])
+            infos.append({'symbol': gene['symbol'], 'ensg': gene['ensg']})
+        self._chroms = {chrom: _ChromGenes(*values) for chrom, values in by_chrom.items()}
+
+    @classmethod
+    def from_locator(cls, locator) -> 'GeneIndex':
+        """Build the index from a `genelocator.GeneLocator`, keeping the genes in their original order"""
+        return cls(
+            {'chrom': chrom, 'start': start, 'end': end, 'ensg': ensg, 'symbol': symbol}
+            for ensg, (chrom, start, end, symbol) in locator._gene_info.items()
+        )
+
+    def nearest_genes(self, chrom: str, positions: ty.Sequence[int]) -> ty.List[ty.List[dict]]:
+        """
+        Find the nearest gene(s) for many positions on one chromosome. Returns one list of genes (`symbol` and
+            `ensg`) per position, in the order given.
+
+        If any genes overlap a position, all are returned (sorted by start). Otherwise, the single closest gene is
+            returned. Unknown chromosomes have no genes.
+        """
+        chrom_genes = self._chroms.get(_chrom_helper(chrom))
+        if chrom_genes is None:
+            return [[] for _ in positions]
+
+        genes = chrom_genes.genes
+        starts, ends = chrom_genes.starts, chrom_genes.ends
+        num_genes = len(starts)
+        positions = np.asarray(positions, dtype=np.int64)
+        # The last gene ending at (or before) each position, and the first gene starting at (or after) it
+        prev_idx = np.searchsorted(ends, positions, side='right') - 1
+        next_idx = np.searchsorted(starts, positions, side='left')
+
+        results = [[] for _ in range(len(positions))]  # type: ty.List[ty.List[dict]]
+        # Sweep through the positions in order, keeping track of the genes that overlap the current position
+        active = []  # type: ty.List[ty.Tuple[int, int]]  # heap of (end, rank by start)
+        next_gene = 0
+        for row in np.argsort(positions, kind='stable').tolist():
+            pos = int(positions[row])
+            while next_gene < num_genes and starts[next_gene] <= pos:
+                heapq.heappush(active, (int(chrom_genes.ends_by_start[next_gene]), next_gene))
+                next_gene += 1
+            while active and active[0][0] <= pos:
+                heapq.heappop(active)
+            if active:
+                results[row] = [genes[chrom_genes.by_start[rank]] for rank in sorted(rank for _, rank in active)]
+                continue
+
+            prev, nxt = int(prev_idx[row]), int(next_idx[row])
+            if nxt < num_genes and (prev < 0 or abs(int(ends[prev]) - pos) >= abs(int(starts[nxt]) - pos)):
+                results[row] = [genes[chrom_genes.by_start[nxt]]]
+            else:
+                results[row] = [genes[chrom_genes.by_end[prev]]]
+        return results
+
+    def annotate(self, variants: ty.Iterable[dict], key: str = 'nearest_genes'):
+        """Add the nearest gene(s) to each variant dict (with `chrom` and `pos`), with one sweep per chromosome"""
+        by_chrom = {}  # type: ty.Dict[str, ty.List[dict]]
+        for variant in variants:
+            by_chrom.setdefault(variant['chrom'], []).append(variant)
+        for chrom, chrom_variants in by_chrom.items():
+            found = self.nearest_genes(chrom, [variant['pos'] for variant in chrom_variants])
+            for variant, nearest in zip(chrom_variants, found):
+                # Each variant gets its own copy, in case the result is modified later
+                variant[key] = [dict(gene) for gene in nearest]
+
+
+@functools.lru_cache(maxsize=None)
+def get_gene_index(build: str) -> GeneIndex:
+    """The gene index for a genome build (all genes, not just coding). Loaded once, then reused by each process."""
+    return GeneIndex.from_locator(get_genelocator(build, coding_only=False))
@@ -0,0 +1,240 @@
+"""
+Keep tabix files (and columnar stores) open between region queries
+
+Opening a tabix file reads its whole index from disk, which can take longer than the query itself for a large study.
+    A pool keeps recently used files open (up to a limit on the number of open files), so that each web process only
+    pays this cost once per file. Columnar stores are kept in the same way, so that each query does not read the
+    metadata and map the column files again.
+"""
+import collections
+import contextlib
+import logging
+import os
+import threading
+import typing as ty
+
+import pysam
+
+from . import columnar
+
+
+logger = logging.getLogger(__name__)
+
+
+def _signature(path: str) -> tuple:
+    """
+    Identify the current version of a file and its index. The ingest pipeline replaces (rather than rewrites) both
+        files, so the inode changes when a study is re-ingested. Raises FileNotFoundError if either file was deleted.
+    """
+    data, index = os.stat(path), os.stat(f'{path}.tbi')
+    return data.st_ino, data.st_mtime_ns, data.st_size, index.st_ino, index.st_mtime_ns
+
+
+class TabixPool:
+    """
+    A bounded pool of open `pysam.TabixFile` handles, keyed by path. Each handle is used by one request at a time
+        (see `open`), and idle handles are closed least-recently-used first.
+
+    Handles are checked against the files on disk before each use, so a handle for a file that has been deleted or
+        replaced (in any process) is never reused.
+
+    The pool does not block: if every handle is in use, another one is opened. Handles beyond `max_open` are closed
+        when they are returned, so the limit can be briefly exceeded under load.
+
+    This is safe for threads, and for greenlets (under gevent, the `threading` lock is patched to be cooperative; no
+        I/O happens while it is held).
+    """
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self._idle = collections.OrderedDict()  # type: ty.OrderedDict[str, ty.List[pysam.TabixFile]]
+        # Only paths with open handles (idle or in use) are tracked
+        self._signatures = {}  # type: ty.Dict[str, tuple]
+        self._in_use = collections.Counter()  # type: ty.Counter[str]
+        self._num_open = 0
+        self._lock = threading.Lock()
+
+    @property
+    def num_open(self) -> int:
+        """Handles that are idle or in use"""
+        return self._num_open
+
+    @property
+    def num_idle(self) -> int:
+        return sum(len(handles) for handles in self._idle.values())
+
+    @contextlib.contextmanager
+    def open(self, path: str) -> ty.Iterator[pysam.TabixFile]:
+        """
+        Borrow an open handle for the tabix-indexed file at `path`. The handle must not be used (eg, by a generator of
+            rows) after the block ends.
+        """
+        try:
+            signature = _signature(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            raise
+
+        with self._lock:
+            stale = []  # type: ty.List[pysam.TabixFile]
+            if self._signatures.get(path) != signature:
+                stale = self._idle.pop(path, [])
+                self._signatures[path] = signature
+            idle = self._idle.get(path)
+            handle = idle.pop() if idle else None
+            if idle is not None and not idle:
+                del self._idle[path]
+            if handle is None:
+                self._num_open += 1  # Reserved before opening, so that concurrent requests count it
+            self._in_use[path] += 1
+        self._close(stale)
+
+        if handle is None:
+            try:
+                handle = pysam.TabixFile(path)
+            except Exception:
+                with self._lock:
+                    self._num_open -= 1
+                    self._release(path)
+                    self._forget_if_closed(path)
+                raise
+
+        try:
+            yield handle
+        except GeneratorExit:
+            # The caller stopped reading early (eg a response that is streamed to a client that has disconnected). The
+            #   handle itself is fine.
+            self._return(path, signature, handle)
+            raise
+        except BaseException:
+            # Don't reuse a handle that may be in an unexpected state
+            with self._lock:
+                self._release(path)
+                self._forget_if_closed(path)
+            self._close([handle])
+            raise
+        self._return(path, signature, handle)
+
+    def _release(self, path: str):
+        """Record that a handle is no longer in use. Must be called with the lock held."""
+        self._in_use[path] -= 1
+        if not self._in_use[path]:
+            del self._in_use[path]
+
+    def _forget_if_closed(self, path: str):
+        """Stop tracking a file once it has no open handles. Must be called with the lock held."""
+        if path not in self._idle and path not in self._in_use:
+            self._signatures.pop(path, None)
+
+    def _return(self, path: str, signature: tuple, handle: pysam.TabixFile):
+        with self._lock:
+            to_close = []
+            self._release(path)
+            if self._signatures.get(path) == signature:
+                self._idle.setdefault(path, []).append(handle)
+                self._idle.move_to_end(path)
+            else:
+                to_close.append(handle)
+            while self._num_open - len(to_close) > self.max_open and self._idle:
+                to_close.append(self._pop_oldest())
+            self._forget_if_closed(path)
+        self._close(to_close)
+
+    def _pop_oldest(self) -> pysam.TabixFile:
+        path, handles = next(iter(self._idle.items()))
+        handle = handles.pop(0)
+        if not handles:
+            del self._idle[path]
+            self._forget_if_closed(path)
+        return handle
+
+    def _close(self, handles: ty.List[pysam.TabixFile]):
+        if not handles:
+            return
+        with self._lock:
+            self._num_open -= len(handles)
+        for handle in handles:
+            try:
+                handle.close()
+            except Exception:
+                logger.exception('Could not close tabix file')
+
+    def invalidate(self, path: str):
+        """
+        Close idle handles for a file (eg, when the study is deleted), or for every file in a folder. Handles that are
+            in use are closed when they are returned.
+        """
+        folder = os.path.join(path, '')
+        with self._lock:
+            paths = [name for name in self._idle if name == path or name.startswith(folder)]
+            stale = [handle for name in paths for handle in self._idle.pop(name)]
+            for name in [name for name in self._signatures if name == path or name.startswith(folder)]:
+                del self._signatures[name]
+        self._close(stale)
+
+    def clear(self):
+        """Close all idle handles"""
+        with self._lock:
+            stale = [handle for handles in self._idle.values() for handle in handles]
+            self._idle.clear()
+            self._signatures.clear()
+        self._close(stale)
+
+
+def _store_signature(folder: str) -> tuple:
+    """
+    Identify the current version of a columnar store. The store is rewritten from scratch when a study is re-ingested,
+        and its metadata is written last. Raises FileNotFoundError if there is no complete store.
+    """
+    meta = os.stat(os.path.join(folder, columnar.META_FILENAME))
+    return meta.st_ino, meta.st_mtime_ns, meta.st_size
+
+
+class ColumnarStorePool:
+    """
+    A bounded pool of open `columnar.ColumnarStore`s, keyed by folder. The least recently used store is dropped once
+        there are more than `max_open`.
+
+    Stores are read-only, so one store can be shared by concurrent requests. As with `TabixPool`, each store is checked
+        against the files on disk before it is used, so a store that has been deleted or replaced is never reused. The
+        column files of a dropped store are unmapped once no request is still using its rows.
+    """
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self._stores = collections.OrderedDict()  # type: ty.OrderedDict[str, ty.Tuple[tuple, columnar.ColumnarStore]]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._stores)
+
+    def get(self, folder: str) -> ty.Optional[columnar.ColumnarStore]:
+        """The store in this folder, or None if there is no (complete) store"""
+        try:
+            signature = _store_signature(folder)
+        except FileNotFoundError:
+            self.invalidate(folder)
+            return None
+
+        with self._lock:
+            signature_and_store = self._stores.get(folder)
+            if signature_and_store is not None and signature_and_store[0] == signature:
+                self._stores.move_to_end(folder)
+                return signature_and_store[1]
+
+        store = columnar.ColumnarStore(folder)
+        with self._lock:
+            self._stores[folder] = (signature, store)
+            self._stores.move_to_end(folder)
+            while len(self._stores) > self.max_open:
+                self._stores.popitem(last=False)
+        return store
+
+    def invalidate(self, path: str):
+        """Drop the store in a folder (eg, when the study is deleted), and any stores inside it"""
+        folder = os.path.join(path, '')
+        with self._lock:
+            for name in [name for name in self._stores if name == path or name.startswith(folder)]:
+                del self._stores[name]
+
+    def clear(self):
+        with self._lock:
+            self._stores.clear()
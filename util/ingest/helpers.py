@@ -12,6 +12,9 @@ from zorp import exceptions as z_exc
 
 logger = logging.getLogger(__name__)
 
+# The columns of the normalized file: all fields of a parsed variant, in the order that zorp writes them
+NORMALIZED_COLUMNS = ('chrom', 'pos', 'rsid', 'ref', 'alt', 'neg_log_pvalue', 'beta', 'stderr_beta', 'alt_allele_freq')
+
 
 def capture_errors(func):
     """
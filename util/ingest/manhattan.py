@@ -5,22 +5,41 @@ Extracted from PheWeb: 2cfaa69
 """
 # NOTE: `qval` means `-log10(pvalue)`
 
-# TODO: optimize binning for fold@20 view.
-#       - if we knew the max_qval before we started (eg, by running qq first), it would be very easy.
-#       - at present, we set qval bin size well for the [0-40] range but not for variants above that.
-# TODO: combine with QQ?
+# Binning is optimized for the fold@20 view: when the largest qval is known before binning starts (eg from stats
+#   gathered during normalization), the qval bin size is chosen once, up front, based on where the y-axis will be
+#   folded. Otherwise, the bin size is adjusted as larger qvals are seen.
 
 import collections
 import heapq
 import logging
 import math
+import typing as ty
 
+import numpy as np
 from zorp.parsers import BasicVariant
 
 
 logger = logging.getLogger(__name__)
 
 
+# The frontend folds the y-axis at this qval, when the largest qval is more than twice this value
+FOLD_THRESHOLD = 20
+
+# Increment whenever a change (eg to `Binner`) alters manhattan.json, so that cached plots are rebuilt (see `manifests`)
+VERSION = 1
+
+
+def get_qval_bin_size(max_qval: float, fold_threshold: float = FOLD_THRESHOLD) -> float:
+    """The qval bin size that suits a y-axis extending up to `max_qval`"""
+    if max_qval > 2 * fold_threshold:
+        # this makes 200 bins for a y-axis extending past 40 (but folded so that the lower half is 0-20)
+        return 0.2
+    elif max_qval > fold_threshold:
+        return 0.1  # this makes 200-400 bins for a y-axis extending up to 20-40.
+    else:
+        return 0.05  # this makes 200 bins for the minimum-allowed y-axis covering 0-10
+
+
 class MaxPriorityQueue:
     """
     .pop() returns the item with the largest priority.
@@ -60,35 +79,179 @@ class MaxPriorityQueue:
     def __len__(self):
         return len(self._q)
 
+    def min_priority(self):
+        """The smallest priority in the queue: any new item must beat this to be kept by `add_and_keep_size`"""
+        return self._q[0][0]
+
     def pop_all(self):
         while self._q:
             yield self.pop()
 
 
+class OccupiedBins:
+    """
+    The occupied bins of one chromosome: unique (position bin, rounded qval) pairs, kept as sorted arrays. New pairs are
+        buffered, and merged in bulk.
+
+    Rounding an infinite qval gives NaN. These are stored as infinity (so that duplicates can be found); neither value
+        is ever shown.
+    """
+    # Number of buffered pairs that triggers a merge into the sorted pairs
+    FLUSH_SIZE = 2 ** 16
+
+    def __init__(self):
+        self._pos_bin_ids = np.empty(0, dtype=np.int64)
+        self._qvals = np.empty(0, dtype=np.float64)
+        self._pending = []  # type: ty.List[ty.Tuple[np.ndarray, np.ndarray]]
+        self._pending_pairs = []  # type: ty.List[ty.Tuple[int, float]]
+        self._num_pending = 0
+
+    def add(self, pos_bin_id: int, qval: float):
+        self._pending_pairs.append((pos_bin_id, qval))
+        self._num_pending += 1
+        if self._num_pending >= self.FLUSH_SIZE:
+            self._flush()
+
+    def add_many(self, pos_bin_ids: np.ndarray, qvals: np.ndarray):
+        self._pending.append((pos_bin_ids, qvals))
+        self._num_pending += len(qvals)
+        if self._num_pending >= self.FLUSH_SIZE:
+            self._flush()
+
+    def update(self, other: 'OccupiedBins'):
+        other._flush()
+        self.add_many(other._pos_bin_ids, other._qvals)
+
+    def items(self) -> ty.Iterator[ty.Tuple[int, ty.List[float]]]:
+        """(position bin, rounded qvals) for each occupied position bin, in increasing order of position"""
+        self._flush()
+        pos_bin_ids = self._pos_bin_ids
+        if not len(pos_bin_ids):
+            return
+        starts = np.flatnonzero(np.concatenate([[True], pos_bin_ids[1:] != pos_bin_ids[:-1]]))
+        ends = np.append(starts[1:], len(pos_bin_ids))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield int(pos_bin_ids[start]), self._qvals[start:end].tolist()
+
+    def _flush(self):
+        if not self._pending and not self._pending_pairs:
+            return
+        if self._pending_pairs:
+            pos_bin_ids, qvals = zip(*self._pending_pairs)
+            self._pending.append((np.array(pos_bin_ids, dtype=np.int64), np.array(qvals, dtype=np.float64)))
+            self._pending_pairs = []
+        pos_bin_ids = np.concatenate([self._pos_bin_ids] + [pos for pos, _ in self._pending])
+        qvals = np.concatenate([self._qvals] + [qvals for _, qvals in self._pending])
+        self._pending = []
+        self._num_pending = 0
+
+        qvals = np.where(np.isnan(qvals), np.inf, qvals)
+        order = np.lexsort((qvals, pos_bin_ids))
+        pos_bin_ids, qvals = pos_bin_ids[order], qvals[order]
+        is_new = np.ones(len(qvals), dtype=bool)
+        is_new[1:] = (pos_bin_ids[1:] != pos_bin_ids[:-1]) | (qvals[1:] != qvals[:-1])
+        self._pos_bin_ids, self._qvals = pos_bin_ids[is_new], qvals[is_new]
+
+
 class Binner:
-    """Manhattan plot binner class"""
+    """
+    Manhattan plot binner class
+
+    Variants are received in chunks of arrays (chrom, pos, qval). Almost all variants are binned, and only need to be
+        rounded and counted, which is done in bulk. The rare variants that might be shown individually (peaks and
+        unbinned variants) are handled one at a time, and only those are ever loaded as a full variant dict. Bins are
+        kept as arrays for each chromosome (see `OccupiedBins`).
+    """
     def __init__(self, *,
                  peak_neg_log_pval_threshold: float = 6.0,
                  peak_sprawl_dist: int = int(200e3),
                  peak_max_count: int = 500,
                  num_unbinned: int = 500,
-                 bin_length: int = int(3e6)):
+                 bin_length: int = int(3e6),
+                 max_qval: float = None,
+                 fold_threshold: float = FOLD_THRESHOLD):
+        """
+        :param max_qval: The largest finite qval in the study, if known in advance. This fixes the qval bin size before
+            any variants are binned, so that all bins use the same resolution.
+        :param fold_threshold: The qval where the frontend folds the y-axis of a tall plot
+        """
         # Instance configuration
         self._peak_neg_log_pval_threshold = peak_neg_log_pval_threshold
         self._peak_sprawl_dist = peak_sprawl_dist
         self._peak_max_count = peak_max_count
         self._num_unbinned = num_unbinned
         self._bin_length = bin_length
+        self._fold_threshold = fold_threshold
+        self._is_bin_size_fixed = max_qval is not None
 
         # Internal storage
         self._peak_best_variant = None
         self._peak_last_chrpos = None
         self._peak_pq = MaxPriorityQueue()
         self._unbinned_variant_pq = MaxPriorityQueue()
-        self._bins = collections.OrderedDict()  # like {<chrom>: {<pos // bin_length>: [{chrom, startpos, qvals}]}}
-        self._qval_bin_size = 0.05  # this makes 200 bins for the minimum-allowed y-axis covering 0-10
+        self._bins = {}  # type: ty.Dict[str, OccupiedBins]
+        self._qval_bin_size = get_qval_bin_size(max_qval if max_qval is not None else 0, fold_threshold)
 
     def process_variant(self, variant: BasicVariant):
+        self.process_chunk([variant])
+
+    def process_chunk(self, variants: ty.Sequence[BasicVariant]):
+        """Process a chunk of variants, in file order"""
+        chroms = np.array([variant.chrom for variant in variants])
+        positions = np.fromiter((variant.pos for variant in variants), dtype=np.int64, count=len(variants))
+        qvals = np.fromiter((variant.neg_log_pvalue for variant in variants), dtype=np.float64, count=len(variants))
+
+        def get_variant(row: int) -> dict:
+            variant = variants[row]
+            variant_dict = variant.to_dict()
+            variant_dict['pvalue'] = variant.pvalue  # derived property
+            return variant_dict
+
+        self.process_arrays(chroms, positions, qvals, get_variant)
+
+    def process_arrays(self, chroms: np.ndarray, positions: np.ndarray, qvals: np.ndarray,
+                       get_variant: ty.Callable[[int], dict]):
+        """
+        Process a chunk of variants, in file order, given as arrays of chrom, pos, and qval (neg_log_pvalue).
+
+        `get_variant(row)` returns the full variant dict for one row of the chunk. It is only called for variants
+            that might appear individually in the final plot (as a peak or an unbinned variant).
+        """
+        if not len(qvals):
+            return
+
+        if self._is_bin_size_fixed:
+            bin_sizes = np.full(len(qvals), self._qval_bin_size)
+        else:
+            # Determine bin size based on variants with finite values (eg not pvalue underflow). Each variant is binned
+            #   using the bin size that was in effect when it was processed, so keep track of the size at every row.
+            #   (pvalue is always finite in the range where the size changes). Sizes are as in `get_qval_bin_size`.
+            fold = self._fold_threshold
+            new_sizes = np.where(qvals > 2 * fold, 0.2, np.where(qvals > fold, 0.1, np.nan))
+            last_change = np.maximum.accumulate(np.where(np.isnan(new_sizes), -1, np.arange(len(qvals))))
+            bin_sizes = np.where(last_change >= 0, new_sizes[last_change], self._qval_bin_size)
+
+        # A variant may be shown individually if it is part of a peak, or if it is stronger than the weakest
+        #   unbinned variant seen so far. All other variants are binned right away.
+        is_binned = (qvals <= self._peak_neg_log_pval_threshold) & (qvals <= self._weakest_unbinned())
+        for row in np.flatnonzero(~is_binned).tolist():
+            # The weakest unbinned variant gets stronger as we go; check again before loading the full variant
+            if qvals[row] <= self._peak_neg_log_pval_threshold and qvals[row] <= self._weakest_unbinned():
+                is_binned[row] = True
+                continue
+            self._qval_bin_size = float(bin_sizes[row])
+            self._process_variant_dict(get_variant(row))
+
+        self._bin_arrays(chroms[is_binned], positions[is_binned], qvals[is_binned], bin_sizes[is_binned])
+        self._qval_bin_size = float(bin_sizes[-1])
+
+    def _weakest_unbinned(self) -> float:
+        """A variant that is not part of a peak will be binned right away, unless it is stronger than this"""
+        if len(self._unbinned_variant_pq) < self._num_unbinned:
+            return -math.inf
+        return self._unbinned_variant_pq.min_priority()
+
+    def _process_variant_dict(self, variant_dict: dict):
         """
         There are 3 types of variants:
           a) If the variant starts or extends a peak and has a stronger pval than the current `peak_best_variant`:
@@ -103,23 +266,6 @@ class Binner:
             weakest pval.
         So, at the end, we'll have `peak_pq`, `unbinned_variant_pq`, and `bins`.
         """
-
-        # TODO: Internally, PheWeb binner relies on the data being mutable.
-        #   Hence the container type defines what fields we use, but internally variants must be represented as dicts.
-        #   This is low hanging fruit for optimization in the future (eg using a mutable, non-slots container
-        #   in the parser by default)
-        variant_dict = variant.to_dict()
-        variant_dict['pvalue'] = variant.pvalue  # derived property
-
-        if not math.isinf(variant_dict['pvalue']):
-            # Determine bin size based on variants with finite values (eg not pvalue underflow)
-            qval = variant_dict['neg_log_pvalue']
-            if qval > 40:
-                # this makes 200 bins for a y-axis extending past 40 (but folded so that the lower half is 0-20)s
-                self._qval_bin_size = 0.2
-            elif qval > 20:
-                self._qval_bin_size = 0.1  # this makes 200-400 bins for a y-axis extending up to 20-40.
-
         if variant_dict['neg_log_pvalue'] > self._peak_neg_log_pval_threshold:  # part of a peak
             if self._peak_best_variant is None:  # open a new peak
                 self._peak_best_variant = variant_dict
@@ -154,18 +300,43 @@ class Binner:
                                                     popped_callback=self._bin_variant)
 
     def _bin_variant(self, variant):
-        chrom_idx = variant['chrom']  # This part differs from PheWeb
-        if chrom_idx not in self._bins:
-            self._bins[chrom_idx] = {}
-        pos_bin_id = variant['pos'] // self._bin_length
-        if pos_bin_id not in self._bins[chrom_idx]:
-            self._bins[chrom_idx][pos_bin_id] = {
-                'chrom': variant['chrom'],
-                'startpos': pos_bin_id * self._bin_length,
-                'qvals': set()
-            }
-        qval = self._rounded(variant['neg_log_pvalue'])
-        self._bins[chrom_idx][pos_bin_id]["qvals"].add(qval)
+        self._add_to_bin(variant['chrom'], variant['pos'] // self._bin_length,
+                         self._rounded(variant['neg_log_pvalue']))
+
+    def _bin_arrays(self, chroms: np.ndarray, positions: np.ndarray, qvals: np.ndarray, bin_sizes: np.ndarray):
+        """Bin many variants at once: same as `_bin_variant`, with the qval bin size that applies to each variant"""
+        if not len(qvals):
+            return
+        pos_bin_ids = positions // self._bin_length
+        with np.errstate(invalid='ignore'):
+            # Same as python `//` (as used by `_rounded`). Infinite qvals give NaN, which is never shown.
+            steps = np.floor_divide(qvals, bin_sizes)
+
+        # Neighboring variants usually share a chromosome, position bin, and qval bin size: handle each run together
+        is_new_run = np.ones(len(qvals), dtype=bool)
+        is_new_run[1:] = ((chroms[1:] != chroms[:-1])
+                          | (pos_bin_ids[1:] != pos_bin_ids[:-1])
+                          | (bin_sizes[1:] != bin_sizes[:-1]))
+        run_starts = np.flatnonzero(is_new_run)
+        rounded = collections.defaultdict(list)  # type: ty.DefaultDict[str, ty.List[ty.Tuple[int, float]]]
+        for start, end in zip(run_starts.tolist(), np.append(run_starts[1:], len(qvals)).tolist()):
+            pos_bin_id = int(pos_bin_ids[start])
+            bin_size = float(bin_sizes[start])
+            # Each distinct qval step only needs to be rounded once (with python `round`, as in `_rounded`)
+            rounded[str(chroms[start])].extend((pos_bin_id, round(step * bin_size + bin_size / 2, 3))
+                                               for step in np.unique(steps[start:end]).tolist())
+        for chrom, pairs in rounded.items():
+            pair_pos_bin_ids, pair_qvals = zip(*pairs)
+            self._chrom_bins(chrom).add_many(np.array(pair_pos_bin_ids, dtype=np.int64),
+                                             np.array(pair_qvals, dtype=np.float64))
+
+    def _chrom_bins(self, chrom: str) -> OccupiedBins:
+        if chrom not in self._bins:
+            self._bins[chrom] = OccupiedBins()
+        return self._bins[chrom]
+
+    def _add_to_bin(self, chrom: str, pos_bin_id: int, qval: float):
+        self._chrom_bins(chrom).add(pos_bin_id, qval)
 
     def get_result(self):
         self.get_result = None  # this can only be called once
@@ -182,16 +353,17 @@ class Binner:
                                    key=(lambda variant: variant['neg_log_pvalue']),
                                    reverse=True)
 
-        # unroll dict-of-dict-of-array `bins` into array `variant_bins`
+        # unroll the occupied bins of each chromosome into array `variant_bins`
         variant_bins = []
-        for chrom_idx in sorted(self._bins.keys()):
-            for pos_bin_id in sorted(self._bins[chrom_idx].keys()):
-                b = self._bins[chrom_idx][pos_bin_id]
-                assert len(b['qvals']) > 0
-                b['qvals'], b['qval_extents'] = self._get_qvals_and_qval_extents(b['qvals'])
-                b['pos'] = int(b['startpos'] + self._bin_length / 2)
-                del b['startpos']
-                variant_bins.append(b)
+        for chrom in sorted(self._bins.keys()):
+            for pos_bin_id, bin_qvals in self._bins[chrom].items():
+                qvals, qval_extents = self._get_qvals_and_qval_extents(bin_qvals)
+                variant_bins.append({
+                    'chrom': chrom,
+                    'qvals': qvals,
+                    'qval_extents': qval_extents,
+                    'pos': int(pos_bin_id * self._bin_length + self._bin_length / 2),
+                })
 
         return {
             'variant_bins': variant_bins,
@@ -230,3 +402,64 @@ class Binner:
             else:
                 rv_qval_extents.append([start, end])
         return (rv_qvals, rv_qval_extents)
+
+
+class PartialBinner(Binner):
+    """
+    Bin one part of a file (eg one chromosome), so that several parts can be binned separately (and in parallel), then
+        merged in file order to give exactly the same result as a `Binner` that read the whole file.
+
+    Peaks and unbinned variants depend on every variant that came earlier in the file, so they cannot be decided for
+        one part in isolation. Instead, each part keeps every variant that *might* be shown individually (candidates),
+        and these are replayed, in file order, once all parts have been merged. A variant that is not part of a peak
+        and is no stronger than the `num_unbinned` strongest (non-peak) variants before it in the same part would also
+        be binned right away by a `Binner` reading the whole file, so it is binned immediately.
+
+    This requires the qval bin size to be fixed in advance (`max_qval`).
+    """
+    def __init__(self, **kwargs):
+        if kwargs.get('max_qval') is None:
+            raise ValueError('Variants can only be binned separately when the qval bin size is fixed')
+        super(PartialBinner, self).__init__(**kwargs)
+        self._binner_options = kwargs
+        self._candidates = []  # type: ty.List[dict]  # in file order
+        self._strongest = np.empty(0)  # The `num_unbinned` strongest variants seen that are not part of a peak
+
+    def process_arrays(self, chroms: np.ndarray, positions: np.ndarray, qvals: np.ndarray,
+                       get_variant: ty.Callable[[int], dict]):
+        if not len(qvals):
+            return
+
+        # The threshold only gets stronger as variants are seen. Update it every few rows, so that few variants are
+        #   kept as candidates while the (initially empty) list of strongest variants fills up.
+        is_peak = qvals > self._peak_neg_log_pval_threshold
+        is_binned = np.zeros(len(qvals), dtype=bool)
+        for start in range(0, len(qvals), self._num_unbinned):
+            end = start + self._num_unbinned
+            weakest = self._strongest.min() if len(self._strongest) >= self._num_unbinned else -math.inf
+            is_binned[start:end] = ~is_peak[start:end] & (qvals[start:end] <= weakest)
+            self._keep_strongest(qvals[start:end][~is_peak[start:end]])
+
+        self._candidates.extend(get_variant(row) for row in np.flatnonzero(~is_binned).tolist())
+        self._bin_arrays(chroms[is_binned], positions[is_binned], qvals[is_binned],
+                         np.full(int(is_binned.sum()), self._qval_bin_size))
+
+    def _keep_strongest(self, qvals: np.ndarray):
+        strongest = np.concatenate([self._strongest, qvals])
+        if len(strongest) > self._num_unbinned:
+            strongest = np.partition(strongest, len(strongest) - self._num_unbinned)[-self._num_unbinned:]
+        self._strongest = strongest
+
+    def merge(self, other: 'PartialBinner'):
+        """Add the state of a binner that saw the variants that come after all variants seen by this one"""
+        for chrom, chrom_bins in other._bins.items():
+            self._chrom_bins(chrom).update(chrom_bins)
+        self._candidates.extend(other._candidates)
+        self._keep_strongest(other._strongest)
+
+    def get_result(self):
+        binner = Binner(**self._binner_options)
+        binner._bins = self._bins
+        for variant_dict in self._candidates:
+            binner._process_variant_dict(variant_dict)
+        return binner.get_result()
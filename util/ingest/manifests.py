@@ -0,0 +1,123 @@
+"""
+Record what each pipeline stage was given and what it produced, so that re-running ingestion can skip the stages whose
+    outputs would not change
+
+Each stage writes a manifest (in the study folder) after it completes. The manifest holds a fingerprint of everything
+    that determines the outputs: the inputs (such as the hash of the raw upload, the parser options, or the checksums of
+    files written by an earlier stage), and the version of the code. It also records the checksum and size of every
+    output file. If a later run of the same stage has the same fingerprint, and the outputs are still on disk, the
+    stage can be skipped.
+
+Cached outputs are invalidated explicitly: each module that affects the outputs of a stage declares a `VERSION`. This
+    must be incremented whenever a change to that module would change the files it writes (eg a change to
+    `manhattan.Binner` that alters manhattan.json). Changes that do not alter outputs (eg speedups, or frontend-only
+    changes) do not require a new version.
+"""
+import hashlib
+import json
+import logging
+import os
+import types
+import typing as ty
+
+
+logger = logging.getLogger(__name__)
+
+
+def code_version(*modules: types.ModuleType) -> dict:
+    """The version of each module that a stage depends on, like {'util.ingest.manhattan': 1}"""
+    return {module.__name__: module.VERSION for module in modules}  # type: ignore
+
+
+def file_checksum(path: str, block_size=2 ** 20) -> str:
+    """The SHA256 of a file (as a hex string)"""
+    shasum_256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            shasum_256.update(data)
+    return shasum_256.hexdigest()
+
+
+class StageManifest:
+    """The manifest for one stage of the pipeline, for one study"""
+    def __init__(self, path: str, stage: str, *, inputs: ty.Optional[dict], code: dict, outputs: ty.Sequence[str]):
+        """
+        :param path: Where to store the manifest
+        :param stage: The name of the stage (for humans)
+        :param inputs: Everything (besides code) that determines the outputs of the stage. Must be JSON-serializable.
+            If the inputs cannot be known in advance, use None: the stage will never be skipped.
+        :param code: The version of the code used by this stage (see `code_version`)
+        :param outputs: Paths to all files written by the stage
+        """
+        self.path = path
+        self.stage = stage
+        self.inputs = inputs
+        self.code = code
+        self.outputs = outputs
+
+    @property
+    def fingerprint(self) -> ty.Optional[str]:
+        if self.inputs is None:
+            return None
+        contents = json.dumps({'stage': self.stage, 'inputs': self.inputs, 'code': self.code}, sort_keys=True)
+        return hashlib.sha256(contents.encode('utf8')).hexdigest()
+
+    def is_current(self) -> bool:
+        """Whether this stage has already run with the same fingerprint, and its outputs are still on disk"""
+        fingerprint = self.fingerprint
+        saved = read(self.path)
+        if fingerprint is None or saved is None or saved.get('fingerprint') != fingerprint:
+            return False
+        for output in self.outputs:
+            expected = saved['outputs'].get(os.path.basename(output))
+            if expected is None or not os.path.isfile(output) or os.path.getsize(output) != expected['size']:
+                return False
+        return True
+
+    def invalidate(self):
+        """Remove the manifest before the stage runs, so that a stage that fails part way is never skipped"""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def save(self) -> dict:
+        """Record the outputs of the stage, after it has completed"""
+        contents = {
+            'stage': self.stage,
+            'fingerprint': self.fingerprint,
+            'inputs': self.inputs,
+            'code': self.code,
+            'outputs': {
+                os.path.basename(output): {'sha256': file_checksum(output), 'size': os.path.getsize(output)}
+                for output in self.outputs
+            },
+        }
+        # Write atomically, so that a partial manifest is never read
+        tmp_path = f'{self.path}.partial'
+        with open(tmp_path, 'w') as f:
+            json.dump(contents, f, indent=2)
+        os.replace(tmp_path, self.path)
+        return contents
+
+
+def read(path: str) -> ty.Optional[dict]:
+    """Read a saved manifest, if there is one"""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        logger.warning('Ignoring an unreadable manifest: %s', path)
+        return None
+
+
+def read_checksums(path: str) -> ty.Optional[dict]:
+    """The checksum of each output file recorded by a saved manifest, like {'qq.json': '...'}; used as inputs to later
+        stages"""
+    saved = read(path)
+    if saved is None:
+        return None
+    return {name: output['sha256'] for name, output in saved['outputs'].items()}
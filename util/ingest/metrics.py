@@ -0,0 +1,100 @@
+"""
+Measure the resources used by each step of the ingest pipeline (time, rows, bytes, and memory)
+
+These measurements are stored in the database by the web app, so that slow steps (or regressions) can be found, and
+    workers can be sized from real uploads.
+"""
+import contextlib
+import os
+import resource
+import time
+import typing as ty
+
+
+def _read_peak_rss() -> int:
+    """The peak resident memory of this process (bytes), since it started or since the last `_reset_peak_rss`"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Linux reports kB; some platforms (macOS) report bytes. This is only used if /proc is not available.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss() -> bool:
+    """
+    Celery workers run many tasks in one process, so the peak since the process started says little about one task.
+        Linux (4.0+) can reset the peak to the current memory use.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _cpu_time() -> float:
+    """CPU time (user + system) of this process, and of any child processes that have finished (eg a process pool)"""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def file_sizes(*paths: str) -> int:
+    """The total size of several files (bytes). Files that do not exist are ignored."""
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+class StageMetrics:
+    """
+    The resources used by one step. Time and memory are measured automatically (see `measure`); the step records
+        what it read and wrote, if it knows.
+    """
+    def __init__(self):
+        self.wall_time = 0.0  # seconds
+        self.cpu_time = 0.0  # seconds
+        # Peak memory use while the step ran (bytes). If the peak cannot be reset, this is the peak since the process
+        #   started.
+        self.peak_rss = None  # type: ty.Optional[int]
+
+        # Set by the step
+        self.rows = None  # type: ty.Optional[int]
+        self.bytes_read = None  # type: ty.Optional[int]
+        self.bytes_written = None  # type: ty.Optional[int]
+        self.skipped = False  # The step had nothing to do (eg the outputs were up to date)
+
+    @contextlib.contextmanager
+    def measure(self):
+        _reset_peak_rss()
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_time()
+        try:
+            yield self
+        finally:
+            self.wall_time = time.perf_counter() - start_wall
+            self.cpu_time = _cpu_time() - start_cpu
+            self.peak_rss = _read_peak_rss()
+
+    @property
+    def rows_per_second(self) -> ty.Optional[float]:
+        if self.rows is None or not self.wall_time:
+            return None
+        return self.rows / self.wall_time
+
+    def as_dict(self) -> dict:
+        return {
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'rows': self.rows,
+            'rows_per_second': self.rows_per_second,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_rss': self.peak_rss,
+            'skipped': self.skipped,
+        }
@@ -1,28 +1,35 @@
 """
 Steps used to process a GWAS file for future use
 """
+import functools
 import hashlib
 import json
 import logging
-import math
+import os
+import shutil
+import tempfile
+import typing as ty
 
-from genelocator import get_genelocator
-import genelocator.exception as gene_exc
 from zorp import (
-    lookups,
     readers,
     sniffers
 )
 
-from . exceptions import TopHitException
 from . import (
+    bgzf,
+    columnar,
     helpers,
-    manhattan,
-    qq
+    rsids,
+    sorting,
+    summarizers,
+    validators,
 )
 
 logger = logging.getLogger(__name__)
 
+# The format of the normalized file and ingest stats. Increment when a change alters either (see `manifests`).
+VERSION = 1
+
 
 @helpers.capture_errors
 def get_file_sha256(src_path, block_size=2 ** 20) -> bytes:
@@ -39,86 +46,175 @@ def get_file_sha256(src_path, block_size=2 ** 20) -> bytes:
 
 
 @helpers.capture_errors
-def normalize_contents(reader: readers.BaseReader, dest_path: str, build: str, debug_mode=False) -> bool:
+def normalize_contents(reader: readers.BaseReader, dest_path: str, build: str, debug_mode=False, *,
+                       rsid_annotator: rsids.RsidAnnotator = None) -> bool:
     """
     Initial content ingestion: load the file and write variants in a standardized format
 
     This routine will deliberately exclude lines that could not be handled in a reliable fashion, such as pval=NA
 
     In "debug mode", the ingest process will use a smaller (test environment optimized) version of the
-        rsid_finder lookup.
+        rsid_finder lookup. A caller can provide its own `rsid_annotator`, eg to report statistics afterwards.
     """
-    rsid_finder = lookups.SnpToRsid(build, test=debug_mode)
-    reader.add_lookup('rsid', lambda variant: rsid_finder(variant.chrom, variant.pos, variant.ref, variant.alt))
-    reader.write(dest_path, make_tabix=True)
+    if rsid_annotator is None:
+        rsid_annotator = rsids.RsidAnnotator.for_build(build, test=debug_mode)
+    reader.add_lookup('rsid', rsid_annotator)
+    try:
+        # Compressed and indexed as it is written (the same result as `reader.write(dest_path, make_tabix=True)`)
+        bgzf.write_tabixed(reader, f'{dest_path}.gz', helpers.NORMALIZED_COLUMNS)
+    finally:
+        rsid_annotator.close()
+    logger.info(rsid_annotator.summary())
     # In reality a failing task will usually raise an exception rather than returning False
     return True
 
 
 @helpers.capture_errors
-def generate_manhattan(build: str, in_filename: str, out_filename: str) -> bool:
-    """Generate manhattan plot data for the processed file"""
+def validate_and_normalize(reader: readers.BaseReader, dest_path: str, build: str, debug_mode=False, *,
+                           consumers: ty.Sequence[summarizers.BaseSummarizer] = (),
+                           rsid_annotator: rsids.RsidAnnotator = None,
+                           columnar_path: str = None) -> bool:
+    """
+    Validate and normalize the file contents in a single pass. (if the reader source is a
+        `sources.ReadAheadLineSource`, this same pass also calculates the file hash)
+
+    Rows are written to a temporary file as they are checked. The output is only moved to `dest_path` (along with its
+        tabix index) if the entire file passes validation, so a failed upload never leaves behind a partial file.
+
+    Optionally, summarizers can also be fed from this same pass (eg, to gather stats needed by later steps), and the
+        same rows can be written to a columnar store at `columnar_path` (see `columnar`)
+    """
+    # Rows are checked before any other step sees them
+    checker = validators.RowOrderChecker()
+    reader.add_transform(checker)
+    for summarizer in consumers:
+        reader.add_transform(summarizers.as_transform(summarizer))
+
+    # The writer creates the .gz version of this name internally
+    tmp_path = f'{dest_path}.partial'
+    tmp_gz_path = f'{tmp_path}.gz'
+    tmp_columnar_path = None
+    columnar_writer = None
+    if columnar_path:
+        tmp_columnar_path = f'{columnar_path}.partial'
+        columnar_writer = columnar.ColumnarWriter(tmp_columnar_path)
+        reader.add_transform(columnar_writer)
+    try:
+        normalize_contents(reader, tmp_path, build, debug_mode=debug_mode, rsid_annotator=rsid_annotator)
+        checker.finish()
+        if columnar_writer:
+            columnar_writer.finish()
+            if os.path.isdir(columnar_path):
+                shutil.rmtree(columnar_path)
+            os.replace(tmp_columnar_path, columnar_path)
+        os.replace(f'{tmp_gz_path}.tbi', f'{dest_path}.tbi')
+        os.replace(tmp_gz_path, dest_path)
+    finally:
+        for path in (tmp_path, tmp_gz_path, f'{tmp_gz_path}.tbi'):
+            if os.path.isfile(path):
+                os.remove(path)
+        if columnar_writer:
+            columnar_writer.close()
+            shutil.rmtree(tmp_columnar_path, ignore_errors=True)
+    return True
+
+
+@helpers.capture_errors
+def sort_and_normalize(reader: readers.BaseReader, dest_path: str, build: str, debug_mode=False, *,
+                       tmp_dir: str, memory_budget: int, disk_budget: int,
+                       consumers: ty.Sequence[summarizers.BaseSummarizer] = (),
+                       rsid_annotator: rsids.RsidAnnotator = None,
+                       columnar_path: str = None) -> bool:
+    """
+    Accept a file whose rows are not sorted: sort the parsed rows (see `sorting.sort_variants`), then validate and
+        normalize the sorted rows as usual. The sorted copy is written to `tmp_dir`, and removed afterwards.
+    """
+    fd, sorted_path = tempfile.mkstemp(prefix='sorted-', suffix='.txt', dir=tmp_dir)
+    os.close(fd)
+    try:
+        sorting.sort_variants(reader, sorted_path, tmp_dir=tmp_dir,
+                              memory_budget=memory_budget, disk_budget=disk_budget)
+        return validate_and_normalize(sniffers.guess_gwas_standard(sorted_path), dest_path, build,
+                                      debug_mode=debug_mode, consumers=consumers, rsid_annotator=rsid_annotator,
+                                      columnar_path=columnar_path)
+    finally:
+        os.remove(sorted_path)
+
+
+def _read_normalized(in_filename: str) -> readers.BaseReader:
     # Strong assumption: there are no invalid lines when a file reaches this stage; this operates on normalized data
-    reader = sniffers.guess_gwas_standard(in_filename)\
+    return sniffers.guess_gwas_standard(in_filename)\
         .add_filter('neg_log_pvalue')
 
-    binner = manhattan.Binner()
-    for variant in reader:
-        binner.process_variant(variant)
-
-    manhattan_data = binner.get_result()
-
-    gl = get_genelocator(build, coding_only=False)
-    for v_dict in manhattan_data['unbinned_variants']:
-        # Annotate nearest gene(s) for all "top hits", and also clean up values so JS can handle them
-        # It's possible to have more than one nearest gene for a given position (if variant is inside, not just near)
-        try:
-            nearest_genes = [
-                {
-                    'symbol': res['symbol'],
-                    'ensg': res['ensg']
-                }
-                for res in gl.at(v_dict["chrom"], v_dict["pos"])
-            ]
-        except (gene_exc.BadCoordinateException, gene_exc.NoResultsFoundException):
-            nearest_genes = []
-
-        v_dict['nearest_genes'] = nearest_genes
-
-        if math.isinf(v_dict['neg_log_pvalue']):
-            # JSON has no concept of infinity; use a string that browsers can type-coerce into the correct number
-            v_dict['neg_log_pvalue'] = 'Infinity'
 
+def write_json(data, out_filename: str):
     with open(out_filename, 'w') as f:
-        json.dump(manhattan_data, f)
-    return True
+        json.dump(data, f)
+
+
+def read_json(in_filename: str, default=None):
+    """Read a JSON file written by a previous step, if it exists (studies ingested by older versions may not have it)"""
+    if not os.path.isfile(in_filename):
+        return default
+    with open(in_filename, 'r') as f:
+        return json.load(f)
 
 
 @helpers.capture_errors
-def generate_qq(in_filename: str, out_filename) -> bool:
-    """Largely borrowed from PheWeb code (load.qq.make_json_file)"""
-    # TODO: This step appears to load ALL data into memory (list on generator). This could be a memory hog; not sure if
-    #   there is a way around it as it seems to rely on sorting values
-    reader = sniffers.guess_gwas_standard(in_filename)\
-        .add_filter("neg_log_pvalue")
-
-    # TODO: Pheweb QQ code benefits from being passed { num_samples: n }, from metadata stored outside the
-    #   gwas file. This is used when AF/MAF are present (which at the moment ingest pipeline does not support)
-    variants = list(qq.augment_variants(reader))
-
-    rv = {}
-    if variants:
-        if variants[0].maf is not None:
-            rv['overall'] = qq.make_qq_unstratified(variants, include_qq=False)
-            rv['by_maf'] = qq.make_qq_stratified(variants)
-            rv['ci'] = list(qq.get_confidence_intervals(len(variants) / len(rv['by_maf'])))
-        else:
-            rv['overall'] = qq.make_qq_unstratified(variants, include_qq=True)
-            rv['ci'] = list(qq.get_confidence_intervals(len(variants)))
+def summarize_contents(in_filename: str, consumers: ty.Sequence[summarizers.BaseSummarizer]) -> list:
+    """
+    Generate several summaries of the processed file (top hit, QQ, manhattan...), in a single read of the data.
+
+    Returns the result of each summarizer, in the order given. Each summarizer tracks the time spent on its own work.
+    """
+    return summarizers.summarize(_read_normalized(in_filename), consumers)
+
+
+def _summarize_chrom(in_filename: str,
+                     make_consumers: ty.Callable[[str], ty.Sequence[summarizers.BaseSummarizer]],
+                     chrom: str) -> ty.Sequence[summarizers.BaseSummarizer]:
+    """Summarize one chromosome of the processed file (fetched via the tabix index). May run in a worker process."""
+    consumers = make_consumers(chrom)
+    summarizers.process(_read_normalized(in_filename).fetch(chrom, None, None), consumers)
+    return consumers
+
+
+@helpers.capture_errors
+def summarize_contents_by_chrom(in_filename: str,
+                                consumers: ty.Sequence[summarizers.BaseSummarizer],
+                                chroms: ty.Sequence[str],
+                                make_consumers: ty.Callable[[str], ty.Sequence[summarizers.BaseSummarizer]],
+                                *, map_func: ty.Callable = map) -> list:
+    """
+    Same as `summarize_contents`, but each chromosome is read (via the tabix index) and summarized separately. The
+        partial summaries are then merged into `consumers`, in file order, so that the results are exactly the same.
+
+    :param chroms: Every chromosome in the file, in file order
+    :param make_consumers: Create the (mergeable) summarizers for one chromosome. When a process pool is used, this
+        must be picklable (eg a module-level function, or `functools.partial` of one).
+    :param map_func: Used to summarize all chromosomes, eg `pool.map` to use a process pool. Results must be returned
+        in the order given.
+    """
+    partials = map_func(functools.partial(_summarize_chrom, in_filename, make_consumers), chroms)
+    for chrom_consumers in partials:
+        for summarizer, partial in zip(consumers, chrom_consumers):
+            summarizer.merge(partial)
+    return summarizers.get_results(consumers)
 
-    with open(out_filename, 'w') as f:
-        json.dump(rv, f)
 
+@helpers.capture_errors
+def generate_manhattan(build: str, in_filename: str, out_filename: str, max_qval: float = None) -> bool:
+    """Generate manhattan plot data for the processed file"""
+    manhattan_data, = summarize_contents(in_filename, [summarizers.ManhattanSummarizer(build, max_qval=max_qval)])
+    write_json(manhattan_data, out_filename)
+    return True
+
+
+@helpers.capture_errors
+def generate_qq(in_filename: str, out_filename, maf_counts=None) -> bool:
+    """Largely borrowed from PheWeb code (load.qq.make_json_file)"""
+    qq_data, = summarize_contents(in_filename, [summarizers.QQSummarizer(maf_counts=maf_counts)])
+    write_json(qq_data, out_filename)
     return True
 
 
@@ -129,16 +225,5 @@ def get_top_hit(in_filename: str):
 
     Although most of the tasks in our pipeline are written to be ORM-agnostic, this one modifies the database.
     """
-    reader = sniffers.guess_gwas_standard(in_filename)\
-        .add_filter("neg_log_pvalue")
-    best_pval = 1
-    best_row = None
-    for row in reader:
-        if row.pval < best_pval:
-            best_pval = row.pval
-            best_row = row
-
-    if best_row is None:
-        raise TopHitException('No usable top hit could be identified. Check that the file has valid p-values.')
-
+    best_row, = summarize_contents(in_filename, [summarizers.TopHitSummarizer()])
     return best_row
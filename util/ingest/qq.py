@@ -16,24 +16,32 @@ Extracted from PheWeb: 2cfaa69
 #               - then we could start processing variants after reading only 10% of all variants
 #               - if we're wrong, `raise StrataGuessingFailed()` and try again with sorting.
 #          c) we could run manhattan before this, and make it track Counter(rounded(v.maf,2) for v in variants).
+# (Implemented: qvals are counted in a `QvalHistogram`. Strata use option (c): the normalization pass counts rounded
+#   MAF values, and `MafStrata` uses those counts to assign each variant to a stratum as it streams by.)
 
 # NOTE: `qval` means `-log10(pvalue)`
 
+import bisect
 import collections
 import logging
 import math
 import typing as ty
 
-import boltons.iterutils
 import boltons.mathutils
+import numpy as np
 import scipy.stats
 from zorp.parsers import BasicVariant
 
+from .exceptions import QQPlotException
+
 
 NUM_BINS = 400
 NUM_MAF_RANGES = 4
 MAF_SIGFIGS = 2
 
+# Increment whenever a change alters qq.json, so that cached QQ plots are rebuilt (see `manifests`)
+VERSION = 2
+
 
 logger = logging.getLogger(__name__)
 
@@ -41,18 +49,32 @@ logger = logging.getLogger(__name__)
 Variant = collections.namedtuple('Variant', ['qval', 'maf'])
 
 
+def augment_variant(var: BasicVariant) -> Variant:
+    if var.pvalue == 0:
+        # FIXME: Why does QQ plot require this stub value?
+        qval = 1000  # TODO(pjvh): make an option "convert_pval0_to = [num|None]"
+    else:
+        qval = var.neg_log_pvalue
+
+    af = var.maf
+    if af is not None:
+        af = round(af, MAF_SIGFIGS)
+    return Variant(qval=qval, maf=af)
+
+
 def augment_variants(variants: ty.Iterator[BasicVariant], num_samples=None):
     for var in variants:
-        if var.pvalue == 0:
-            # FIXME: Why does QQ plot require this stub value?
-            qval = 1000  # TODO(pjvh): make an option "convert_pval0_to = [num|None]"
-        else:
-            qval = var.neg_log_pvalue
+        yield augment_variant(var)
+
 
-        af = var.maf
-        if af is not None:
-            af = round(af, MAF_SIGFIGS)
-        yield Variant(qval=qval, maf=af)
+def augment_qvals(variants: ty.Sequence[BasicVariant]) -> np.ndarray:
+    """The qval that `augment_variant` would assign to each variant, as an array"""
+    qvals = np.fromiter((var.neg_log_pvalue for var in variants), dtype=np.float64, count=len(variants))
+    # Only very large qvals can have pvalue 0 (eg `10 ** -400` underflows); check those few in the same way as above
+    for idx in np.flatnonzero(qvals > 300):
+        if variants[idx].pvalue == 0:
+            qvals[idx] = 1000
+    return qvals
 
 
 def round_sig(x, digits):
@@ -106,55 +128,80 @@ def make_qq_unstratified(variants, include_qq):
     if include_qq:
         rv['qq'] = compute_qq(qvals)
     rv['count'] = len(qvals)
-    rv['gc_lambda'] = {}
+    rv['gc_lambda'] = _get_gc_lambdas(lambda perc: gc_value_from_list(qvals, perc))
+    return rv
+
+
+def _get_gc_lambdas(get_gc_value: ty.Callable[[float], float]) -> dict:
+    gc_lambda = {}
     for perc in ['0.5', '0.1', '0.01', '0.001']:
-        gc = gc_value_from_list(qvals, float(perc))
+        gc = get_gc_value(float(perc))
         if math.isnan(gc) or abs(gc) == math.inf:
             logger.warning('WARNING: got gc_value {!r}'.format(gc))
         else:
-            rv['gc_lambda'][perc] = round_sig(gc, 5)
-    return rv
+            gc_lambda[perc] = round_sig(gc, 5)
+    return gc_lambda
 
 
 def compute_qq(qvals):
     # qvals must be in decreasing order.
-    assert all(a >= b for a, b in boltons.iterutils.pairwise(qvals))
-
-    if len(qvals) == 0:
-        return []
+    qvals = np.asarray(qvals, dtype=np.float64)
+    assert np.all(np.diff(qvals) <= 0)
+    return compute_qq_from_histogram(qvals, np.ones(len(qvals), dtype=np.int64))
 
-    if qvals[0] == 0:
-        logger.warning('WARNING: All pvalues are 1! How is that supposed to make a QQ plot?')
-        return []
 
-    max_exp_qval = -math.log10(0.5 / len(qvals))
+def _get_max_obs_qval(qvals: np.ndarray, max_exp_qval: float) -> float:
+    """Find the largest observed qval that will be shown in the plot. `qvals` must be in decreasing order."""
+    top_qval = float(qvals[0])
     # Our QQ plot will only show `obs_qval` up to `ceil(2*max_exp_pval)`.
     # So we can drop any obs_qval above that, to save space and make sure the visible range gets all the NUM_BINS.
 
     # this calculation must avoid dropping points that would be shown by the calculation done in javascript.
     # `max_obs_qval` means the largest observed -log10(pvalue) that will be shown in the plot. It's usually NOT the
     # largest in the data.
-    max_obs_qval = boltons.mathutils.clamp(qvals[0],
+    max_obs_qval = boltons.mathutils.clamp(top_qval,
                                            lower=max_exp_qval,
                                            upper=math.ceil(2 * max_exp_qval))
-    if qvals[0] > max_obs_qval:
-        for qval in qvals:
-            if qval <= max_obs_qval:
-                max_obs_qval = qval
-                break
-
-    occupied_bins = set()
-    for i, obs_qval in enumerate(qvals):
-        if obs_qval > max_obs_qval:
-            continue
-        exp_qval = -math.log10((i + 0.5) / len(qvals))
-        exp_bin = int(exp_qval / max_exp_qval * NUM_BINS)
-        # TODO(pjvh): it'd be great if the `obs_bin`s started right at the lowest qval in that `exp_bin`.
-        #       that way we could have fewer bins but still get a nice straight diagonal line without that
-        #       stair-stepping appearance.
-        obs_bin = int(obs_qval / max_obs_qval * NUM_BINS)
-        occupied_bins.add((exp_bin, obs_bin))
-
+    if top_qval > max_obs_qval:
+        shown = qvals <= max_obs_qval
+        if shown.any():
+            max_obs_qval = float(qvals[shown.argmax()])
+    return max_obs_qval
+
+
+def _get_exp_bins(num_variants: int, max_exp_qval: float) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """
+    Split the ranks `0..num_variants-1` into contiguous runs that share one `exp_bin`. Returns the first rank of each
+        run, and its `exp_bin`.
+
+    There are at most NUM_BINS + 1 runs. Run boundaries are found with the same (scalar) expression that assigns an
+        `exp_bin` to each rank, so that every rank gets exactly the value of the original per-variant calculation.
+    """
+    def get_exp_bin(rank: int) -> int:
+        exp_qval = -math.log10((rank + 0.5) / num_variants)
+        return int(exp_qval / max_exp_qval * NUM_BINS)
+
+    starts = []
+    exp_bins = []
+    rank = 0
+    while rank < num_variants:
+        exp_bin = get_exp_bin(rank)
+        starts.append(rank)
+        exp_bins.append(exp_bin)
+
+        # Find the last rank that shares this exp_bin. Expected qvals decrease with rank, so estimate the boundary
+        #   from the inverse formula, then correct for any floating point error.
+        end = math.floor(num_variants * 10 ** (-exp_bin * max_exp_qval / NUM_BINS) - 0.5)
+        end = min(max(end, rank), num_variants - 1)
+        while end < num_variants - 1 and get_exp_bin(end + 1) >= exp_bin:
+            end += 1
+        while get_exp_bin(end) < exp_bin:
+            end -= 1
+        rank = end + 1
+    return np.array(starts, dtype=np.int64), np.array(exp_bins, dtype=np.int64)
+
+
+def _format_qq(occupied_bins: ty.Set[ty.Tuple[int, int]], max_exp_qval: float, max_obs_qval: float) -> dict:
     bins = []
     for exp_bin, obs_bin in occupied_bins:
         assert 0 <= exp_bin <= NUM_BINS, exp_bin
@@ -171,8 +218,8 @@ def compute_qq(qvals):
 
 def gc_value_from_list(qvals, quantile=0.5):
     # qvals must be in decreasing order.
-    assert all(a >= b for a, b in boltons.iterutils.pairwise(qvals))
-    qval = qvals[int(len(qvals) * quantile)]
+    assert np.all(np.diff(qvals) <= 0)
+    qval = float(qvals[int(len(qvals) * quantile)])
     pval = 10 ** -qval
     return gc_value(pval, quantile)
 
@@ -189,6 +236,291 @@ assert approx_equal(gc_value(0.50001), 0.9999533)
 assert approx_equal(gc_value(0.6123), 0.5645607)
 
 
+#####
+# Bounded-memory QQ
+# Studies with tens of millions of variants can't keep (and sort) a list of every qval. Instead, qvals are counted in
+#   a fixed-resolution histogram, with buckets `1 / QVAL_RESOLUTION` wide. Each bucket remembers its count and its
+#   largest (exact) qval, which is used to represent every qval in that bucket. Memory is bounded by the number of
+#   occupied buckets (in practice, ~10 * QVAL_RESOLUTION), regardless of the number of variants.
+#
+# Error versus the exact (list-based) algorithm:
+#   - Counts, ranks, and expected qvals are exact: the histogram knows how many variants are above any observed value.
+#   - Each observed qval is replaced by a real qval from the study that is at most `1 / QVAL_RESOLUTION` (1e-4) larger.
+#       The largest qval (and usually the `max_obs_qval` that sets the plot scale) is exact. A QQ point can therefore
+#       only move to the adjacent `obs_bin` (one step of `max_obs_qval / NUM_BINS`), and only for variants whose qval
+#       lies within 1e-4 below a bin edge.
+#   - Genomic control lambdas are exact for studies with up to `EXACT_QVALS_LIMIT` variants: the histogram also keeps
+#       every qval (as a float64 array, ~32 MB at the limit), and the quantiles are selected from those.
+#   - For larger studies, bounded memory takes priority, and the exact qvals are dropped. Lambdas are then computed
+#       from a qval that is within 1e-4 of the exact quantile, which is a relative error of at most ~2.3e-4 in the
+#       pvalue. For the median, this moves lambda by at most ~5.4e-4 of its value (less for the other quantiles), so
+#       the last digits of the rounded lambdas can differ (eg `gc_lambda['0.5']` may be 1.0105 rather than 1.0106).
+QVAL_RESOLUTION = 10_000
+EXACT_QVALS_LIMIT = 2 ** 22
+
+
+class QvalHistogram:
+    """
+    Count qvals at a fixed resolution, for QQ plots and genomic control in bounded memory.
+
+    Histograms can be merged, so that partial results (eg from separate parts of a file) can be combined. Buckets are
+        stored as sorted arrays; new qvals are buffered, and added in bulk. The exact qvals are also kept, until there
+        are more than `exact_limit` of them.
+    """
+    # Number of buffered qvals that triggers a merge into the sorted buckets
+    FLUSH_SIZE = 2 ** 20
+
+    def __init__(self, resolution: int = QVAL_RESOLUTION, exact_limit: int = EXACT_QVALS_LIMIT):
+        self.resolution = resolution
+        self.exact_limit = exact_limit
+        # One entry per occupied bucket, in increasing order of bucket key
+        self._keys = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._maxes = np.empty(0, dtype=np.float64)
+        self._pending = []  # type: ty.List[np.ndarray]
+        self._num_pending = 0
+        self._count = 0
+        self._exact = []  # type: ty.Optional[ty.List[np.ndarray]]
+
+    def update(self, qvals: ty.Iterable[float]):
+        if not isinstance(qvals, np.ndarray):
+            qvals = np.fromiter(qvals, dtype=np.float64)
+        qvals = qvals.astype(np.float64, copy=False)
+        self._pending.append(qvals)
+        self._num_pending += len(qvals)
+        self._count += len(qvals)
+        self._keep_exact([qvals])
+        if self._num_pending >= self.FLUSH_SIZE:
+            self._flush()
+
+    def merge(self, other: 'QvalHistogram'):
+        if other.resolution != self.resolution:
+            raise ValueError('Cannot merge histograms with different resolutions')
+        self._flush()
+        other._flush()
+        self._combine(other._keys, other._counts, other._maxes)
+        self._count += len(other)
+        if other._exact is None:
+            self._exact = None
+        else:
+            self._keep_exact(other._exact)
+
+    def descending(self) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """(qvals, counts) arrays with one entry per bucket, largest qval first"""
+        self._flush()
+        return self._maxes[::-1], self._counts[::-1]
+
+    def exact(self) -> ty.Optional[np.ndarray]:
+        """Every qval, in no particular order; None if there were too many to keep"""
+        if self._exact is None:
+            return None
+        if len(self._exact) != 1:
+            self._exact = [np.concatenate(self._exact) if self._exact else np.empty(0, dtype=np.float64)]
+        return self._exact[0]
+
+    def _keep_exact(self, parts: ty.List[np.ndarray]):
+        if self._exact is None:
+            return
+        if self._count > self.exact_limit:
+            self._exact = None
+        else:
+            self._exact.extend(parts)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        qvals = np.concatenate(self._pending)
+        self._pending = []
+        self._num_pending = 0
+        keys = np.floor(qvals * self.resolution).astype(np.int64)
+        self._combine(keys, np.ones(len(qvals), dtype=np.int64), qvals)
+
+    def _combine(self, keys: np.ndarray, counts: np.ndarray, maxes: np.ndarray):
+        """Add (key, count, max) entries to the buckets. Entries do not need to be sorted or unique."""
+        keys = np.concatenate([self._keys, keys])
+        counts = np.concatenate([self._counts, counts])
+        maxes = np.concatenate([self._maxes, maxes])
+        if not len(keys):
+            return
+
+        order = np.argsort(keys, kind='stable')
+        keys, counts, maxes = keys[order], counts[order], maxes[order]
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        self._keys = keys[starts]
+        self._counts = np.add.reduceat(counts, starts)
+        self._maxes = np.maximum.reduceat(maxes, starts)
+
+    def __len__(self):
+        return self._count
+
+
+def make_qq_unstratified_from_histogram(histogram: QvalHistogram, include_qq: bool) -> dict:
+    """Bounded-memory equivalent of `make_qq_unstratified`"""
+    qvals, counts = histogram.descending()
+    rv = {}
+    if include_qq:
+        rv['qq'] = compute_qq_from_histogram(qvals, counts)
+    rv['count'] = len(histogram)
+    exact = histogram.exact()
+    if exact is not None:
+        rv['gc_lambda'] = _get_gc_lambdas(lambda perc: gc_value_from_array(exact, perc))
+    else:
+        rv['gc_lambda'] = _get_gc_lambdas(lambda perc: gc_value_from_histogram(qvals, counts, perc))
+    return rv
+
+
+def compute_qq_from_histogram(qvals: np.ndarray, counts: np.ndarray) -> ty.Union[dict, list]:
+    """
+    Equivalent of `compute_qq`, for histogram buckets: (qval, count) arrays, in decreasing order of qval.
+
+    Rather than visiting each variant, this visits each contiguous range of ranks that shares one bucket and one
+        `exp_bin`. The work is proportional to (number of buckets + NUM_BINS).
+    """
+    num_variants = int(counts.sum())
+    if num_variants == 0:
+        return []
+
+    if qvals[0] == 0:
+        logger.warning('WARNING: All pvalues are 1! How is that supposed to make a QQ plot?')
+        return []
+
+    max_exp_qval = -math.log10(0.5 / num_variants)
+    max_obs_qval = _get_max_obs_qval(qvals, max_exp_qval)
+
+    # Every rank range that starts a new bucket, or a new exp_bin, is one (exp_bin, obs_bin) point. Both lists of
+    #   range starts are sorted, so they can be merged without sorting.
+    bucket_starts = np.cumsum(counts) - counts
+    exp_starts, exp_bins = _get_exp_bins(num_variants, max_exp_qval)
+    insert_at = np.searchsorted(bucket_starts, exp_starts)
+    is_new = bucket_starts[np.minimum(insert_at, len(bucket_starts) - 1)] != exp_starts
+    range_starts = np.insert(bucket_starts, insert_at[is_new], exp_starts[is_new])
+    buckets = np.searchsorted(bucket_starts, range_starts, side='right') - 1
+    exp_bins = exp_bins[np.searchsorted(exp_starts, range_starts, side='right') - 1]
+
+    shown = qvals[buckets] <= max_obs_qval
+    # TODO(pjvh): it'd be great if the `obs_bin`s started right at the lowest qval in that `exp_bin`.
+    #       that way we could have fewer bins but still get a nice straight diagonal line without that
+    #       stair-stepping appearance.
+    with np.errstate(divide='raise', invalid='raise'):
+        obs_bins = (qvals[buckets[shown]] / max_obs_qval * NUM_BINS).astype(np.int64)
+    exp_bins = exp_bins[shown]
+
+    # Neither exp_bin nor obs_bin can increase with rank, so repeated points are always adjacent
+    is_new = np.ones(len(obs_bins), dtype=bool)
+    is_new[1:] = (exp_bins[1:] != exp_bins[:-1]) | (obs_bins[1:] != obs_bins[:-1])
+    occupied_bins = zip(exp_bins[is_new].tolist(), obs_bins[is_new].tolist())
+
+    return _format_qq(set(occupied_bins), max_exp_qval, max_obs_qval)
+
+
+class MafStrata:
+    """
+    Decide the MAF strata in advance, from a table of how many variants have each (rounded) MAF value. Each variant can
+        then be assigned to its stratum as it streams by, so that each stratum only needs a `QvalHistogram`.
+
+    This is equivalent to `make_qq_stratified`, which sorts all variants by MAF and cuts the list into equal-count
+        pieces. Variants with the same MAF are assigned in file order, exactly as a stable sort would do.
+    """
+    def __init__(self, maf_counts: ty.Iterable[ty.Tuple[ty.Optional[float], int]], num_ranges: int = NUM_MAF_RANGES):
+        self._counts = collections.Counter()  # type: ty.Counter[ty.Optional[float]]
+        for maf, count in maf_counts:
+            self._counts[maf] += count
+
+        # Some variants may be missing MAF. Sort those at the end of the list (eg, lump with the common variants)
+        self._order = sorted(self._counts, key=lambda maf: (maf is None, maf))
+        self._starts = []  # type: ty.List[int]  # Position in the sorted list of the first variant with each MAF
+        position = 0
+        for maf in self._order:
+            self._starts.append(position)
+            position += self._counts[maf]
+        # Per-MAF state is kept in arrays (indexed by position in `_order`), so that many variants can be assigned
+        #   at once
+        self._code_by_maf = {maf: code for code, maf in enumerate(self._order)}
+        self._start_array = np.array(self._starts, dtype=np.int64)
+        self._count_array = np.array([self._counts[maf] for maf in self._order], dtype=np.int64)
+        self._seen = np.zeros(len(self._order), dtype=np.int64)
+
+        self.num_variants = position
+        self.num_ranges = num_ranges
+        # Note: bounds[i + 1] is the same as bounds[i] of the next slice; slices exclude the last index.
+        self.bounds = [position * idx // num_ranges for idx in range(num_ranges + 1)]
+
+    def assign(self, maf: ty.Optional[float]) -> int:
+        """Return the stratum for the next variant (in file order) with this MAF"""
+        return int(self.assign_many([maf])[0])
+
+    def assign_many(self, mafs: ty.Sequence[ty.Optional[float]]) -> np.ndarray:
+        """Return the strata for the next several variants (in file order), given the MAF of each"""
+        codes = np.fromiter((self._code_by_maf.get(maf, -1) for maf in mafs), dtype=np.int64, count=len(mafs))
+        if not len(codes):
+            return codes
+        seen = self._seen + np.bincount(codes[codes >= 0], minlength=len(self._seen))
+        if (codes < 0).any() or (seen > self._count_array).any():
+            raise QQPlotException('MAF counts do not match the contents of the file')
+
+        # Variants with the same MAF are numbered in file order, continuing from any that were assigned earlier
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        group_starts = np.flatnonzero(np.concatenate([[True], sorted_codes[1:] != sorted_codes[:-1]]))
+        group_sizes = np.diff(np.append(group_starts, len(codes)))
+        ranks = np.empty(len(codes), dtype=np.int64)
+        ranks[order] = np.arange(len(codes)) - np.repeat(group_starts, group_sizes)
+
+        positions = self._start_array[codes] + self._seen[codes] + ranks
+        self._seen = seen
+        return np.searchsorted(self.bounds, positions, side='right') - 1
+
+    def skip(self, maf_counts: ty.Iterable[ty.Tuple[ty.Optional[float], int]]):
+        """
+        Mark some variants as already assigned, without assigning them. This allows part of a file (eg one chromosome)
+            to be assigned separately, given the (maf, count) pairs for all variants that come before it.
+        """
+        for maf, count in maf_counts:
+            code = self._code_by_maf.get(maf)
+            if code is None or self._seen[code] + count > self._count_array[code]:
+                raise QQPlotException('MAF counts do not match the contents of the file')
+            self._seen[code] += count
+
+    def maf_at(self, position: int) -> ty.Optional[float]:
+        """The MAF of the variant at a given position in the (virtual) sorted list"""
+        if position < 0:
+            position += self.num_variants
+        return self._order[bisect.bisect_right(self._starts, position) - 1]
+
+
+def make_qq_stratified_from_histograms(strata: MafStrata, histograms: ty.List[QvalHistogram]) -> list:
+    """Bounded-memory equivalent of `make_qq_stratified`, given one histogram per stratum"""
+    rv = []
+    for idx, histogram in enumerate(histograms):
+        start, end = strata.bounds[idx], strata.bounds[idx + 1]
+        rv.append({
+            'maf_range': (strata.maf_at(start), strata.maf_at(end - 1)),
+            'count': len(histogram),
+            'qq': compute_qq_from_histogram(*histogram.descending()),
+        })
+    return rv
+
+
+def gc_value_from_array(qvals: np.ndarray, quantile=0.5):
+    """Equivalent of `gc_value_from_list`, for an array of qvals in any order"""
+    # The list is in decreasing order, so the same qval is at this position in increasing order
+    idx = len(qvals) - 1 - int(len(qvals) * quantile)
+    if idx < 0:
+        raise IndexError('Quantile is out of range')
+    qval = float(np.partition(qvals, idx)[idx])
+    return gc_value(10 ** -qval, quantile)
+
+
+def gc_value_from_histogram(qvals: np.ndarray, counts: np.ndarray, quantile=0.5):
+    """Equivalent of `gc_value_from_list`, for histogram (qval, count) arrays in decreasing order of qval"""
+    ranks = np.cumsum(counts)
+    target = int(int(counts.sum()) * quantile)
+    idx = np.searchsorted(ranks, target, side='right')
+    if idx >= len(qvals):
+        raise IndexError('Quantile is out of range')
+    return gc_value(10 ** -float(qvals[idx]), quantile)
+
+
 def get_confidence_intervals(num_variants, confidence=0.95):
     one_sided_doubt = (1 - confidence) / 2
 
@@ -200,10 +532,15 @@ def get_confidence_intervals(num_variants, confidence=0.95):
     variant_counts.append(num_variants - 1)
     variant_counts.reverse()
 
-    for variant_count in variant_counts:
-        rv = scipy.stats.beta(variant_count, num_variants - variant_count)
+    # Evaluate every beta distribution in a single call
+    a = np.array(variant_counts, dtype=np.float64)
+    b = num_variants - a
+    y_mins = scipy.stats.beta.ppf(1 - one_sided_doubt, a, b)
+    y_maxes = scipy.stats.beta.ppf(one_sided_doubt, a, b)
+
+    for variant_count, y_min, y_max in zip(variant_counts, y_mins, y_maxes):
         yield {
             'x': round(-math.log10((variant_count - 0.5) / num_variants), 2),
-            'y_min': round(-math.log10(rv.ppf(1 - one_sided_doubt)), 2),
-            'y_max': round(-math.log10(rv.ppf(one_sided_doubt)), 2),
+            'y_min': round(-math.log10(y_min), 2),
+            'y_max': round(-math.log10(y_max), 2),
         }
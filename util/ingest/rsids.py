@@ -0,0 +1,127 @@
+"""
+Annotate variants with rsIDs, by walking the dbSNP lookup in the same order as the (position-sorted) GWAS file
+
+`zorp.lookups.SnpToRsid` answers one question at a time: each variant opens a new read transaction, searches the
+    whole lookup for its position, and decodes the record. Normalized files are sorted by position within each
+    chromosome, so instead this keeps one cursor open per chromosome and moves it forward alongside the GWAS rows (a
+    merge-join). Rows that fall before the next record need no search, nearby records are reached by stepping the cursor
+    forward, and each record is decoded at most once.
+"""
+import math
+import struct
+import time
+import typing as ty
+
+import msgpack
+from zorp import lookups
+from zorp.parsers import BasicVariant
+
+
+# Increment if a change could alter which rsIDs are found (see `manifests`)
+VERSION = 1
+
+
+class RsidAnnotator:
+    """
+    Find the rsID for each variant, in file order. Use as a zorp reader lookup, eg
+        `reader.add_lookup('rsid', annotator)`. Gives the same results as `zorp.lookups.SnpToRsid`, but is fastest when
+        variants are sorted by position (rows that are out of order are still found, with a new search).
+    """
+    # A record past the current one is reached by stepping forward through (at most) this many records. Larger gaps
+    #   (eg a region with no GWAS rows) use a new search instead.
+    MAX_STEPS = 8
+
+    def __init__(self, finder: lookups.SnpToRsid):
+        """
+        :param finder: The lookup for this genome build (used to locate and open the database)
+        """
+        self._finder = finder
+        self._chrom = None  # type: ty.Optional[str]
+        self._txn = None
+        self._cursor = None
+        # The cursor is at the first lookup record at or after the last position requested. There are no records
+        #   between the two, so rows in that range can be skipped without searching.
+        self._last_pos = -1
+        self._record_pos = -1  # type: float  # (inf: no more records)
+        self._alleles = None  # type: ty.Optional[dict]  # rsIDs at the record position, like {'A/G': 123}
+
+        # Statistics, for the ingest log
+        self.num_variants = 0
+        self.num_found = 0
+        self.elapsed = 0.0
+
+    @classmethod
+    def for_build(cls, build: str, *, test=False) -> 'RsidAnnotator':
+        return cls(lookups.SnpToRsid(build, test=test))
+
+    def __call__(self, variant: BasicVariant) -> ty.Optional[str]:
+        start = time.perf_counter()
+        self.num_variants += 1
+        rsid = None
+        if variant.chrom != self._chrom:
+            self._start_chrom(variant.chrom)
+
+        pos = variant.pos
+        if self._cursor is not None:
+            if pos < self._last_pos or self._record_pos < 0:
+                # Out of order, or the first row of the chromosome: search for the next record
+                self._seek(pos)
+            elif pos > self._record_pos:
+                self._advance(pos)
+            self._last_pos = pos
+            if pos == self._record_pos:
+                if self._alleles is None:
+                    # Decode each position only once, even if it has several variants
+                    self._alleles = msgpack.unpackb(self._cursor.value(), use_list=False)
+                rsid = self._alleles.get('{}/{}'.format(variant.ref, variant.alt))
+                if rsid is not None:
+                    self.num_found += 1
+                    rsid = 'rs{}'.format(rsid)
+        self.elapsed += time.perf_counter() - start
+        return rsid
+
+    def _start_chrom(self, chrom: str):
+        self.close()
+        self._chrom = chrom
+        if chrom not in self._finder.known_chroms:
+            return
+        env = self._finder.env
+        self._txn = env.begin(db=env.open_db(bytes(chrom, 'utf8'), integerkey=True))
+        self._cursor = self._txn.cursor()
+        self._last_pos = self._record_pos = -1
+
+    def _seek(self, pos: int):
+        """Move the cursor to the first record at or after this position"""
+        if self._cursor.set_range(struct.pack('I', pos)):
+            self._record_pos = struct.unpack('I', self._cursor.key())[0]
+        else:
+            self._record_pos = math.inf
+        self._alleles = None
+
+    def _advance(self, pos: int):
+        """Move the cursor forward to the first record at or after this position, which is past the current record"""
+        self._alleles = None
+        for _ in range(self.MAX_STEPS):
+            if not self._cursor.next():
+                self._record_pos = math.inf
+                return
+            self._record_pos = struct.unpack('I', self._cursor.key())[0]
+            if self._record_pos >= pos:
+                return
+        self._seek(pos)
+
+    def close(self):
+        """Release the read transaction for the current chromosome"""
+        if self._txn is not None:
+            self._txn.abort()
+        self._chrom = self._txn = self._cursor = None
+
+    @property
+    def hit_rate(self) -> float:
+        return self.num_found / self.num_variants if self.num_variants else 0.0
+
+    def summary(self) -> str:
+        """A human-readable summary of the work done, for the ingest log"""
+        rate = self.num_variants / self.elapsed if self.elapsed else 0.0
+        return 'Found rsIDs for {:,} of {:,} variants ({:.1%}) in {:.2f} s ({:,.0f} variants/s)'.format(
+            self.num_found, self.num_variants, self.hit_rate, self.elapsed, rate)
@@ -0,0 +1,125 @@
+"""
+Sort GWAS rows that were uploaded out of order, using a bounded amount of memory
+
+Rows are read in batches that fit in the memory budget. Each batch is sorted and written to a temporary "spill" file,
+    and the sorted spill files are then merged into one sorted file (an external merge sort). The output uses the same
+    columns as the normalized file, so it can be read with `sniffers.guess_gwas_standard` and normalized as usual.
+"""
+import heapq
+import logging
+import os
+import shutil
+import tempfile
+import typing as ty
+
+from zorp.parsers import BasicVariant
+
+from . import (
+    exceptions,
+    helpers,
+    validators,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Sorted output, and the rows written by `sort_variants`. Increment when a change alters either (see `manifests`).
+VERSION = 1
+
+# Chromosomes are sorted in natural order (1, 2, ..., 10, ..., X, Y). Only allowed chromosomes are ever sorted.
+CHROM_ORDER = {chrom: rank for rank, chrom in enumerate(helpers.natural_sort(validators.ALLOWED_CHROMS))}
+
+# Approximate memory used by each buffered row, in addition to the text of the line (the key, tuple, and str objects)
+ROW_OVERHEAD = 200
+
+
+def _format_row(variant: BasicVariant) -> str:
+    # Same format as `readers.BaseReader.write`: missing values (None) are written as `.`
+    return '\t'.join('.' if value is None else str(value) for value in
+                     (getattr(variant, name) for name in helpers.NORMALIZED_COLUMNS)) + '\n'
+
+
+def _line_key(line: str) -> ty.Tuple[int, int]:
+    chrom, pos, _ = line.split('\t', 2)
+    return CHROM_ORDER[chrom], int(pos)
+
+
+class _SpillFiles:
+    """Sorted batches of rows, written to temporary files in one folder (which is removed by `close`)"""
+    def __init__(self, tmp_dir: str, disk_budget: int):
+        self._folder = tempfile.mkdtemp(prefix='sort-', dir=tmp_dir)
+        self._disk_budget = disk_budget
+        self.paths = []  # type: ty.List[str]
+        self.bytes_written = 0
+
+    def write(self, lines: ty.Iterable[str]):
+        path = os.path.join(self._folder, f'{len(self.paths)}.txt')
+        self.paths.append(path)
+        with open(path, 'w') as f:
+            for line in lines:
+                f.write(line)
+            self.bytes_written += f.tell()
+        if self.bytes_written > self._disk_budget:
+            raise exceptions.ValidationException(
+                'This file is too large to be sorted on our servers. Please sort it by chromosome and position '
+                'before uploading.')
+
+    def close(self):
+        shutil.rmtree(self._folder, ignore_errors=True)
+
+
+def sort_variants(variants: ty.Iterable[BasicVariant], out_path: str, *,
+                  tmp_dir: str, memory_budget: int, disk_budget: int) -> int:
+    """
+    Write variants to a file, sorted by chromosome and position. Rows at the same position keep their original order.
+
+    The chromosome of every row is checked against the whitelist before the row is sorted, so that unexpected values
+        are rejected with the same message as in a sorted file.
+
+    :param variants: Parsed rows, in any order
+    :param out_path: Where to write the sorted rows (plain text, with a header row)
+    :param tmp_dir: Where to write temporary files. Temporary files are always removed before returning.
+    :param memory_budget: Approximate number of bytes of rows to hold in memory at once
+    :param disk_budget: Maximum number of bytes of temporary files
+    :return: The number of rows written
+    """
+    spills = _SpillFiles(tmp_dir, disk_budget)
+    batch = []  # type: ty.List[ty.Tuple[ty.Tuple[int, int], str]]
+    batch_size = 0
+    num_rows = 0
+    try:
+        for variant in variants:
+            validators.check_chrom(variant.chrom)
+            line = _format_row(variant)
+            batch.append(((CHROM_ORDER[variant.chrom], variant.pos), line))
+            batch_size += len(line) + ROW_OVERHEAD
+            num_rows += 1
+            if batch_size >= memory_budget:
+                # `sort` is stable, and compares only the key
+                batch.sort(key=lambda item: item[0])
+                spills.write(line for _, line in batch)
+                batch = []
+                batch_size = 0
+
+        batch.sort(key=lambda item: item[0])
+        with open(out_path, 'w') as out:
+            out.write('#' + '\t'.join(helpers.NORMALIZED_COLUMNS) + '\n')
+            if not spills.paths:
+                # Everything fit in memory
+                out.writelines(line for _, line in batch)
+            else:
+                handles = [open(path, 'r') for path in spills.paths]
+                try:
+                    # The in-memory batch was read last, so it comes last among rows at the same position
+                    runs = handles + [(line for _, line in batch)]
+                    out.writelines(heapq.merge(*runs, key=_line_key))
+                finally:
+                    for handle in handles:
+                        handle.close()
+    finally:
+        spills.close()
+
+    if spills.paths:
+        logger.info(f'Sorted {num_rows} rows using {len(spills.paths)} temporary files '
+                    f'({spills.bytes_written} bytes)')
+    return num_rows
@@ -0,0 +1,119 @@
+"""
+Line sources that wrap a raw upload, and change how the raw bytes are read for the parser
+
+Zorp readers accept any iterable of lines. By handing them one of these objects instead of a filename, the file can be
+    read on another thread while the parser runs, and the same single read can compute side information (like a hash)
+    that would otherwise require another full pass over a (very large) file.
+"""
+import binascii
+import gzip
+import hashlib
+import io
+import queue
+import threading
+import typing as ty
+
+
+def _is_gzip(path: str) -> bool:
+    with open(path, 'rb') as f:
+        # A known magic number for GZIP files: simple filetype detection (same as zorp)
+        return binascii.hexlify(f.read(2)) == b'1f8b'
+
+
+class _HashingFile(io.RawIOBase):
+    """Raw binary stream that updates a SHA256 hash with every byte that passes through it"""
+    def __init__(self, handle: ty.BinaryIO):
+        self._handle = handle
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = self._handle.readinto(buffer)
+        if n:
+            self.sha256.update(memoryview(buffer)[:n])
+        return n
+
+
+class ReadAheadLineSource:
+    """
+    A re-iterable source of text lines, from a plain text or gzip file, that is read (and decompressed) by a separate
+        thread while the caller parses the lines it has already received. Each iteration re-opens the file.
+
+    Decompression releases the GIL, so on a machine with more than one CPU it overlaps with parsing. Lines are passed
+        between threads in batches (of about `batch_size` bytes), and at most `max_batches` batches are read ahead, so
+        memory use is bounded no matter how far the parser falls behind. The lines are exactly the same as when zorp
+        opens the file itself.
+
+    When one iteration reads the file to the end, the SHA256 of the raw (compressed) bytes is recorded. Partial
+        iterations (like the header sniffing done by zorp) never touch the stored hash.
+    """
+    def __init__(self, path: str, *, batch_size: int = 2 ** 20, max_batches: int = 8):
+        self._path = path
+        self._batch_size = batch_size
+        self._max_batches = max_batches
+        self._sha256 = None  # type: ty.Optional[bytes]
+        self._is_gz = _is_gzip(path)
+
+    @property
+    def sha256(self) -> bytes:
+        """The hash of the raw file. Only available after the file has been read all the way through."""
+        if self._sha256 is None:
+            raise ValueError('The hash is only known after the entire file has been read')
+        return self._sha256
+
+    def _open(self, raw: io.RawIOBase) -> ty.TextIO:
+        buffered = io.BufferedReader(raw, buffer_size=self._batch_size)
+        if self._is_gz:
+            # A large buffer means that each call to zlib decompresses a lot of data (with the GIL released)
+            decompressed = gzip.GzipFile(fileobj=buffered)  # type: ty.BinaryIO
+            return io.TextIOWrapper(io.BufferedReader(decompressed, buffer_size=self._batch_size))  # type: ignore
+        return io.TextIOWrapper(buffered)
+
+    def _read(self, batches: queue.Queue, stop: threading.Event):
+        """Runs in the reader thread. Ends with `None` (the end of the file) or the exception that stopped it."""
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            with open(self._path, 'rb', buffering=0) as f:
+                raw = _HashingFile(f)
+                text = self._open(raw)
+                while True:
+                    lines = text.readlines(self._batch_size)
+                    if not lines:
+                        break
+                    if not put(lines):
+                        return
+                # Anything after the last line (eg gzip trailers) is part of the file, and must be part of the hash
+                while raw.read(self._batch_size):
+                    pass
+                self._sha256 = raw.sha256.digest()
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self) -> ty.Iterator[str]:
+        batches = queue.Queue(maxsize=self._max_batches)  # type: queue.Queue
+        stop = threading.Event()
+        thread = threading.Thread(target=self._read, args=(batches, stop), name='read-ahead', daemon=True)
+        thread.start()
+        try:
+            while True:
+                lines = batches.get()
+                if lines is None:
+                    return
+                if isinstance(lines, Exception):
+                    raise lines
+                yield from lines
+        finally:
+            # The caller may stop early (eg after reading the header rows): the thread must not wait forever
+            stop.set()
+            thread.join()
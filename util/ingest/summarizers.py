@@ -0,0 +1,385 @@
+"""
+Summarize the contents of a normalized GWAS file, in a single read of the data
+
+Each summarizer is a consumer that receives every variant in the file, and then produces one derived result (top hit,
+    QQ plot data, Manhattan plot data, etc). The file is read once, and each chunk of variants is fanned out to all
+    registered summarizers. New derived artifacts can be added by writing a new summarizer, without adding another
+    pass over multi-GB files.
+
+Summarizers can also be merged. Each part of a file (eg one chromosome) can be summarized separately (and in parallel),
+    and the partial summaries are then merged, in file order, to give the same result as a single read of the file.
+"""
+import abc
+import collections
+import itertools
+import logging
+import math
+import time
+import typing as ty
+
+from zorp.parsers import BasicVariant
+
+from .exceptions import QQPlotException, TopHitException
+from . import (
+    genes,
+    manhattan,
+    qq
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Increment when a change alters the top hit, the study stats, or how summaries are assembled (see `manifests`)
+VERSION = 2
+
+
+class BaseSummarizer(abc.ABC):
+    """A consumer that sees every variant in the study, and produces one result at the end"""
+    # A human-readable label, used in logs
+    label: str
+
+    def __init__(self):
+        # Cumulative time spent in this summarizer (seconds), including calculation of the final result
+        self.elapsed = 0.0
+        # Number of variants seen
+        self.num_variants = 0
+
+    def process_chunk(self, variants: ty.List[BasicVariant]):
+        """Receive a chunk of variants (in file order). Subclasses can override this for faster, bulk handling."""
+        for variant in variants:
+            self.process_variant(variant)
+
+    @abc.abstractmethod
+    def process_variant(self, variant: BasicVariant):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_result(self) -> ty.Any:
+        """Return the summary; called once, after all variants have been processed"""
+        raise NotImplementedError
+
+    def merge(self, other: 'BaseSummarizer'):
+        """
+        Add the state of another summarizer of the same kind, which saw the variants that come after all variants
+            seen by this one. Subclasses that support summarizing parts of a file separately must implement this.
+        """
+        raise NotImplementedError
+
+
+class TopHitSummarizer(BaseSummarizer):
+    """Find the very top hit in the study"""
+    label = 'Top hit'
+
+    def __init__(self):
+        super(TopHitSummarizer, self).__init__()
+        self._best_pval = 1
+        self._best_row = None  # type: ty.Optional[BasicVariant]
+
+    def process_variant(self, variant: BasicVariant):
+        if variant.pval < self._best_pval:
+            self._best_pval = variant.pval
+            self._best_row = variant
+
+    def merge(self, other: 'TopHitSummarizer'):
+        # Ties go to the variant that comes first in the file, as when reading the file in order
+        if other._best_row is not None and other._best_pval < self._best_pval:
+            self._best_pval = other._best_pval
+            self._best_row = other._best_row
+        self.elapsed += other.elapsed
+        self.num_variants += other.num_variants
+
+    def get_result(self) -> BasicVariant:
+        if self._best_row is None:
+            raise TopHitException('No usable top hit could be identified. Check that the file has valid p-values.')
+        return self._best_row
+
+
+class StudyStatsSummarizer(BaseSummarizer):
+    """
+    Count the things that later steps need to know in advance, such as how many variants have each (rounded) MAF, and
+        the largest finite qval (which decides the Manhattan plot bin size). MAF is also counted for each chromosome
+        (in file order), so that chromosomes can later be summarized separately, along with whether the study has MAF
+        (decided by the first variant, as the QQ plot does when it reads the whole file).
+
+    This is designed to run during normalization (see `as_transform`), so that the stats are available before the
+        summary step reads the file again. Like all summaries, it only considers variants with a pvalue.
+    """
+    label = 'Study stats'
+
+    def __init__(self):
+        super(StudyStatsSummarizer, self).__init__()
+        self._maf_counts_by_chrom = collections.OrderedDict()  # type: ty.Dict[str, ty.Counter[ty.Optional[float]]]
+        self._max_neg_log_pvalue = None  # type: ty.Optional[float]
+        self._has_maf = None  # type: ty.Optional[bool]
+
+    def process_variant(self, variant: BasicVariant):
+        neg_log_pvalue = variant.neg_log_pvalue
+        if neg_log_pvalue is None:
+            return
+        if self._has_maf is None:
+            self._has_maf = variant.maf is not None
+        if not math.isinf(neg_log_pvalue) \
+                and (self._max_neg_log_pvalue is None or neg_log_pvalue > self._max_neg_log_pvalue):
+            self._max_neg_log_pvalue = neg_log_pvalue
+        maf = variant.maf
+        if maf is not None:
+            maf = round(maf, qq.MAF_SIGFIGS)
+        chrom_counts = self._maf_counts_by_chrom.get(variant.chrom)
+        if chrom_counts is None:
+            chrom_counts = self._maf_counts_by_chrom[variant.chrom] = collections.Counter()
+        chrom_counts[maf] += 1
+
+    def merge(self, other: 'StudyStatsSummarizer'):
+        for chrom, counts in other._maf_counts_by_chrom.items():
+            self._maf_counts_by_chrom.setdefault(chrom, collections.Counter()).update(counts)
+        if other._max_neg_log_pvalue is not None \
+                and (self._max_neg_log_pvalue is None or other._max_neg_log_pvalue > self._max_neg_log_pvalue):
+            self._max_neg_log_pvalue = other._max_neg_log_pvalue
+        if self._has_maf is None:
+            self._has_maf = other._has_maf
+        self.elapsed += other.elapsed
+        self.num_variants += other.num_variants
+
+    def get_result(self) -> dict:
+        # JSON-serializable; MAF values are not always valid object keys (eg None)
+        def as_pairs(counts: ty.Counter[ty.Optional[float]]) -> list:
+            return sorted(counts.items(), key=lambda item: (item[0] is None, item[0]))
+
+        maf_counts = collections.Counter()  # type: ty.Counter[ty.Optional[float]]
+        for counts in self._maf_counts_by_chrom.values():
+            maf_counts.update(counts)
+        return {
+            'maf_counts': as_pairs(maf_counts),
+            'maf_counts_by_chrom': [[chrom, as_pairs(counts)] for chrom, counts in self._maf_counts_by_chrom.items()],
+            'max_neg_log_pvalue': self._max_neg_log_pvalue,
+            'has_maf': self._has_maf,
+        }
+
+
+class QQSummarizer(BaseSummarizer):
+    """Largely borrowed from PheWeb code (load.qq.make_json_file)"""
+    label = 'QQ plot'
+
+    def __init__(self, maf_counts: ty.Iterable[ty.Tuple[ty.Optional[float], int]] = None,
+                 maf_counts_before: ty.Iterable[ty.Tuple[ty.Optional[float], int]] = None,
+                 has_maf: bool = None):
+        """
+        :param maf_counts: (maf, count) pairs, as counted by `StudyStatsSummarizer`. When provided, MAF-stratified
+            plots are built in bounded memory.
+        :param maf_counts_before: When only part of the file will be seen by this summarizer, the (maf, count) pairs
+            for all variants that come earlier in the file
+        :param has_maf: Whether the study has MAF (as found by `StudyStatsSummarizer`). Otherwise, this is decided by
+            the first variant seen, which is only correct if this summarizer sees the start of the file.
+        """
+        super(QQSummarizer, self).__init__()
+        # QQ plots are built in bounded memory. See `qq.QvalHistogram` for the (small) error bounds. Only the overall
+        #   histogram keeps exact qvals, which are used for genomic control.
+        self._histogram = qq.QvalHistogram()
+        self._strata = qq.MafStrata(maf_counts) if maf_counts is not None else None
+        if self._strata is not None and maf_counts_before is not None:
+            self._strata.skip(maf_counts_before)
+        self._maf_histograms = [qq.QvalHistogram(exact_limit=0) for _ in range(qq.NUM_MAF_RANGES)]
+        self._has_maf = has_maf  # type: ty.Optional[bool]
+        # Without advance knowledge of MAF counts, strata can only be determined by keeping (and sorting) ALL variants
+        self._variants = []  # type: ty.List[qq.Variant]
+
+    def process_chunk(self, variants: ty.List[BasicVariant]):
+        if not variants:
+            return
+        qvals = qq.augment_qvals(variants)
+
+        if self._has_maf is None:
+            self._has_maf = variants[0].maf is not None
+            if self._has_maf and self._strata is None:
+                logger.warning('MAF counts not provided; QQ plot strata will be calculated in memory')
+
+        if self._has_maf:
+            if self._strata is not None:
+                mafs = (variant.maf for variant in variants)
+                strata = self._strata.assign_many([None if maf is None else round(maf, qq.MAF_SIGFIGS)
+                                                   for maf in mafs])
+                for idx, histogram in enumerate(self._maf_histograms):
+                    histogram.update(qvals[strata == idx])
+            else:
+                self._variants.extend(qq.augment_variant(variant) for variant in variants)
+        self._histogram.update(qvals)
+
+    def process_variant(self, variant: BasicVariant):
+        self.process_chunk([variant])
+
+    def merge(self, other: 'QQSummarizer'):
+        self._histogram.merge(other._histogram)
+        for histogram, other_histogram in zip(self._maf_histograms, other._maf_histograms):
+            histogram.merge(other_histogram)
+        if self._has_maf is None:
+            self._has_maf = other._has_maf
+        self._variants.extend(other._variants)
+        self.elapsed += other.elapsed
+        self.num_variants += other.num_variants
+
+    def get_result(self) -> dict:
+        # TODO: Pheweb QQ code benefits from being passed { num_samples: n }, from metadata stored outside the
+        #   gwas file. This is used when AF/MAF are present (which at the moment ingest pipeline does not support)
+        num_variants = len(self._histogram)
+        rv = {}
+        if num_variants:
+            if self._has_maf:
+                rv['overall'] = qq.make_qq_unstratified_from_histogram(self._histogram, include_qq=False)
+                if self._strata is not None:
+                    if self._strata.num_variants != num_variants:
+                        raise QQPlotException('MAF counts do not match the contents of the file')
+                    rv['by_maf'] = qq.make_qq_stratified_from_histograms(self._strata, self._maf_histograms)
+                else:
+                    rv['by_maf'] = qq.make_qq_stratified(self._variants)
+                rv['ci'] = list(qq.get_confidence_intervals(num_variants / len(rv['by_maf'])))
+            else:
+                rv['overall'] = qq.make_qq_unstratified_from_histogram(self._histogram, include_qq=True)
+                rv['ci'] = list(qq.get_confidence_intervals(num_variants))
+        return rv
+
+
+class ManhattanSummarizer(BaseSummarizer):
+    """Generate manhattan plot data, with the nearest gene(s) annotated for each top hit"""
+    label = 'Manhattan plot'
+
+    def __init__(self, build: str, *, max_qval: float = None, fold_threshold: float = manhattan.FOLD_THRESHOLD,
+                 mergeable: bool = False):
+        """
+        :param max_qval: The largest finite qval in the study, as found by `StudyStatsSummarizer`. When provided, all
+            variants are binned at the same resolution.
+        :param fold_threshold: The qval where the frontend folds the y-axis of a tall plot
+        :param mergeable: Whether this summarizer will be merged with others (see `manhattan.PartialBinner`). This
+            requires `max_qval`.
+        """
+        super(ManhattanSummarizer, self).__init__()
+        self._build = build
+        if mergeable:
+            self._binner = manhattan.PartialBinner(max_qval=max_qval, fold_threshold=fold_threshold)
+        else:
+            self._binner = manhattan.Binner(max_qval=max_qval, fold_threshold=fold_threshold)
+
+    def process_chunk(self, variants: ty.List[BasicVariant]):
+        self._binner.process_chunk(variants)
+
+    def process_variant(self, variant: BasicVariant):
+        self._binner.process_variant(variant)
+
+    def merge(self, other: 'ManhattanSummarizer'):
+        self._binner.merge(other._binner)
+        self.elapsed += other.elapsed
+        self.num_variants += other.num_variants
+
+    def get_result(self) -> dict:
+        manhattan_data = self._binner.get_result()
+
+        # Annotate nearest gene(s) for all "top hits". It's possible to have more than one nearest gene for a given
+        #   position (if variant is inside, not just near)
+        genes.get_gene_index(self._build).annotate(manhattan_data['unbinned_variants'])
+        for v_dict in manhattan_data['unbinned_variants']:
+            # Clean up values so JS can handle them
+            if math.isinf(v_dict['neg_log_pvalue']):
+                # JSON has no concept of infinity; use a string that browsers can type-coerce into the correct number
+                v_dict['neg_log_pvalue'] = 'Infinity'
+        return manhattan_data
+
+
+def as_transform(summarizer: BaseSummarizer) -> ty.Callable[[BasicVariant], BasicVariant]:
+    """
+    Feed a summarizer from inside another read of the data, by registering it as a zorp reader transform. This is
+        used to gather stats during the normalization pass.
+    """
+    def transform(variant: BasicVariant) -> BasicVariant:
+        summarizer.process_variant(variant)
+        summarizer.num_variants += 1
+        return variant
+    return transform
+
+
+def process(variants: ty.Iterable[BasicVariant], summarizers: ty.Sequence[BaseSummarizer], *, chunk_size: int = 10_000):
+    """
+    Read the variants once, and send each chunk to every summarizer. Time spent in each summarizer is recorded on its
+        `elapsed` attribute (and the number of variants on `num_variants`).
+
+    Variants are passed in chunks, so that timing has negligible overhead and summarizers can use bulk operations.
+    """
+    iterator = iter(variants)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            break
+        for summarizer in summarizers:
+            start = time.perf_counter()
+            summarizer.process_chunk(chunk)
+            summarizer.elapsed += time.perf_counter() - start
+            summarizer.num_variants += len(chunk)
+
+
+def get_results(summarizers: ty.Sequence[BaseSummarizer]) -> list:
+    """Returns a list of results (same order as the summarizers)"""
+    results = []
+    for summarizer in summarizers:
+        start = time.perf_counter()
+        results.append(summarizer.get_result())
+        summarizer.elapsed += time.perf_counter() - start
+        logger.debug('Summarizer "%s" completed in %.2f s', summarizer.label, summarizer.elapsed)
+    return results
+
+
+def summarize(variants: ty.Iterable[BasicVariant],
+              summarizers: ty.Sequence[BaseSummarizer],
+              *, chunk_size: int = 10_000) -> list:
+    """
+    Read the variants once, and send each chunk to every summarizer. Returns a list of results (same order as the
+        summarizers).
+    """
+    process(variants, summarizers, chunk_size=chunk_size)
+    return get_results(summarizers)
+
+
+def get_chroms(study_stats: dict) -> ty.Optional[ty.List[str]]:
+    """
+    The chromosomes in the study (in file order), if the stats gathered during normalization allow each chromosome to
+        be summarized separately. Studies ingested by older versions do not have the necessary stats.
+    """
+    if study_stats.get('max_neg_log_pvalue') is None or 'maf_counts_by_chrom' not in study_stats \
+            or 'has_maf' not in study_stats:
+        return None
+    return [chrom for chrom, _ in study_stats['maf_counts_by_chrom']]
+
+
+# The summaries calculated for every study. Each can be calculated separately (see `make_study_summarizers`).
+STUDY_SUMMARIES = ('top_hit', 'qq', 'manhattan')
+
+
+def make_study_summarizers(build: str, study_stats: dict, chrom: str = None, *,
+                           summaries: ty.Sequence[str] = STUDY_SUMMARIES,
+                           fold_threshold: float = manhattan.FOLD_THRESHOLD,
+                           mergeable: bool = False) -> ty.List[BaseSummarizer]:
+    """
+    Create the summarizers used for every study: top hit, QQ plot, and Manhattan plot (in the order requested)
+
+    :param build: The genome build
+    :param study_stats: Stats gathered during normalization (see `StudyStatsSummarizer`). May be empty.
+    :param chrom: If the summarizers will only see one chromosome (to be merged with the others later)
+    :param summaries: Which summaries to calculate (a subset of `STUDY_SUMMARIES`)
+    :param fold_threshold: The qval where the frontend folds the y-axis of a tall Manhattan plot
+    :param mergeable: Whether the summarizers will be merged with summarizers for other parts of the file
+    """
+    maf_counts_before = None
+    if chrom is not None:
+        maf_counts_before = []
+        for other_chrom, counts in study_stats['maf_counts_by_chrom']:
+            if other_chrom == chrom:
+                break
+            maf_counts_before.extend(counts)
+
+    factories = {
+        'top_hit': lambda: TopHitSummarizer(),
+        'qq': lambda: QQSummarizer(maf_counts=study_stats.get('maf_counts'), maf_counts_before=maf_counts_before,
+                                   has_maf=study_stats.get('has_maf')),
+        'manhattan': lambda: ManhattanSummarizer(build,
+                                                 max_qval=study_stats.get('max_neg_log_pvalue'),
+                                                 fold_threshold=fold_threshold,
+                                                 mergeable=mergeable),
+    }
+    return [factories[name]() for name in summaries]
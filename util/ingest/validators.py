@@ -2,8 +2,10 @@
 
 import itertools
 import logging
+import typing as ty
 
 import magic
+import numpy as np
 
 from zorp.readers import BaseReader
 
@@ -23,6 +25,117 @@ ALLOWED_CHROMS = frozenset({
     'X', 'Y', 'M', 'MT'
 })
 
+# Number of rows checked at once by `RowOrderChecker`
+BLOCK_SIZE = 10_000
+
+
+def check_chrom(chrom: str):
+    """Prevent server issues by imposting strict limits on what chroms are allowed"""
+    if chrom not in ALLOWED_CHROMS:
+        options = ' '.join(helpers.natural_sort(ALLOWED_CHROMS))
+        raise v_exc.ValidationException(
+            f"Chromosome {chrom} is not a valid chromosome name. Must be one of: '{options}'")
+
+
+class RowOrderChecker:
+    """
+    Streaming form of the row checks: data must be sorted, and all chroms must be contiguous and whitelisted
+
+    Rows are fed in one at a time, so that validation can share a single pass over the file with other steps (like
+        writing the normalized output). It can also be registered directly as a zorp reader transform: each row is
+        checked before it is passed on, so later steps (eg the tabix index, which requires sorted rows) never see
+        an invalid row.
+
+    When all the rows are available up front, `check_block` checks many rows at once, with the same results.
+    """
+    # Horked from PheWeb's `load.read_input_file.PhenoReader` class
+    def __init__(self):
+        self._chrom_seen = set()  # type: ty.Set[str]
+        self._prev_chrom = None  # type: ty.Optional[str]
+        self._prev_pos = -1
+
+    def __call__(self, variant):
+        chrom, pos = variant.chrom, variant.pos
+        if chrom == self._prev_chrom and pos >= self._prev_pos:
+            # The usual case (the next row of the same chrom) needs no other checks
+            self._prev_pos = pos
+        else:
+            self.check(chrom, pos)
+        return variant
+
+    def check_block(self, chroms: ty.Sequence[str], positions: ty.Sequence[int]):
+        """
+        Check the next several rows (in file order), given the chrom and pos of each. Equivalent to calling `check` for
+            each row, but the checks are done for all rows at once. If any row is invalid, the first one is checked
+            again by `check`, so that the error message is exactly the same.
+        """
+        if not len(chroms):
+            return
+        chroms = np.array(chroms, dtype=object)
+        positions = np.asarray(positions, dtype=np.int64)
+        prev_chroms = np.empty(len(chroms), dtype=object)
+        prev_chroms[0] = self._prev_chrom
+        prev_chroms[1:] = chroms[:-1]
+        prev_positions = np.concatenate([[self._prev_pos], positions[:-1]])
+
+        # Positions must increase within each chrom (several variants at one position are allowed)
+        is_start = chroms != prev_chroms
+        unsorted = np.flatnonzero(~is_start & (positions < prev_positions))
+        first_error = int(unsorted[0]) if len(unsorted) else len(chroms)
+
+        # Chroms only change a few times per block: check each new chrom is allowed, and has not been seen before
+        seen = set(self._chrom_seen)
+        for row in np.flatnonzero(is_start[:first_error]).tolist():
+            chrom = chroms[row]
+            if chrom not in ALLOWED_CHROMS or chrom in seen:
+                first_error = row
+                break
+            seen.add(chrom)
+
+        if first_error < len(chroms):
+            # All rows before the first error are valid: bring the state up to that row, and let it raise
+            self._chrom_seen.update(chroms[:first_error].tolist())
+            if first_error:
+                self._prev_chrom, self._prev_pos = chroms[first_error - 1], int(positions[first_error - 1])
+            self.check(chroms[first_error], int(positions[first_error]))
+            raise AssertionError('Row should have failed validation')  # pragma: no cover
+
+        self._chrom_seen = seen
+        self._prev_chrom, self._prev_pos = chroms[-1], int(positions[-1])
+
+    def check(self, cur_chrom: str, cur_pos: int):
+        if cur_chrom == self._prev_chrom and cur_pos == self._prev_pos:
+            # Several variants at one position are allowed, and have already been checked
+            return
+
+        check_chrom(cur_chrom)
+
+        if cur_chrom == self._prev_chrom and cur_pos < self._prev_pos:
+            # Positions not in correct order for Pheweb to use
+            raise v_exc.UnsortedDataException(
+                f'Positions must be sorted prior to uploading. '
+                f'Position chr{cur_chrom}:{cur_pos} should not follow chr{self._prev_chrom}:{self._prev_pos}'
+            )
+
+        if cur_chrom != self._prev_chrom:
+            if cur_chrom in self._chrom_seen:
+                raise v_exc.UnsortedDataException(f'Chromosomes must be sorted (so that all variants for the same chromosome are contiguous). Error at position: chr{cur_chrom}:{cur_pos}')  # noqa
+            else:
+                self._chrom_seen.add(cur_chrom)
+
+        self._prev_chrom = cur_chrom
+        self._prev_pos = cur_pos
+
+    def finish(self) -> bool:
+        """
+        Must make it through the entire file without parsing errors, with all chroms in order, and find at least
+            one row of data
+        """
+        if self._prev_pos != -1:
+            return True
+        else:
+            raise v_exc.ValidationException('File must contain at least one row of data')
+
 
 class _GwasValidator:
     """Validate a raw GWAS file as initially uploaded (given filename and instructions on how to parse it)"""
@@ -52,43 +165,22 @@ class _GwasValidator:
     @helpers.capture_errors
     def _validate_data_rows(self, reader) -> bool:
         """Data must be sorted, all values must be readable, and all chroms must be contiguous"""
-        # Horked from PheWeb's `load.read_input_file.PhenoReader` class
-        cp_groups = itertools.groupby(reader, key=lambda v: (v.chrom, v.pos))
-        chrom_seen = set()
-
-        prev_chrom = None
-        prev_pos = -1
-        for cp, tied_variants in cp_groups:
-            cur_chrom = cp[0]
-
-            # Prevent server issues by imposting strict limits on what chroms are allowed
-            if cur_chrom not in ALLOWED_CHROMS:
-                options = ' '.join(helpers.natural_sort(ALLOWED_CHROMS))
-                raise v_exc.ValidationException(
-                    f"Chromosome {cur_chrom} is not a valid chromosome name. Must be one of: '{options}'")
-
-            if cur_chrom == prev_chrom and cp[1] < prev_pos:
-                # Positions not in correct order for Pheweb to use
-                raise v_exc.ValidationException(
-                    f'Positions must be sorted prior to uploading. '
-                    f'Position chr{cur_chrom}:{cp[1]} should not follow chr{prev_chrom}:{prev_pos}'
-                )
-
-            if cur_chrom != prev_chrom:
-                if cur_chrom in chrom_seen:
-                    raise v_exc.ValidationException(f'Chromosomes must be sorted (so that all variants for the same chromosome are contiguous). Error at position: chr{cur_chrom}:{cp[1]}')  # noqa
-                else:
-                    chrom_seen.add(cur_chrom)
-
-            prev_chrom = cur_chrom
-            prev_pos = cp[1]
-
-        # Must make it through the entire file without parsing errors, with all chroms in order, and find at least
-        #   one row of data
-        if prev_pos != -1:
-            return True
-        else:
-            raise v_exc.ValidationException('File must contain at least one row of data')
+        checker = RowOrderChecker()
+        iterator = iter(reader)
+        while True:
+            block = list(itertools.islice(iterator, BLOCK_SIZE))
+            if not block:
+                break
+            checker.check_block([variant.chrom for variant in block], [variant.pos for variant in block])
+        return checker.finish()
+
+    def validate_file_type(self, filename: str) -> bool:
+        """Check only the type of the stored file. This reads a few bytes, and can be done before parsing begins."""
+        return self._validate_mimetype(self._get_encoding(filename))
+
+    def validate_mimetype(self, mimetype: str) -> bool:
+        """Check a file type that is already known (eg, sniffed from the first bytes while the file was uploaded)"""
+        return self._validate_mimetype(mimetype)
 
     @helpers.capture_errors
     def _validate_contents(self, reader: BaseReader) -> bool: